@@ -0,0 +1,65 @@
+"""
+Awaitable mirror of the `database` module.
+
+Every public function in `database` is available here under the same name:
+
+    await async_db.cache_message(...)
+    expiry, trial = await async_db.get_user_sub_info(user_id)
+
+Calls are executed on one dedicated DB thread that owns a long-lived SQLite
+connection, so disk I/O never stalls the asyncio loop that serves aiogram and
+all Pyrogram clients. SQLite serializes writers anyway, so a single thread
+costs nothing in throughput and keeps statement ordering deterministic.
+"""
+import time
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import database
+from services import metrics
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_wrappers = {}
+
+def _call(fn, args, kwargs):
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        # Never leave a half-finished transaction on the shared connection
+        conn = database._connect()
+        if conn.in_transaction:
+            conn.rollback()
+        raise
+
+async def run(fn, *args, **kwargs):
+    """Run any blocking callable on the DB thread and await its result."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, _call, fn, args, kwargs)
+    finally:
+        metrics.db_seconds.observe(time.perf_counter() - started, fn=getattr(fn, "__name__", "call"))
+
+def _wrap(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run(fn, *args, **kwargs)
+    return wrapper
+
+def __getattr__(name):
+    if name in _wrappers:
+        return _wrappers[name]
+    target = getattr(database, name, None)
+    if name.startswith("_") or not callable(target):
+        raise AttributeError(f"module 'async_db' has no attribute '{name}'")
+    _wrappers[name] = _wrap(target)
+    return _wrappers[name]
+
+async def shutdown():
+    """Close the DB thread's connection and stop the executor."""
+    try:
+        await run(database.close_connection)
+    except Exception as e:
+        logging.error(f"DB shutdown error: {e}")
+    _executor.shutdown(wait=True)
@@ -0,0 +1,199 @@
+"""
+Offline harness for update ingestion: a fake Bot API server plus a load driver.
+
+The fake server answers Bot API calls locally (getMe, setWebhook, getUpdates,
+send*/edit* ...). The driver fires a burst of updates either at our webhook
+app (services/webhook.py, with the secret token) or through getUpdates for
+long polling. It reports end-to-end latency from update delivery until the
+handler's reply reaches the "Telegram" side, plus overall throughput.
+
+    python benchmarks/fake_telegram.py --mode webhook --updates 2000 --handler-delay 0.05
+    python benchmarks/fake_telegram.py --mode polling --updates 2000 --handler-delay 0.05
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web, ClientSession
+from aiogram import Bot, Dispatcher, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+TOKEN = "123456:FAKE-TOKEN"
+SECRET = "harness-secret"
+
+class FakeTelegram:
+    """Just enough of the Bot API for aiogram to run against."""
+
+    def __init__(self):
+        self.updates = []          # pending updates for getUpdates
+        self.new_update = asyncio.Event()
+        self.replies = {}          # update number -> monotonic arrival time
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.webhook = None
+        self.calls = 0
+        self._message_id = 0
+
+    def push(self, update):
+        self.updates.append(update)
+        self.new_update.set()
+
+    async def _params(self, request):
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post())
+
+    async def handle(self, request):
+        method = request.match_info["method"].lower()
+        data = await self._params(request)
+        self.calls += 1
+        if method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method == "setwebhook":
+            self.webhook = data.get("url")
+            result = True
+        elif method == "deletewebhook":
+            self.webhook = None
+            result = True
+        elif method == "getupdates":
+            result = await self._get_updates(int(data.get("offset") or 0), float(data.get("timeout") or 0))
+        elif method.startswith(("send", "edit", "copy", "forward")):
+            result = self._message(data)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, offset, timeout):
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_update.clear()
+            try:
+                await asyncio.wait_for(self.new_update.wait(), min(timeout, 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    def _message(self, data):
+        text = str(data.get("text", ""))
+        if text.startswith("pong "):
+            self.replies[int(text.split()[1])] = time.monotonic()
+            if len(self.replies) >= self.expected:
+                self.done.set()
+        self._message_id += 1
+        return {
+            "message_id": self._message_id, "date": int(time.time()), "text": text,
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+        }
+
+def make_update(n):
+    user = {"id": 100000 + n % 500, "is_bot": False, "first_name": "Load"}
+    return {
+        "update_id": n,
+        "message": {
+            "message_id": n, "date": int(time.time()), "text": f"ping {n}",
+            "chat": {"id": user["id"], "type": "private"}, "from": user,
+        },
+    }
+
+def make_dispatcher(handler_delay):
+    router = Router()
+
+    @router.message()
+    async def echo(message: types.Message):
+        if handler_delay:
+            await asyncio.sleep(handler_delay) # stands in for DB/API work of a real handler
+        await message.answer(f"pong {message.text.split()[1]}")
+
+    dp = Dispatcher()
+    dp.include_router(router)
+    return dp
+
+async def start_site(app, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+async def drive_webhook(fake, dp, bot, args):
+    from services.webhook import build_app
+    import config
+    runner = await start_site(build_app(dp, bot, SECRET), args.webhook_port)
+    url = f"http://127.0.0.1:{args.webhook_port}{config.WEBHOOK_PATH}"
+    sent = {}
+    try:
+        async with ClientSession() as http:
+            async with http.post(url, json=make_update(0), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as resp:
+                print(f"Wrong secret token -> HTTP {resp.status}" + (" ✓" if resp.status == 401 else " ✗ expected 401"))
+
+            sem = asyncio.Semaphore(args.connections) # Telegram opens at most max_connections at once
+            async def post(n):
+                async with sem:
+                    sent[n] = time.monotonic()
+                    async with http.post(url, json=make_update(n), headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as resp:
+                        resp.raise_for_status()
+            await asyncio.gather(*(post(n) for n in range(1, args.updates + 1)))
+            await asyncio.wait_for(fake.done.wait(), args.timeout)
+    finally:
+        await runner.cleanup()
+    return sent
+
+async def drive_polling(fake, dp, bot, args):
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=1))
+    await asyncio.sleep(0.5)
+    sent = {}
+    for n in range(1, args.updates + 1):
+        sent[n] = time.monotonic()
+        fake.push(make_update(n))
+    try:
+        await asyncio.wait_for(fake.done.wait(), args.timeout)
+    finally:
+        await dp.stop_polling()
+        await asyncio.gather(polling, return_exceptions=True)
+    return sent
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+async def main_async(args):
+    fake = FakeTelegram()
+    fake.expected = args.updates
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", fake.handle)
+    fake_runner = await start_site(app, args.api_port)
+
+    bot = Bot(TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.api_port}")))
+    dp = make_dispatcher(args.handler_delay)
+    try:
+        if args.mode == "webhook":
+            sent = await drive_webhook(fake, dp, bot, args)
+        else:
+            sent = await drive_polling(fake, dp, bot, args)
+    finally:
+        await bot.session.close()
+        await fake_runner.cleanup()
+
+    latencies = sorted((fake.replies[n] - sent[n]) * 1000 for n in sent if n in fake.replies)
+    elapsed = max(fake.replies.values()) - min(sent.values())
+    print(f"\n{args.mode}: {len(latencies)}/{args.updates} updates answered, {len(latencies) / elapsed:.0f} updates/s, {fake.calls} Bot API calls")
+    print(f"latency ms: p50 {percentile(latencies, 0.5):.1f}  p95 {percentile(latencies, 0.95):.1f}  "
+          f"p99 {percentile(latencies, 0.99):.1f}  max {latencies[-1]:.1f}  mean {statistics.mean(latencies):.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("webhook", "polling"), default="webhook")
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--handler-delay", type=float, default=0.02, help="seconds each handler spends working")
+    parser.add_argument("--connections", type=int, default=40, help="concurrent webhook deliveries")
+    parser.add_argument("--api-port", type=int, default=8781)
+    parser.add_argument("--webhook-port", type=int, default=8782)
+    parser.add_argument("--timeout", type=float, default=120)
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
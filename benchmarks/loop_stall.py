@@ -0,0 +1,79 @@
+"""
+Event-loop stall benchmark: sync `database` calls vs the `async_db` layer.
+
+Simulates a message storm (many UserBot clients caching private messages at
+once) while a probe task measures how late the loop wakes it up. Every
+millisecond of lag is time during which no other update could be dispatched.
+
+    python benchmarks/loop_stall.py --clients 50 --messages 40
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import async_db
+
+PROBE_INTERVAL = 0.005
+
+async def probe(stop: asyncio.Event, lags: list):
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - t0 - PROBE_INTERVAL))
+
+async def client_storm(user_id: int, messages: int, use_async: bool):
+    for i in range(messages):
+        args = (i, 1000 + user_id, user_id, 1000 + user_id, f"message {i} " * 8, "Sender", None, None, "sender", "Личный чат")
+        if use_async:
+            await async_db.cache_message(*args)
+        else:
+            database.cache_message(*args)
+        await asyncio.sleep(0)  # yield like a real handler would between updates
+
+async def run_case(clients: int, messages: int, use_async: bool):
+    stop = asyncio.Event()
+    lags = []
+    probe_task = asyncio.create_task(probe(stop, lags))
+    t0 = time.perf_counter()
+    await asyncio.gather(*(client_storm(u, messages, use_async) for u in range(clients)))
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    await probe_task
+    lags.sort()
+    total = clients * messages
+    return {
+        "mode": "async_db" if use_async else "sync",
+        "messages": total,
+        "msg_per_s": total / elapsed if elapsed else 0,
+        "max_lag_ms": lags[-1] * 1000 if lags else 0,
+        "p99_lag_ms": lags[int(len(lags) * 0.99) - 1] * 1000 if lags else 0,
+        "stalled_ms": sum(lags) * 1000,
+    }
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=40)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "bench.db")
+        database.init_db()
+        results = []
+        for use_async in (False, True):
+            results.append(await run_case(args.clients, args.messages, use_async))
+        await async_db.shutdown()
+        database.close_connection()
+
+    print(f"{'mode':<10}{'messages':>10}{'msg/s':>10}{'max lag ms':>12}{'p99 lag ms':>12}{'stalled ms':>12}")
+    for r in results:
+        print(f"{r['mode']:<10}{r['messages']:>10}{r['msg_per_s']:>10.0f}{r['max_lag_ms']:>12.1f}{r['p99_lag_ms']:>12.1f}{r['stalled_ms']:>12.0f}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+"""
+Per-message CPU of secret-media detection in py_on_message, before and after.
+
+"legacy" is the detection and logging py_on_message used to do on every
+message: a deep attribute scan, `str(message)` lowercased for a keyword
+search, three INFO lines and a FULL MESSAGE DATA dump for every non-text
+message. "structured" is what it does now: `_secret_flags` on the parsed
+fields and one DEBUG line. Logging goes to os.devnull at INFO, as in
+production, so formatting and emitting are counted but nothing is printed.
+
+Also counts how many plain messages the keyword search flagged as secret
+(any text containing "view", "once", "ttl" or "expire").
+
+    python benchmarks/message_detect.py --messages 20000
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyrogram import enums
+from pyrogram import types as pt
+
+import config
+from services.userbot_manager import _secret_flags
+
+WORDS = ("привет", "ок", "как дела", "завтра", "созвон", "ссылка", "норм", "смотри", "preview", "ага", "потом", "да")
+
+def make_messages(n, seed):
+    rng = random.Random(seed)
+    messages = []
+    for i in range(n):
+        sender = pt.User(id=1000 + i % 50, first_name="Peer", username=f"peer{i % 50}")
+        chat = pt.Chat(id=sender.id, type=enums.ChatType.PRIVATE, first_name="Peer")
+        kind = rng.choices(("text", "photo", "voice", "ttl"), (0.75, 0.14, 0.09, 0.02))[0]
+        fields = dict(id=i + 1, from_user=sender, chat=chat, date=None)
+        if kind == "text":
+            fields["text"] = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        elif kind == "voice":
+            fields.update(media=enums.MessageMediaType.VOICE, voice=pt.Voice(file_id=f"V{i}", file_unique_id=f"U{i}", duration=4, file_size=9000))
+        else:
+            photo = pt.Photo(file_id=f"P{i}", file_unique_id=f"U{i}", width=1280, height=960, file_size=120_000, date=None)
+            if kind == "ttl":
+                photo.ttl_seconds = 10
+            fields.update(media=enums.MessageMediaType.PHOTO, photo=photo)
+        messages.append((kind, pt.Message(**fields)))
+    return messages
+
+def legacy(message):
+    """The pre-change detection and logging, verbatim in effect."""
+    is_protected = getattr(message, "has_protected_content", False)
+    has_ttl = False
+    if hasattr(message, "ttl_seconds") and message.ttl_seconds:
+        has_ttl = True
+    for attr in ["photo", "video", "voice", "video_note", "audio", "document"]:
+        obj = getattr(message, attr, None)
+        if obj:
+            if getattr(obj, "ttl_seconds", None):
+                has_ttl = True; break
+            if getattr(obj, "view_once", False):
+                has_ttl = True; break
+    s_id = message.from_user.id
+    media_type = message.media.value if message.media else None
+    logging.info(f"📩 Private Message from {s_id}: Type={media_type} Secret={has_ttl or is_protected}")
+    logging.info(f"📩 Private Message from {s_id}: Type={media_type}")
+    logging.info(f"🕵️ Detection Result: is_protected={is_protected}, has_ttl={has_ttl}")
+    if not message.text:
+        if getattr(message, "media", None):
+            logging.info(f"DEBUG: Media object: {message.media}")
+        logging.info(f"FULL MESSAGE DATA: {message}")
+    if not has_ttl:
+        dump = str(message).lower()
+        if any(k in dump for k in ["ttl", "view", "once", "expire"]):
+            has_ttl = True
+    return is_protected, has_ttl
+
+def structured(message):
+    """What py_on_message does now."""
+    is_protected, has_ttl = _secret_flags(message)
+    s_id = message.from_user.id
+    media_type = message.media.value if message.media else None
+    logging.debug(f"📩 Private Message from {s_id}: Type={media_type} protected={is_protected} ttl={has_ttl}")
+    if config.MESSAGE_DUMP_SAMPLE and not message.text and random.random() < config.MESSAGE_DUMP_SAMPLE:
+        logging.info(f"FULL MESSAGE DATA (sampled): {message}")
+    return is_protected, has_ttl
+
+def measure(fn, messages, rounds):
+    per_kind = {}
+    flagged = {}
+    for kind, message in messages:
+        flagged.setdefault(kind, 0)
+        if fn(message)[1]:
+            flagged[kind] += 1
+    for _ in range(rounds):
+        for kind, message in messages:
+            t0 = time.process_time()
+            fn(message)
+            spent = per_kind.setdefault(kind, [0.0, 0])
+            spent[0] += time.process_time() - t0
+            spent[1] += 1
+    started = time.process_time()
+    for _ in range(rounds):
+        for _, message in messages:
+            fn(message)
+    total = time.process_time() - started
+    return {
+        "us_per_message": total / (rounds * len(messages)) * 1e6,
+        "us_by_kind": {k: v[0] / v[1] * 1e6 for k, v in per_kind.items()},
+        "flagged": flagged,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.FileHandler(os.devnull))
+    root.setLevel(logging.INFO)
+
+    messages = make_messages(args.messages, args.seed)
+    kinds = {}
+    for kind, _ in messages:
+        kinds[kind] = kinds.get(kind, 0) + 1
+    results = {name: measure(fn, messages, args.rounds) for name, fn in (("legacy", legacy), ("structured", structured))}
+
+    print(f"{args.messages} messages {kinds}, {args.rounds} rounds, CPU time per message:\n")
+    print(f"{'kind':<8}{'legacy µs':>12}{'structured µs':>16}{'saved':>8}")
+    for kind in sorted(kinds):
+        old, new = results["legacy"]["us_by_kind"][kind], results["structured"]["us_by_kind"][kind]
+        print(f"{kind:<8}{old:>12.1f}{new:>16.1f}{(1 - new / old) * 100:>7.0f}%")
+    old, new = results["legacy"]["us_per_message"], results["structured"]["us_per_message"]
+    print(f"{'all':<8}{old:>12.1f}{new:>16.1f}{(1 - new / old) * 100:>7.0f}%")
+    print(f"\nflagged as secret: legacy {results['legacy']['flagged']}, structured {results['structured']['flagged']} (expected: ttl {kinds.get('ttl', 0)})")
+    print(f"one CPU core at the structured rate: {1e6 / new:,.0f} messages/s (legacy: {1e6 / old:,.0f})")
+
+if __name__ == "__main__":
+    main()
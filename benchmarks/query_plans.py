@@ -0,0 +1,195 @@
+"""
+Query-plan regression check for database.py.
+
+Seeds a throwaway database with production-like volumes, calls every public
+function in `database`, captures each SQL statement it runs and asks SQLite
+for its EXPLAIN QUERY PLAN. Any full-table SCAN or temp B-tree sort fails the
+run, so a new query without an index (or an index dropped by a migration)
+shows up before the tables grow large in production.
+
+    python benchmarks/query_plans.py --users 2000 --messages 200
+"""
+import argparse
+import inspect
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+UID = 7 # user whose data the per-user queries touch
+
+# One representative call per public function
+CALLS = {
+    "add_category": (UID, "food"),
+    "add_excluded_chat": (UID, 1007, "chat"),
+    "add_expense": (UID, 10.0, "food"),
+    "add_habit": (UID, "run", "08:00"),
+    "add_note": (UID, "note"),
+    "add_promo_code": ("PROMO-CHECK", 7),
+    "add_task": (UID, "task"),
+    "add_user": (UID,),
+    "cache_message": (999999, 1007, UID, 1007, "text", "Sender", None, "STORE:abc", "sender", "Личный чат", "uq"),
+    "cache_messages_bulk": ([(999998, 1007, UID, 1007, "text", "Sender", None, None, "sender", "Личный чат", None)],),
+    "claim_referral_reward": (UID,),
+    "cleanup_old_messages": (30,),
+    "clear_notes": (UID + 1,),
+    "complete_task": (1,),
+    "delete_bot_file_id": ("uq-1",),
+    "delete_cached_message": (999998, 1007),
+    "delete_cached_rows": ([1, 2, 3],),
+    "delete_expenses_by_category": (UID + 1, "food"),
+    "delete_note": (1,),
+    "delete_user_session": (UID + 2,),
+    "fsm_get": ("1:7:7:::default", 1.0),
+    "fsm_write_bulk": ([("1:7:7:::default", "Form:x")], [("1:8:8:::default", "{}")], 1.0, 2.0),
+    "get_bot_file_id": ("uq-2",),
+    "get_cache_usage": (UID,),
+    "get_cached_message": (1, 1007),
+    "get_cached_message_content": (5, 1007),
+    "get_cached_messages_by_ids": (UID, [5, 6, 7]),
+    "get_categories": (UID,),
+    "get_excluded_chats": (UID,),
+    "get_expenses": (UID,),
+    "get_expenses_stats": (UID,),
+    "get_habits": (UID,),
+    "get_habits_with_reminders": (),
+    "get_local_media_refs": (UID,),
+    "get_messages_for_check": (UID,),
+    "get_notes": (UID,),
+    "get_oldest_cached": (UID, 500, 30),
+    "get_referral_stats": (UID,),
+    "get_retention_policy": (UID,),
+    "get_tasks": (UID,),
+    "get_temp_email": (UID,),
+    "get_track_groups": (UID,),
+    "get_user_city": (UID,),
+    "get_user_city_2": (UID,),
+    "get_user_location": (UID,),
+    "get_user_session": (UID,),
+    "get_user_sub_info": (UID,),
+    "log_habit": (1, UID, "2024-01-01"),
+    "media_store_add": ("key-check", "/tmp/x", 10, "0" * 64, 1.0),
+    "media_store_delete": ("key-3",),
+    "media_store_get": ("key-4",),
+    "media_store_lru": (50, time.time() - 600),
+    "media_store_touch": ("key-5", 2.0),
+    "remove_excluded_chat": (UID, 1007),
+    "replace_file_ref": ("LOCAL:/nonexistent", "STORE:none"),
+    "save_bot_file_id": ("uq-check", "BOTFILE", "photo"),
+    "save_temp_email": (UID, "a@b.c"),
+    "save_user_session": (UID, "session"),
+    "set_referrer": (UID + 3, UID),
+    "set_retention_policy": (UID, 30, None, None),
+    "set_subscription": (UID, "2030-01-01 00:00:00", True),
+    "set_track_groups": (UID, False),
+    "update_user_city": (UID, "Moscow"),
+    "update_user_city_2": (UID, "Kazan"),
+    "update_user_location": (UID, 55.7, 37.6),
+    "use_promo_code": ("PROMO-1",),
+    # Second form of functions with an optional filter
+    "get_local_media_refs ": (),
+    "get_oldest_cached ": (UID, 500),
+}
+
+# Whole-table reads by design (startup, admin stats, periodic jobs)
+FULL_SCAN_OK = {
+    "get_all_users", "get_all_sessions", "get_all_sessions_with_expiry", "get_user_count",
+    "get_cached_user_ids", "media_store_all", "media_store_total",
+}
+
+# Not queries, or exercised by the setup itself
+SKIP = {"init_db", "close_connection", "get_schema_version"}
+
+def seed(conn, users, messages):
+    rnd = random.Random(1)
+    cur = conn.cursor()
+    cur.executemany("INSERT INTO users (user_id, referred_by, referral_reward_claimed) VALUES (?, ?, ?)",
+                    [(u, rnd.randrange(1, users) if u % 3 else None, u % 2) for u in range(1, users + 1)])
+    cur.executemany("INSERT INTO user_sessions (user_id, session_string) VALUES (?, ?)",
+                    [(u, "s" * 300) for u in range(1, users + 1, 4)])
+    cur.executemany(
+        "INSERT INTO cached_messages (message_id, chat_id, user_id, sender_id, content, timestamp, sender_name, media_type, file_id) VALUES (?, ?, ?, ?, ?, datetime('now', ?), ?, ?, ?)",
+        ((m, 1000 + u, u, 1000 + u, "message " * 10, f"-{m % 60} days", "Sender",
+          "photo" if m % 10 == 0 else None, (f"LOCAL:/tmp/{u}_{m}.jpg" if m % 20 == 0 else f"STORE:key-{m % 50}" if m % 10 == 0 else None))
+         for u in range(1, users + 1) for m in range(messages)))
+    cur.executemany("INSERT INTO expenses (user_id, amount, category, timestamp) VALUES (?, ?, ?, datetime('now', ?))",
+                    ((u, rnd.random() * 100, f"cat{i % 8}", f"-{i} hours") for u in range(1, users + 1) for i in range(20)))
+    cur.executemany("INSERT INTO notes (user_id, content) VALUES (?, ?)", ((u, "note") for u in range(1, users + 1) for _ in range(5)))
+    cur.executemany("INSERT INTO tasks (user_id, text, is_done) VALUES (?, ?, ?)", ((u, "task", i % 2) for u in range(1, users + 1) for i in range(5)))
+    cur.executemany("INSERT INTO habits (user_id, name, reminder_time) VALUES (?, ?, ?)",
+                    ((u, "habit", "09:00" if i == 0 and u % 10 == 0 else None) for u in range(1, users + 1) for i in range(3)))
+    cur.executemany("INSERT OR IGNORE INTO categories (user_id, name) VALUES (?, ?)", ((u, f"cat{i}") for u in range(1, users + 1) for i in range(8)))
+    cur.executemany("INSERT INTO excluded_chats (user_id, chat_id, title) VALUES (?, ?, ?)", ((u, 5000 + u, "x") for u in range(1, users + 1)))
+    cur.executemany("INSERT INTO media_store (key, path, size, sha256, refcount, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                    ((f"key-{i}", f"/tmp/key-{i}", 1000, "0" * 64, i % 3, float(i)) for i in range(users)))
+    cur.executemany("INSERT INTO message_cache (message_id, chat_id, user_id, text) VALUES (?, ?, ?, ?)",
+                    ((m, 1000 + u, u, "t") for u in range(1, users + 1, 10) for m in range(20)))
+    cur.executemany("INSERT INTO promo_codes (code, days) VALUES (?, ?)", ((f"PROMO-{i}", 7) for i in range(users)))
+    conn.commit()
+    cur.execute("ANALYZE")
+    conn.commit()
+
+def bad_steps(conn, sql):
+    """
+    Plan lines of a statement that scan a whole table or sort into a temp B-tree.
+    An index-ordered SCAN under a LIMIT stops early and is fine.
+    """
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+    limited = " LIMIT " in sql.upper()
+    return [row[3] for row in plan
+            if "TEMP B-TREE" in row[3] or (row[3].startswith("SCAN") and not (limited and " USING " in row[3]))]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=200, help="cached messages per user")
+    args = parser.parse_args()
+
+    public = {n for n, f in inspect.getmembers(database, inspect.isfunction) if f.__module__ == "database" and not n.startswith("_")}
+    unchecked = public - SKIP - FULL_SCAN_OK - {name.strip() for name in CALLS}
+    failures = [f"{name}: no entry in CALLS, add one" for name in sorted(unchecked)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "plans.db")
+        database.init_db()
+        conn = database._connect()
+        started = time.perf_counter()
+        seed(conn, args.users, args.messages)
+        print(f"Seeded {args.users} users x {args.messages} messages in {time.perf_counter() - started:.1f}s")
+
+        captured = []
+        conn.set_trace_callback(captured.append)
+        explain = sqlite3.connect(database.DB_PATH)
+        for name in sorted(CALLS) + sorted(FULL_SCAN_OK):
+            captured.clear()
+            call_args = CALLS.get(name, ())
+            started = time.perf_counter()
+            getattr(database, name.strip())(*call_args)
+            elapsed = (time.perf_counter() - started) * 1000
+            for sql in captured:
+                statement = sql.strip()
+                if statement.startswith("--") or statement.split()[0].upper() not in ("SELECT", "UPDATE", "DELETE", "INSERT"):
+                    continue # trigger bodies, BEGIN/COMMIT
+                bad = bad_steps(explain, statement)
+                if bad and name not in FULL_SCAN_OK:
+                    failures.append(f"{name.strip()}: {'; '.join(bad)}\n    {' '.join(statement.split())[:160]}")
+            print(f"  {name.strip():32} {elapsed:8.2f} ms")
+        conn.set_trace_callback(None)
+        explain.close()
+        database.close_connection()
+
+    if failures:
+        print(f"\n{len(failures)} query plan problem(s):")
+        for line in failures:
+            print(f"  ✗ {line}")
+        sys.exit(1)
+    print("\nAll queries use indexes.")
+
+if __name__ == "__main__":
+    main()
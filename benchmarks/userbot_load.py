@@ -0,0 +1,391 @@
+"""
+Synthetic load for UserBotManager: thousands of fake UserBot clients, no Telegram.
+
+Every simulated user gets a FakeClient (Pyrogram's handler decorators,
+get_messages, download_media, invoke) and the real handlers from
+UserBotManager.register_handlers. The driver feeds them generated Pyrogram
+Message objects (text, photo, voice, TTL photo, edits), deletes part of them
+on the fake "server", reports half of those through the deleted-messages
+handler and leaves the rest to check_deleted_messages. Bot API sends go to a
+FakeBot with a fixed latency.
+
+Reported: messages/s through the handlers, cached_messages rows/s, sweep
+time, alert latency, RSS and event-loop lag. Results are written as JSON
+(to the system temp dir unless --out is given); pass an earlier file with
+--compare to see the change.
+
+    python benchmarks/userbot_load.py --users 2000 --messages 50
+    python benchmarks/userbot_load.py --users 2000 --messages 50 --compare /tmp/userbot_load_<ts>.json
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import types
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from pyrogram import enums
+from pyrogram import types as pt
+
+import config
+import database
+import async_db
+from services import notifier as notifier_module
+from services.notifier import notifier
+from services.rate_limit import TokenBucket
+from services.message_buffer import message_buffer
+from services.hot_cache import hot_cache
+from services.alert_trace import alert_trace
+from services.userbot_manager import ub_manager
+
+PROBE_INTERVAL = 0.01
+FIRST_USER = 10_000_000
+# Key figures compared by --compare: (path in the results, True when higher is better)
+KEY_FIGURES = [
+    (("ingest", "msg_per_s"), True),
+    (("ingest", "db_rows_per_s"), True),
+    (("sweep", "seconds"), False),
+    (("alerts", "p95_s"), False),
+    (("loop_lag_ms", "p99"), False),
+    (("loop_lag_ms", "max"), False),
+    (("rss_mb", "peak"), False),
+]
+
+class FakeClient:
+    """The slice of pyrogram.Client that UserBotManager and its services touch."""
+
+    def __init__(self, user_id, api_latency):
+        self.me = pt.User(id=user_id, is_self=True, first_name="Owner")
+        self.is_connected = True
+        self.api_latency = api_latency
+        self.handlers = {}
+        self.history = {}    # (chat_id, message_id) -> Message still on the "server"
+        self.calls = 0
+
+    def _register(self, kind):
+        def decorator(fn):
+            self.handlers[kind] = fn
+            return fn
+        return decorator
+
+    def on_message(self, *args, **kwargs): return self._register("message")
+    def on_edited_message(self, *args, **kwargs): return self._register("edit")
+    def on_deleted_messages(self, *args, **kwargs): return self._register("deleted")
+
+    async def get_messages(self, chat_id, message_ids):
+        self.calls += 1
+        await asyncio.sleep(self.api_latency)
+        if not isinstance(message_ids, list):
+            return self.history.get((chat_id, message_ids)) or pt.Message(id=message_ids, empty=True)
+        return [self.history.get((chat_id, mid)) or pt.Message(id=mid, empty=True) for mid in message_ids]
+
+    async def download_media(self, message, in_memory=False, file_name=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.api_latency)
+        media = getattr(message, "photo", None) or getattr(message, "voice", None) or message
+        data = os.urandom(getattr(media, "file_size", None) or 4096)
+        if in_memory:
+            buf = io.BytesIO(data)
+            buf.name = "media.bin"
+            return buf
+        with open(file_name, "wb") as f:
+            f.write(data)
+        return file_name
+
+    async def invoke(self, query):
+        self.calls += 1
+        await asyncio.sleep(self.api_latency)
+        return types.SimpleNamespace(messages=[])
+
+    async def send_document(self, *args, **kwargs):
+        self.calls += 1
+
+    async def stop(self):
+        self.is_connected = False
+
+class FakeBot:
+    """Answers every bot.send_* the notifier makes after `latency` seconds."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._ids = itertools.count(1)
+
+    def __getattr__(self, method):
+        if not method.startswith("send_"):
+            raise AttributeError(method)
+        async def call(chat_id, *args, **kwargs):
+            self.calls += 1
+            await asyncio.sleep(self.latency)
+            n = next(self._ids)
+            media = types.SimpleNamespace(file_id=f"BOTFILE{n}")
+            kind = method[len("send_"):]
+            return types.SimpleNamespace(message_id=n, **({kind: [media] if kind == "photo" else media} if kind != "message" else {}))
+        return call
+
+class Generator:
+    """Pyrogram Message objects in the mix a real private inbox produces."""
+
+    def __init__(self, seed, photo, voice, ttl):
+        self.rng = random.Random(seed)
+        self.weights = {"photo": photo, "voice": voice, "ttl": ttl}
+        self.weights["text"] = max(0.0, 1 - photo - voice - ttl)
+        self.kinds = Counter()
+
+    def message(self, user_id, peer, message_id, kind=None):
+        kind = kind or self.rng.choices(list(self.weights), list(self.weights.values()))[0]
+        self.kinds[kind] += 1
+        sender = pt.User(id=peer, first_name=f"Peer{peer % 1000}", username=f"peer{peer}")
+        chat = pt.Chat(id=peer, type=enums.ChatType.PRIVATE, first_name=sender.first_name)
+        fields = dict(id=message_id, from_user=sender, chat=chat, date=None)
+        unique = f"U{user_id}_{peer}_{message_id}"
+        if kind == "text":
+            fields["text"] = " ".join(self.rng.choice(("привет", "как дела", "ок", "завтра", "созвон", "ссылка")) for _ in range(self.rng.randint(1, 20)))
+        elif kind == "voice":
+            fields.update(media=enums.MessageMediaType.VOICE, voice=pt.Voice(file_id=f"V{unique}", file_unique_id=unique, duration=3, file_size=8192))
+        else:
+            photo = pt.Photo(file_id=f"P{unique}", file_unique_id=unique, width=800, height=600, file_size=64 * 1024, date=None)
+            if kind == "ttl":
+                photo.ttl_seconds = 10
+            fields.update(media=enums.MessageMediaType.PHOTO, photo=photo, caption="фото" if self.rng.random() < 0.3 else None)
+        return pt.Message(**fields)
+
+    def edit(self, original):
+        return pt.Message(id=original.id, from_user=original.from_user, chat=original.chat, date=None,
+                          text=(original.text or "") + " (исправлено)")
+
+class LoopProbe:
+    """Measures how late the loop wakes a sleeping task; every ms is ms nobody else was served."""
+
+    def __init__(self):
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(PROBE_INTERVAL)
+            self.lags.append(max(0.0, time.perf_counter() - t0 - PROBE_INTERVAL))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def summary(self, since=0):
+        lags = sorted(self.lags[since:])
+        if not lags:
+            return {"p50": 0, "p99": 0, "max": 0, "stalled": 0}
+        pick = lambda q: lags[min(len(lags) - 1, int(q * len(lags)))] * 1000
+        return {"p50": round(pick(0.5), 2), "p99": round(pick(0.99), 2), "max": round(lags[-1] * 1000, 2), "stalled": round(sum(lags) * 1000)}
+
+def rss_mb():
+    """Current RSS from /proc where available, else the peak."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+async def drain_background():
+    while True:
+        tasks = [t for running in ub_manager.bg_tasks.values() for t in running if not t.done()]
+        if not tasks:
+            return
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def run(args):
+    rng = random.Random(args.seed)
+    gen = Generator(args.seed, args.photo, args.voice, args.ttl)
+    probe = LoopProbe()
+    results = {"params": vars(args).copy(), "rss_mb": {"start": round(rss_mb(), 1)}}
+
+    bot = FakeBot(args.bot_latency)
+    notifier_module.bot = bot
+    notifier.global_bucket = TokenBucket(args.bot_rate, args.bot_rate)
+
+    # --- Clients ---
+    clients = {}
+    for n in range(args.users):
+        user_id = FIRST_USER + n
+        client = FakeClient(user_id, args.api_latency)
+        ub_manager.register_handlers(client, user_id)
+        ub_manager.clients[user_id] = client
+        clients[user_id] = client
+    results["rss_mb"]["clients"] = round(rss_mb(), 1)
+    probe.start()
+
+    # --- Ingest: every user receives its messages (and some edits) concurrently ---
+    sent = {}  # user_id -> [(chat_id, message_id)]
+    async def inbox(user_id, client):
+        peers = [FIRST_USER * 10 + user_id * args.peers + p for p in range(args.peers)]
+        mine = sent[user_id] = []
+        for message_id in range(1, args.messages + 1):
+            msg = gen.message(user_id, rng.choice(peers), message_id)
+            client.history[(msg.chat.id, msg.id)] = msg
+            await client.handlers["message"](client, msg)
+            mine.append((msg.chat.id, msg.id))
+            if msg.text and rng.random() < args.edits:
+                edited = gen.edit(msg)
+                client.history[(msg.chat.id, msg.id)] = edited
+                await client.handlers["edit"](client, edited)
+                gen.kinds["edit"] += 1
+
+    lag_mark = len(probe.lags)
+    started = time.perf_counter()
+    await asyncio.gather(*(inbox(uid, c) for uid, c in clients.items()))
+    handled = time.perf_counter() - started
+    await message_buffer.flush()
+    flushed = time.perf_counter() - started
+    rows = (await async_db.run(lambda: database._connect().execute("SELECT COUNT(*) FROM cached_messages").fetchone()))[0]
+    total = args.users * args.messages
+    results["ingest"] = {
+        "messages": total, "kinds": dict(gen.kinds), "seconds": round(flushed, 3),
+        "msg_per_s": round(total / handled), "db_rows": rows, "db_rows_per_s": round(rows / flushed),
+        "loop_lag_ms": probe.summary(lag_mark),
+    }
+    results["rss_mb"]["ingested"] = round(rss_mb(), 1)
+
+    # --- Deletions: half arrive as updates, the rest only the sweep can find ---
+    newest = min(args.messages, 100)
+    deleted_update, deleted_sweep = 0, 0
+    lag_mark = len(probe.lags)
+    started = time.perf_counter()
+    for user_id, client in clients.items():
+        for chat_id, message_id in rng.sample(sent[user_id][-newest:], int(newest * args.delete)):
+            gone = client.history.pop((chat_id, message_id))
+            if rng.random() < 0.5:
+                deleted_update += 1
+                await client.handlers["deleted"](client, [pt.Message(id=gone.id, empty=True)])
+            else:
+                deleted_sweep += 1
+    await drain_background() # alerts (and restores) for the update path, so the sweep only finds its own share
+    update_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await ub_manager.check_deleted_messages()
+    sweep_seconds = time.perf_counter() - started
+    results["sweep"] = {
+        "seconds": round(sweep_seconds, 3), "deleted_via_updates": deleted_update, "deleted_for_sweep": deleted_sweep,
+        "found_by_sweep": ub_manager.sweep_stats["last_run"]["deleted"] if ub_manager.sweep_stats["last_run"] else 0,
+        "update_handling_seconds": round(update_seconds, 3), "loop_lag_ms": probe.summary(lag_mark),
+        "get_messages_calls": sum(c.calls for c in clients.values()),
+    }
+
+    # --- Deliveries ---
+    await drain_background()
+    await notifier.close(timeout=args.drain_timeout)
+    overall = alert_trace.percentiles().get("all")
+    results["alerts"] = {
+        "delivered": overall[0] if overall else 0, "bot_calls": bot.calls, "breaches": alert_trace.breaches,
+        **({"p50_s": round(overall[1], 3), "p95_s": round(overall[2], 3), "p99_s": round(overall[3], 3)} if overall else {}),
+    }
+    lookups = hot_cache.hits + hot_cache.misses
+    results["hot_cache_hit_ratio"] = round(hot_cache.hits / lookups, 3) if lookups else None
+
+    await probe.stop()
+    results["loop_lag_ms"] = probe.summary()
+    results["rss_mb"].update(end=round(rss_mb(), 1), peak=round(peak_rss_mb(), 1))
+    for user_id in list(clients):
+        await ub_manager.stop_client(user_id)
+    await message_buffer.close()
+    await async_db.shutdown()
+    return results
+
+def compare(current, previous):
+    print(f"\n{'vs ' + previous['_file']:<40}{'before':>12}{'after':>12}{'change':>10}")
+    for path, higher_is_better in KEY_FIGURES:
+        before, after = previous, current
+        for part in path:
+            before = (before or {}).get(part)
+            after = (after or {}).get(part)
+        if before is None or after is None:
+            continue
+        change = (after - before) / before * 100 if before else 0
+        better = change >= 0 if higher_is_better else change <= 0
+        print(f"{'.'.join(path):<40}{before:>12}{after:>12}{change:>+9.1f}% {'✓' if better or abs(change) < 2 else '✗'}")
+
+def report(r):
+    ingest, sweep, alerts = r["ingest"], r["sweep"], r["alerts"]
+    print(f"users {r['params']['users']}, messages {ingest['messages']} {ingest['kinds']}")
+    print(f"ingest: {ingest['msg_per_s']} msg/s through handlers, {ingest['db_rows']} rows at {ingest['db_rows_per_s']} rows/s, "
+          f"loop lag p99 {ingest['loop_lag_ms']['p99']}ms max {ingest['loop_lag_ms']['max']}ms")
+    print(f"sweep: {sweep['seconds']}s, found {sweep['found_by_sweep']}/{sweep['deleted_for_sweep']} "
+          f"(+{sweep['deleted_via_updates']} via updates), loop lag p99 {sweep['loop_lag_ms']['p99']}ms")
+    if alerts.get("p50_s") is not None:
+        print(f"alerts: {alerts['delivered']} delivered, deleted -> notified p50 {alerts['p50_s']}s p95 {alerts['p95_s']}s p99 {alerts['p99_s']}s")
+    print(f"hot cache hit ratio {r['hot_cache_hit_ratio']}, RSS {r['rss_mb']}, loop lag overall {r['loop_lag_ms']}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=50, help="messages per user")
+    parser.add_argument("--peers", type=int, default=5, help="private chats per user")
+    parser.add_argument("--photo", type=float, default=0.15)
+    parser.add_argument("--voice", type=float, default=0.08)
+    parser.add_argument("--ttl", type=float, default=0.02, help="share of self-destructing photos")
+    parser.add_argument("--edits", type=float, default=0.05, help="share of text messages edited afterwards")
+    parser.add_argument("--delete", type=float, default=0.1, help="share of each user's newest messages deleted")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="fake Telegram (MTProto) round trip, seconds")
+    parser.add_argument("--bot-latency", type=float, default=0.03, help="fake Bot API round trip, seconds")
+    parser.add_argument("--bot-rate", type=float, default=1000, help="global Bot API sends/s (production: NOTIFY_GLOBAL_RATE)")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-file", default=os.devnull, help="handler logging still runs, but goes here")
+    parser.add_argument("--out", help="results JSON (default: <temp dir>/userbot_load_<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.FileHandler(args.log_file))
+    root.setLevel(logging.INFO)
+
+    out = os.path.abspath(args.out or os.path.join(tempfile.gettempdir(), f"userbot_load_{time.strftime('%Y%m%d_%H%M%S')}.json"))
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        previous["_file"] = os.path.basename(args.compare)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp) # media_store/ and downloads/ are relative to the working directory
+        database.DB_PATH = os.path.join(tmp, "bench.db")
+        database.init_db()
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            database.close_connection()
+            os.chdir(cwd)
+
+    results["python"] = sys.version.split()[0]
+    results["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    report(results)
+    if previous:
+        compare(results, previous)
+    print(f"\nSaved {out}")
+
+if __name__ == "__main__":
+    main()
@@ -24,3 +24,102 @@ API_ID = os.getenv("API_ID")
 API_HASH = os.getenv("API_HASH")
 PAYMENT_TOKEN = os.getenv("PAYMENT_TOKEN")
 WEBAPP_URL = "https://4riz7.github.io/4riz-github.io/index.html?v=2.0"
+
+# Webhook mode: set WEBHOOK_URL (public https base) to receive updates over HTTP instead of long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") # random per start when unset
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Alternative Bot API server (local telegram-bot-api, or benchmarks/fake_telegram.py)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE")
+
+# Prometheus-format metrics endpoint (local only; 0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Deletion-alert tracing: finished traces kept, receipts remembered, share of traces logged, SLO for "deleted -> notified"
+ALERT_TRACE_RING = int(os.getenv("ALERT_TRACE_RING", "5000"))
+ALERT_TRACE_OPEN = int(os.getenv("ALERT_TRACE_OPEN", "20000"))
+ALERT_TRACE_LOG_SAMPLE = float(os.getenv("ALERT_TRACE_LOG_SAMPLE", "0.01"))
+ALERT_SLO_SECONDS = float(os.getenv("ALERT_SLO_SECONDS", "10"))
+
+# Event-loop watchdog: stalls longer than this are attributed to a call site (0 disables); summary log interval
+LOOP_WATCHDOG_MS = int(os.getenv("LOOP_WATCHDOG_MS", "100"))
+LOOP_WATCHDOG_SUMMARY_SECONDS = int(os.getenv("LOOP_WATCHDOG_SUMMARY_SECONDS", "300"))
+
+# Share of non-text private messages whose full Pyrogram object is logged (debugging only, 0 = off)
+MESSAGE_DUMP_SAMPLE = float(os.getenv("MESSAGE_DUMP_SAMPLE", "0"))
+
+# FSM state (logins in progress, dialogs) lives in SQLite; entries expire after this long without a write
+FSM_TTL_SECONDS = int(os.getenv("FSM_TTL_SECONDS", str(24 * 3600)))
+FSM_FLUSH_MS = int(os.getenv("FSM_FLUSH_MS", "50"))
+
+# Write-behind cache for cached_messages (flush every N rows or M milliseconds)
+CACHE_FLUSH_ROWS = int(os.getenv("CACHE_FLUSH_ROWS", "200"))
+CACHE_FLUSH_MS = int(os.getenv("CACHE_FLUSH_MS", "250"))
+# Newest cached messages kept in RAM per user (should stay >= the 100 rows a sweep checks)
+HOT_CACHE_PER_USER = int(os.getenv("HOT_CACHE_PER_USER", "200"))
+
+# Retention defaults for cached_messages (per-user overrides live in retention_policies)
+RETENTION_MAX_AGE_DAYS = int(os.getenv("RETENTION_MAX_AGE_DAYS", "30"))
+RETENTION_MAX_ROWS = int(os.getenv("RETENTION_MAX_ROWS", "5000"))
+RETENTION_MAX_BYTES = int(os.getenv("RETENTION_MAX_BYTES", str(50 * 1024 * 1024)))
+RETENTION_INTERVAL_HOURS = int(os.getenv("RETENTION_INTERVAL_HOURS", "1"))
+
+# Deletions arrive via Telegram updates; polling is only a low-frequency reconciliation
+DELETION_RECONCILE_SECONDS = int(os.getenv("DELETION_RECONCILE_SECONDS", "600"))
+
+# Reconciliation sweep limits
+SWEEP_CONCURRENCY = int(os.getenv("SWEEP_CONCURRENCY", "20"))         # get_messages calls in flight, all clients
+SWEEP_PER_CLIENT = int(os.getenv("SWEEP_PER_CLIENT", "2"))            # ... per client
+SWEEP_DEADLINE_SECONDS = int(os.getenv("SWEEP_DEADLINE_SECONDS", "120"))
+
+# Startup: how many saved UserBot sessions connect at once, and random delay before each
+BOOT_PARALLELISM = int(os.getenv("BOOT_PARALLELISM", "10"))
+BOOT_JITTER_SECONDS = float(os.getenv("BOOT_JITTER_SECONDS", "2"))
+
+# Multi-process mode: number of UserBot worker processes (0 or 1 = all clients in the bot process)
+USERBOT_SHARDS = int(os.getenv("USERBOT_SHARDS", "0"))
+
+# Telegram API pacing per UserBot client: (calls per second, burst)
+RATE_HISTORY_PER_SEC = float(os.getenv("RATE_HISTORY_PER_SEC", "3"))
+RATE_HISTORY_BURST = float(os.getenv("RATE_HISTORY_BURST", "5"))
+RATE_RAW_PER_SEC = float(os.getenv("RATE_RAW_PER_SEC", "2"))
+RATE_RAW_BURST = float(os.getenv("RATE_RAW_BURST", "3"))
+RATE_DOWNLOAD_PER_SEC = float(os.getenv("RATE_DOWNLOAD_PER_SEC", "1"))
+RATE_DOWNLOAD_BURST = float(os.getenv("RATE_DOWNLOAD_BURST", "3"))
+
+# Outbound Bot API pacing (Telegram allows ~30 msg/s overall, ~1 msg/s per chat)
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", "25"))
+NOTIFY_CHAT_INTERVAL = float(os.getenv("NOTIFY_CHAT_INTERVAL", "1.0"))
+NOTIFY_DIGEST_WINDOW = float(os.getenv("NOTIFY_DIGEST_WINDOW", "2.0")) # seconds to collect deletions into one digest
+
+# Secret media up to this size is relayed from RAM; bigger files are downloaded to disk
+SECRET_MEDIA_RAM_LIMIT = int(os.getenv("SECRET_MEDIA_RAM_LIMIT", str(20 * 1024 * 1024)))
+
+# Media download pool
+DOWNLOAD_GLOBAL_LIMIT = int(os.getenv("DOWNLOAD_GLOBAL_LIMIT", "8"))
+DOWNLOAD_PER_USER_LIMIT = int(os.getenv("DOWNLOAD_PER_USER_LIMIT", "2"))
+DOWNLOAD_QUOTA_BYTES = int(os.getenv("DOWNLOAD_QUOTA_BYTES", str(2 * 1024 * 1024 * 1024))) # downloads/ total
+DOWNLOAD_SIZE_LIMITS = {
+    "photo": 10 * 1024 * 1024,
+    "voice": 20 * 1024 * 1024,
+    "video_note": 50 * 1024 * 1024,
+    "video": 200 * 1024 * 1024,
+    "document": 100 * 1024 * 1024,
+    "default": 50 * 1024 * 1024,
+}
+
+# Backups are gzip-compressed and sent in parts below Telegram's 50 MB document limit
+BACKUP_PART_BYTES = int(os.getenv("BACKUP_PART_BYTES", str(45 * 1024 * 1024)))
+# "incremental" ships only changed rows between full snapshots; "full" ships the whole DB every time
+BACKUP_MODE = os.getenv("BACKUP_MODE", "incremental")
+BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_FULL_INTERVAL_HOURS = int(os.getenv("BACKUP_FULL_INTERVAL_HOURS", str(24 * 7)))
+
+# Deduplicating media store under downloads/store (LRU eviction above this size)
+MEDIA_STORE_MAX_BYTES = int(os.getenv("MEDIA_STORE_MAX_BYTES", str(1024 * 1024 * 1024)))
+# New entries are not evicted as unreferenced for this long (their cached_messages row may still be in the write buffer)
+MEDIA_STORE_GRACE_SECONDS = int(os.getenv("MEDIA_STORE_GRACE_SECONDS", "600"))
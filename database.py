@@ -1,15 +1,45 @@
 import sqlite3
+import logging
+import threading
 
 DB_PATH = "bot_database.db"
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # PERFORMANCE: Enable Write-Ahead Logging (WAL) for better concurrency
-    cursor.execute("PRAGMA journal_mode=WAL;")
-    cursor.execute("PRAGMA synchronous=NORMAL;")
-    
+# PERFORMANCE: One long-lived connection per thread instead of connect/close per call.
+# The async layer (async_db) funnels everything through a single DB thread, so in
+# practice there is one hot connection for the whole bot.
+_local = threading.local()
+
+def _connect():
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        # INSERT OR REPLACE must fire delete triggers (media_store refcounts)
+        conn.execute("PRAGMA recursive_triggers=ON;")
+        _local.conn = conn
+        _local.path = DB_PATH
+    return conn
+
+def close_connection():
+    """Close the calling thread's connection (used on shutdown)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+# --- Schema migrations ---
+# Each step runs exactly once, inside one transaction, and bumps PRAGMA user_version.
+# A warm restart therefore costs a single pragma read. Never edit a released step;
+# append a new one instead.
+
+def _add_column(cursor, table, column, decl):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _migration_1_baseline(cursor):
+    # Databases created before versioning sit at user_version 0 with any subset of
+    # these tables/columns, so everything here must be idempotent.
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -18,29 +48,15 @@ def init_db():
             trial_used BOOLEAN DEFAULT 0
         )
     """)
-    # Migration for existing table
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN city TEXT DEFAULT 'Moscow'")
-        conn.commit()
-    except sqlite3.OperationalError:
-        # Column already exists
-        pass
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN sub_expiry TIMESTAMP")
-    except sqlite3.OperationalError:
-        pass
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN trial_used BOOLEAN DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
-    except sqlite3.OperationalError:
-        pass
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN referral_reward_claimed BOOLEAN DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass
+    _add_column(cursor, "users", "city", "TEXT DEFAULT 'Moscow'")
+    _add_column(cursor, "users", "sub_expiry", "TIMESTAMP")
+    _add_column(cursor, "users", "trial_used", "BOOLEAN DEFAULT 0")
+    _add_column(cursor, "users", "referred_by", "INTEGER")
+    _add_column(cursor, "users", "referral_reward_claimed", "BOOLEAN DEFAULT 0")
+    _add_column(cursor, "users", "latitude", "REAL")
+    _add_column(cursor, "users", "longitude", "REAL")
+    _add_column(cursor, "users", "city_2", "TEXT")
+    _add_column(cursor, "users", "track_groups", "BOOLEAN DEFAULT 1")
 
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS promo_codes (
@@ -85,12 +101,8 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
-    try:
-        cursor.execute("ALTER TABLE habits ADD COLUMN reminder_time TEXT")
-        conn.commit()
-    except sqlite3.OperationalError:
-        pass
-        
+    _add_column(cursor, "habits", "reminder_time", "TEXT")
+
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS cached_messages (
             message_id INTEGER,
@@ -106,24 +118,11 @@ def init_db():
             PRIMARY KEY (message_id, chat_id)
         )
     """)
-    
-    # Migration for new columns
-    try:
-        cursor.execute("ALTER TABLE cached_messages ADD COLUMN media_type TEXT")
-        cursor.execute("ALTER TABLE cached_messages ADD COLUMN file_id TEXT")
-    except sqlite3.OperationalError:
-        pass # Columns already exist
-
-    try:
-        cursor.execute("ALTER TABLE cached_messages ADD COLUMN sender_username TEXT")
-    except sqlite3.OperationalError:
-        pass
-
-    try:
-        cursor.execute("ALTER TABLE cached_messages ADD COLUMN chat_title TEXT")
-    except sqlite3.OperationalError:
-        pass
-    
+    _add_column(cursor, "cached_messages", "media_type", "TEXT")
+    _add_column(cursor, "cached_messages", "file_id", "TEXT")
+    _add_column(cursor, "cached_messages", "sender_username", "TEXT")
+    _add_column(cursor, "cached_messages", "chat_title", "TEXT")
+
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS user_sessions (
             user_id INTEGER PRIMARY KEY,
@@ -156,23 +155,6 @@ def init_db():
             PRIMARY KEY (message_id, chat_id)
         )
     """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            user_id INTEGER PRIMARY KEY,
-            session_string TEXT
-        )
-    """)
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN latitude REAL")
-        cursor.execute("ALTER TABLE users ADD COLUMN longitude REAL")
-    except sqlite3.OperationalError:
-        pass
-        
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN city_2 TEXT")
-    except sqlite3.OperationalError:
-        pass
-
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS categories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -181,408 +163,675 @@ def init_db():
             UNIQUE(user_id, name)
         )
     """)
-    
-    # Auto-fill categories from existing expenses
+    # One-time backfill: add_expense keeps categories in sync from now on
     cursor.execute("""
         INSERT OR IGNORE INTO categories (user_id, name)
         SELECT DISTINCT user_id, category FROM expenses
     """)
-    init_settings(conn)
-    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS excluded_chats (
+            user_id INTEGER,
+            chat_id INTEGER,
+            title TEXT,
+            PRIMARY KEY (user_id, chat_id)
+        )
+    """)
+
     # PERFORMANCE: Create Indices for faster lookups
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_user ON cached_messages(user_id);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_chat_msg ON cached_messages(chat_id, message_id);")
     cursor.execute("CREATE INDEX IF NOT EXISTS idx_excluded_user ON excluded_chats(user_id);")
 
-    conn.commit()
-    conn.close()
+def _migration_2_retention(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS retention_policies (
+            user_id INTEGER PRIMARY KEY,
+            max_age_days INTEGER,
+            max_rows INTEGER,
+            max_bytes INTEGER
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_user_ts ON cached_messages(user_id, timestamp);")
+
+def _migration_3_deletion_index(cursor):
+    # Delete updates for private chats carry only message ids
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_user_msg ON cached_messages(user_id, message_id);")
+
+def _migration_4_media_store(cursor):
+    # Content-addressed media files (services/media_store.py). cached_messages rows
+    # reference them as file_id = 'STORE:<key>'; refcount is kept by triggers.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS media_store (
+            key TEXT PRIMARY KEY,
+            path TEXT,
+            size INTEGER,
+            sha256 TEXT,
+            refcount INTEGER DEFAULT 0,
+            last_access REAL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_media_store_lru ON media_store(refcount > 0, last_access);")
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_media_ref_insert AFTER INSERT ON cached_messages
+        WHEN NEW.file_id LIKE 'STORE:%'
+        BEGIN
+            UPDATE media_store SET refcount = refcount + 1 WHERE key = substr(NEW.file_id, 7);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_media_ref_delete AFTER DELETE ON cached_messages
+        WHEN OLD.file_id LIKE 'STORE:%'
+        BEGIN
+            UPDATE media_store SET refcount = refcount - 1 WHERE key = substr(OLD.file_id, 7);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_media_ref_update AFTER UPDATE OF file_id ON cached_messages
+        WHEN OLD.file_id IS NOT NEW.file_id
+        BEGIN
+            UPDATE media_store SET refcount = refcount - 1 WHERE OLD.file_id LIKE 'STORE:%' AND key = substr(OLD.file_id, 7);
+            UPDATE media_store SET refcount = refcount + 1 WHERE NEW.file_id LIKE 'STORE:%' AND key = substr(NEW.file_id, 7);
+        END
+    """)
+
+def _migration_5_bot_file_cache(cursor):
+    # Telegram file_unique_id -> file_id of the bot's own upload, for resending without re-upload
+    _add_column(cursor, "cached_messages", "file_unique_id", "TEXT")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bot_file_cache (
+            file_unique_id TEXT PRIMARY KEY,
+            bot_file_id TEXT,
+            media_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+def _migration_6_query_indexes(cursor):
+    # Every per-user query should be an index SEARCH without a temp sort;
+    # benchmarks/query_plans.py checks this against a seeded database.
+    cursor.execute("DROP INDEX IF EXISTS idx_cache_user;")    # prefix of idx_cache_user_ts
+    cursor.execute("DROP INDEX IF EXISTS idx_excluded_user;") # prefix of the primary key
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_file ON cached_messages(file_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_referrer ON users(referred_by, referral_reward_claimed);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_ts ON expenses(user_id, timestamp);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_expenses_user_cat ON expenses(user_id, category, amount);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_tasks_user ON tasks(user_id, is_done);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_habits_user ON habits(user_id);")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_habits_reminder ON habits(reminder_time) WHERE reminder_time IS NOT NULL;")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_cache_ts ON message_cache(timestamp);")
+
+def _migration_7_fsm_storage(cursor):
+    # aiogram FSM state/data (services/fsm_storage.py); key is the serialized StorageKey
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT DEFAULT '{}',
+            expires_at REAL
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_expires ON fsm_storage(expires_at);")
+
+MIGRATIONS = [
+    _migration_1_baseline,
+    _migration_2_retention,
+    _migration_3_deletion_index,
+    _migration_4_media_store,
+    _migration_5_bot_file_cache,
+    _migration_6_query_indexes,
+    _migration_7_fsm_storage,
+]
+
+def get_schema_version(conn=None):
+    conn = conn or _connect()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def init_db():
+    conn = _connect()
+    
+    # PERFORMANCE: Enable Write-Ahead Logging (WAL) for better concurrency
+    # (persistent in the file; must run outside a transaction)
+    conn.execute("PRAGMA journal_mode=WAL;")
+
+    version = get_schema_version(conn)
+    if version >= len(MIGRATIONS):
+        return
+
+    cursor = conn.cursor()
+    for target, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            step(cursor)
+            cursor.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logging.info(f"🗄 DB schema migrated to version {target} ({step.__name__})")
 
 def add_user(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
     conn.commit()
-    conn.close()
 
 def get_all_users():
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id FROM users")
     users = [row[0] for row in cursor.fetchall()]
-    conn.close()
     return users
 
 def update_user_city(user_id: int, city: str):
     # Deprecated but kept for compatibility or fallback
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
     cursor.execute("UPDATE users SET city = ? WHERE user_id = ?", (city, user_id))
     conn.commit()
-    conn.close()
 
 def update_user_location(user_id: int, lat: float, lon: float):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
     cursor.execute("UPDATE users SET latitude = ?, longitude = ? WHERE user_id = ?", (lat, lon, user_id))
     conn.commit()
-    conn.close()
 
 def get_user_city(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT city FROM users WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     return row[0] if row else "Moscow"
 
 def update_user_city_2(user_id: int, city: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
     cursor.execute("UPDATE users SET city_2 = ? WHERE user_id = ?", (city, user_id))
     conn.commit()
-    conn.close()
 
 def get_user_city_2(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT city_2 FROM users WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     return row[0] if row else None
 
 def get_user_location(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT latitude, longitude FROM users WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     if row and row[0] is not None:
         return row[0], row[1]
     return None
 
 def get_user_count():
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM users")
     count = cursor.fetchone()[0]
-    conn.close()
     return count
 
 def add_expense(user_id: int, amount: float, category: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT INTO expenses (user_id, amount, category) VALUES (?, ?, ?)", 
                    (user_id, amount, category))
     # Also ensure category exists
     cursor.execute("INSERT OR IGNORE INTO categories (user_id, name) VALUES (?, ?)", (user_id, category))
     conn.commit()
-    conn.close()
 
 def add_category(user_id: int, category: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR IGNORE INTO categories (user_id, name) VALUES (?, ?)", (user_id, category))
     conn.commit()
-    conn.close()
 
 def get_categories(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT name FROM categories WHERE user_id = ? ORDER BY name", (user_id,))
     cats = [row[0] for row in cursor.fetchall()]
-    conn.close()
     return cats
 
 def delete_expenses_by_category(user_id: int, category: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM expenses WHERE user_id = ? AND category = ?", (user_id, category))
     cursor.execute("DELETE FROM categories WHERE user_id = ? AND name = ?", (user_id, category))
     conn.commit()
-    conn.close()
 
 def get_expenses(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT amount, category, timestamp FROM expenses WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
 def get_expenses_stats(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT category, SUM(amount) FROM expenses WHERE user_id = ? GROUP BY category", (user_id,))
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
 
 def add_note(user_id: int, content: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT INTO notes (user_id, content) VALUES (?, ?)", (user_id, content))
     conn.commit()
-    conn.close()
 
 def get_notes(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT id, content FROM notes WHERE user_id = ?", (user_id,))
     notes = cursor.fetchall()
-    conn.close()
     return notes
 
 def delete_note(note_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
     conn.commit()
-    conn.close()
 
 def clear_notes(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM notes WHERE user_id = ?", (user_id,))
     conn.commit()
-    conn.close()
 # To-Do List Functions
 def add_task(user_id: int, text: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT INTO tasks (user_id, text) VALUES (?, ?)", (user_id, text))
     conn.commit()
-    conn.close()
 
 def get_tasks(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT id, text, is_done FROM tasks WHERE user_id = ? AND is_done = 0", (user_id,))
     tasks = cursor.fetchall()
-    conn.close()
     return tasks
 
 def complete_task(task_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("UPDATE tasks SET is_done = 1 WHERE id = ?", (task_id,))
     conn.commit()
-    conn.close()
 
 # Habit Tracker Functions
 def add_habit(user_id: int, name: str, reminder_time: str = None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT INTO habits (user_id, name, reminder_time) VALUES (?, ?, ?)", (user_id, name, reminder_time))
     conn.commit()
-    conn.close()
 
 def get_habits(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT id, name, reminder_time FROM habits WHERE user_id = ?", (user_id,))
     habits = cursor.fetchall()
-    conn.close()
     return habits
 
 def get_habits_with_reminders():
     """Get all habits that have a reminder set"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT id, user_id, name, reminder_time FROM habits WHERE reminder_time IS NOT NULL")
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
 def log_habit(habit_id: int, user_id: int, date_str: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR IGNORE INTO habit_logs (habit_id, user_id, done_date) VALUES (?, ?, ?)", 
                    (habit_id, user_id, date_str))
     conn.commit()
-    conn.close()
 
 # Temp Mail Functions
 def save_temp_email(user_id: int, email: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR REPLACE INTO temp_emails (user_id, email) VALUES (?, ?)", (user_id, email))
     conn.commit()
-    conn.close()
 
 def get_temp_email(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT email FROM temp_emails WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     return row[0] if row else None
 
 # Message Cache Functions (for UserBot)
 def cache_message(message_id: int, chat_id: int, user_id: int, text: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR REPLACE INTO message_cache (message_id, chat_id, user_id, text) VALUES (?, ?, ?, ?)", 
                    (message_id, chat_id, user_id, text))
     conn.commit()
-    conn.close()
 
 def get_cached_message(message_id: int, chat_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, text FROM message_cache WHERE message_id = ? AND chat_id = ?", (message_id, chat_id))
     row = cursor.fetchone()
-    conn.close()
     return row
 
 def cleanup_old_messages(days: int = 1):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM message_cache WHERE timestamp < datetime('now', '-' || ? || ' days')", (days,))
     conn.commit()
-    conn.close()
 
 # User Session Functions
 def save_user_session(user_id: int, session_string: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR REPLACE INTO user_sessions (user_id, session_string) VALUES (?, ?)", (user_id, session_string))
     conn.commit()
-    conn.close()
 
 def get_user_session(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT session_string FROM user_sessions WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     return row[0] if row else None
 
 def get_all_sessions():
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, session_string FROM user_sessions")
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
+def get_all_sessions_with_expiry():
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT s.user_id, s.session_string, u.sub_expiry
+        FROM user_sessions s LEFT JOIN users u ON u.user_id = s.user_id
+    """)
+    return cursor.fetchall()
+
 def delete_user_session(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
     conn.commit()
-    conn.close()
 
-def cache_message(message_id, chat_id, user_id, sender_id, content, sender_name, media_type=None, file_id=None, sender_username=None, chat_title=None):
-    conn = sqlite3.connect(DB_PATH)
+def cache_message(message_id, chat_id, user_id, sender_id, content, sender_name, media_type=None, file_id=None, sender_username=None, chat_title=None, file_unique_id=None):
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("""
         INSERT OR REPLACE INTO cached_messages 
-        (message_id, chat_id, user_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title) 
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (message_id, chat_id, user_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title))
+        (message_id, chat_id, user_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title, file_unique_id) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (message_id, chat_id, user_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title, file_unique_id))
     conn.commit()
-    conn.close()
 
-def get_messages_for_check(user_id):
-    conn = sqlite3.connect(DB_PATH)
+def cache_messages_bulk(rows):
+    """Write many cached_messages rows in one transaction (rows match cache_message args)."""
+    conn = _connect()
+    with conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO cached_messages 
+            (message_id, chat_id, user_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title, file_unique_id) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+def get_messages_for_check(user_id, limit: int = 100):
+    conn = _connect()
     cursor = conn.cursor()
     # Fetch media info as well
-    cursor.execute("SELECT message_id, chat_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title FROM cached_messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT 100", (user_id,))
+    cursor.execute("SELECT message_id, chat_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title, file_unique_id FROM cached_messages WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?", (user_id, limit))
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
+def get_cached_messages_by_ids(user_id, message_ids):
+    """Resolve ids from a delete update (same row layout as get_messages_for_check)."""
+    if not message_ids:
+        return []
+    conn = _connect()
+    cursor = conn.cursor()
+    marks = ",".join("?" * len(message_ids))
+    cursor.execute(f"SELECT message_id, chat_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title, file_unique_id FROM cached_messages WHERE user_id = ? AND message_id IN ({marks})",
+                   (user_id, *message_ids))
+    return cursor.fetchall()
+
 def delete_cached_message(message_id, chat_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM cached_messages WHERE message_id = ? AND chat_id = ?", (message_id, chat_id))
     conn.commit()
-    conn.close()
 
 def get_cached_message_content(message_id, chat_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT content, media_type, sender_name, sender_username, chat_title FROM cached_messages WHERE message_id = ? AND chat_id = ?", (message_id, chat_id))
     row = cursor.fetchone()
-    conn.close()
     return row # (content, media_type, name, username, title)
 
-# Settings & Exclusions
-def init_settings(conn):
-    cursor = conn.cursor()
-    # Add track_groups to users if not exists
-    try:
-        cursor.execute("ALTER TABLE users ADD COLUMN track_groups BOOLEAN DEFAULT 1")
-    except sqlite3.OperationalError:
-        pass
-        
+# Retention (see services/retention.py)
+def get_retention_policy(user_id: int):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT max_age_days, max_rows, max_bytes FROM retention_policies WHERE user_id = ?", (user_id,))
+    return cursor.fetchone() # None -> use defaults from config
+
+def set_retention_policy(user_id: int, max_age_days=None, max_rows=None, max_bytes=None):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO retention_policies (user_id, max_age_days, max_rows, max_bytes) VALUES (?, ?, ?, ?)",
+                   (user_id, max_age_days, max_rows, max_bytes))
+    conn.commit()
+
+def get_cached_user_ids():
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT user_id FROM cached_messages")
+    return [row[0] for row in cursor.fetchall()]
+
+def get_cache_usage(user_id: int):
+    """Returns (row_count, content_bytes) of a user's cached messages."""
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(content AS BLOB))), 0) FROM cached_messages WHERE user_id = ?", (user_id,))
+    return cursor.fetchone()
+
+def get_oldest_cached(user_id: int, limit: int, older_than_days: int = None):
+    """Oldest cached rows of a user as (rowid, content_bytes, file_id, message_id, chat_id), optionally only those past an age."""
+    conn = _connect()
+    cursor = conn.cursor()
+    if older_than_days is not None:
+        cursor.execute("""
+            SELECT rowid, LENGTH(CAST(content AS BLOB)), file_id, message_id, chat_id FROM cached_messages
+            WHERE user_id = ? AND timestamp < datetime('now', '-' || ? || ' days')
+            ORDER BY timestamp LIMIT ?
+        """, (user_id, older_than_days, limit))
+    else:
+        cursor.execute("SELECT rowid, LENGTH(CAST(content AS BLOB)), file_id, message_id, chat_id FROM cached_messages WHERE user_id = ? ORDER BY timestamp LIMIT ?",
+                       (user_id, limit))
+    return cursor.fetchall()
+
+def delete_cached_rows(rowids):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.executemany("DELETE FROM cached_messages WHERE rowid = ?", [(r,) for r in rowids])
+    conn.commit()
+    return len(rowids)
+
+def get_local_media_refs(user_id: int = None):
+    """file_id values that point at files on our disk (LOCAL:<path>), for one user or everyone."""
+    conn = _connect()
+    cursor = conn.cursor()
+    if user_id is not None:
+        cursor.execute("SELECT file_id FROM cached_messages WHERE user_id = ? AND file_id LIKE 'LOCAL:%'", (user_id,))
+    else:
+        # Range instead of LIKE so idx_cache_file can be used (LIKE is case-insensitive)
+        cursor.execute("SELECT file_id FROM cached_messages WHERE file_id >= 'LOCAL:' AND file_id < 'LOCAL;'")
+    return [row[0] for row in cursor.fetchall()]
+
+def replace_file_ref(old_ref: str, new_ref: str):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE cached_messages SET file_id = ? WHERE file_id = ?", (new_ref, old_ref))
+    conn.commit()
+    return cursor.rowcount
+
+# Bot file_id cache
+def get_bot_file_id(file_unique_id: str):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT bot_file_id FROM bot_file_cache WHERE file_unique_id = ?", (file_unique_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def save_bot_file_id(file_unique_id: str, bot_file_id: str, media_type: str):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO bot_file_cache (file_unique_id, bot_file_id, media_type) VALUES (?, ?, ?)",
+                   (file_unique_id, bot_file_id, media_type))
+    conn.commit()
+
+def delete_bot_file_id(file_unique_id: str):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM bot_file_cache WHERE file_unique_id = ?", (file_unique_id,))
+    conn.commit()
+
+# Media Store (see services/media_store.py)
+def media_store_get(key: str):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT path, size, sha256, refcount FROM media_store WHERE key = ?", (key,))
+    return cursor.fetchone()
+
+def media_store_add(key: str, path: str, size: int, sha256: str, now: float):
+    conn = _connect()
+    cursor = conn.cursor()
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS excluded_chats (
-            user_id INTEGER,
-            chat_id INTEGER,
-            title TEXT,
-            PRIMARY KEY (user_id, chat_id)
-        )
-    """)
+        INSERT INTO media_store (key, path, size, sha256, refcount, last_access) VALUES (?, ?, ?, ?, 0, ?)
+        ON CONFLICT(key) DO UPDATE SET path = excluded.path, size = excluded.size, sha256 = excluded.sha256, last_access = excluded.last_access
+    """, (key, path, size, sha256, now))
+    conn.commit()
+
+def media_store_touch(key: str, now: float):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE media_store SET last_access = ? WHERE key = ?", (now, key))
+    conn.commit()
+
+def media_store_delete(key: str):
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM media_store WHERE key = ?", (key,))
     conn.commit()
 
+def media_store_total():
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM media_store")
+    return cursor.fetchone()
+
+def media_store_lru(limit: int, settled_before: float):
+    """
+    Eviction candidates: unreferenced entries first, then least recently used.
+    Unreferenced entries touched after `settled_before` are skipped: their
+    reference may not have been flushed yet.
+    """
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT key, path, size FROM media_store WHERE refcount > 0 OR last_access < ?
+        ORDER BY refcount > 0, last_access LIMIT ?
+    """, (settled_before, limit))
+    return cursor.fetchall()
+
+def media_store_all():
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT key, path, size, sha256 FROM media_store")
+    return cursor.fetchall()
+
+# FSM storage (see services/fsm_storage.py)
+def fsm_get(key: str, now: float):
+    """(state, data_json) of a live entry, or None."""
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT state, data FROM fsm_storage WHERE key = ? AND expires_at > ?", (key, now))
+    return cursor.fetchone()
+
+def fsm_write_bulk(states, datas, now: float, expires_at: float):
+    """
+    One transaction for a batch of FSM writes: states/datas are [(key, value)].
+    Expired entries are dropped first so a partial write never revives stale fields.
+    """
+    conn = _connect()
+    with conn:
+        conn.execute("DELETE FROM fsm_storage WHERE expires_at <= ?", (now,))
+        conn.executemany("""
+            INSERT INTO fsm_storage (key, state, data, expires_at) VALUES (?, ?, '{}', ?)
+            ON CONFLICT(key) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+        """, [(k, v, expires_at) for k, v in states])
+        conn.executemany("""
+            INSERT INTO fsm_storage (key, state, data, expires_at) VALUES (?, NULL, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at
+        """, [(k, v, expires_at) for k, v in datas])
+        conn.executemany("DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data = '{}'",
+                         [(k,) for k in {k for k, _ in states} | {k for k, _ in datas}])
+
+# Settings & Exclusions
 def set_track_groups(user_id: int, enabled: bool):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("UPDATE users SET track_groups = ? WHERE user_id = ?", (1 if enabled else 0, user_id))
     # Ensure user exists if update failed (though they should)
     if cursor.rowcount == 0:
         cursor.execute("INSERT INTO users (user_id, track_groups) VALUES (?, ?)", (user_id, 1 if enabled else 0))
     conn.commit()
-    conn.close()
 
 def get_track_groups(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT track_groups FROM users WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     return bool(row[0]) if row and row[0] is not None else True
 
 def add_excluded_chat(user_id: int, chat_id: int, title: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR REPLACE INTO excluded_chats (user_id, chat_id, title) VALUES (?, ?, ?)", (user_id, chat_id, title))
     conn.commit()
-    conn.close()
 
 def remove_excluded_chat(user_id: int, chat_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM excluded_chats WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
     conn.commit()
-    conn.close()
 
 def get_excluded_chats(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT chat_id, title FROM excluded_chats WHERE user_id = ?", (user_id,))
     rows = cursor.fetchall()
-    conn.close()
     return rows
 
 # Subscription Functions
 def get_user_sub_info(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT sub_expiry, trial_used FROM users WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
-    conn.close()
     if row:
         return row[0], bool(row[1])
     return None, False
 
 def set_subscription(user_id: int, expiry_timestamp, trial_used: bool = None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     # Ensure user exists
     cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
@@ -594,40 +843,35 @@ def set_subscription(user_id: int, expiry_timestamp, trial_used: bool = None):
         cursor.execute("UPDATE users SET sub_expiry = ? WHERE user_id = ?", 
                        (expiry_timestamp, user_id))
     conn.commit()
-    conn.close()
 
 def add_promo_code(code: str, days: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT INTO promo_codes (code, days) VALUES (?, ?)", (code, days))
     conn.commit()
-    conn.close()
 
 def use_promo_code(code: str):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT days, is_used FROM promo_codes WHERE code = ?", (code,))
     row = cursor.fetchone()
     if row and not row[1]:
         cursor.execute("UPDATE promo_codes SET is_used = 1 WHERE code = ?", (code,))
         conn.commit()
-        conn.close()
         return row[0]
-    conn.close()
     return None
 
 def set_referrer(user_id: int, referrer_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
     # Only set if not already set
     cursor.execute("UPDATE users SET referred_by = ? WHERE user_id = ? AND referred_by IS NULL", (referrer_id, user_id))
     conn.commit()
-    conn.close()
 
 def claim_referral_reward(user_id: int):
     """Checks if a user has a referrer and claims reward for them. Returns referrer_id if successful."""
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT referred_by, referral_reward_claimed FROM users WHERE user_id = ?", (user_id,))
     row = cursor.fetchone()
@@ -636,17 +880,14 @@ def claim_referral_reward(user_id: int):
         # Mark as claimed
         cursor.execute("UPDATE users SET referral_reward_claimed = 1 WHERE user_id = ?", (user_id,))
         conn.commit()
-        conn.close()
         return referrer_id
-    conn.close()
     return None
 
 def get_referral_stats(user_id: int):
-    conn = sqlite3.connect(DB_PATH)
+    conn = _connect()
     cursor = conn.cursor()
     cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,))
     total = cursor.fetchone()[0]
     cursor.execute("SELECT COUNT(*) FROM users WHERE referred_by = ? AND referral_reward_claimed = 1", (user_id,))
     active = cursor.fetchone()[0]
-    conn.close()
     return total, active
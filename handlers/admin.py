@@ -1,12 +1,16 @@
 import asyncio
 import logging
 from aiogram import Router, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 import config
-import database
+import async_db
 from loader import bot
+from services.userbot_manager import ub_manager
+from services.alert_trace import alert_trace
+from services.loop_watchdog import loop_watchdog
+from services import backup, metrics, retention
 from states import Form
 
 router = Router()
@@ -20,6 +24,8 @@ async def cmd_admin(message: types.Message):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📢 Рассылка всем", callback_data="broadcast")],
         [InlineKeyboardButton(text="📊 Статистика", callback_data="stats")],
+        [InlineKeyboardButton(text="⏱ Скорость уведомлений", callback_data="alert_latency")],
+        [InlineKeyboardButton(text="🧹 Очистка кэша", callback_data="retention")],
         [InlineKeyboardButton(text="🎟 Сгенерировать промо (7д)", callback_data="gen_promo_7")],
         [InlineKeyboardButton(text="🎟 Сгенерировать промо (30д)", callback_data="gen_promo_30")]
     ])
@@ -34,7 +40,7 @@ async def generate_promo(callback: types.CallbackQuery):
     days = int(callback.data.split("_")[2])
     import secrets
     code = f"RZ-{secrets.token_hex(4).upper()}"
-    database.add_promo_code(code, days)
+    await async_db.add_promo_code(code, days)
     
     await callback.message.answer(f"✅ **Промокод на {days} дней создан:**\n\n`{code}`", parse_mode="Markdown")
     await callback.answer()
@@ -64,26 +70,140 @@ async def show_stats(callback: types.CallbackQuery):
         await callback.answer("У вас нет прав.")
         return
     
-    total_users = database.get_user_count()
-    active_sessions = len(database.get_all_sessions())
+    total_users = await async_db.get_user_count()
+    active_sessions = len(await async_db.get_all_sessions())
+    
+    sweep = ub_manager.sweep_stats
     
     msg = (
         "📊 **Статистика Бота**\n\n"
         f"👤 Всего пользователей в БД: **{total_users}**\n"
-        f"🔌 Подключено UserBot сессий: **{active_sessions}**"
+        f"🔌 Подключено UserBot сессий: **{active_sessions}**\n"
+        f"🔎 Проверка удалений: **{sweep['last_duration']}с** (макс. {sweep['max_duration']}с, таймаутов: {sweep['timeouts']})"
     )
+    boot = ub_manager.boot_progress
+    if boot["total"]:
+        msg += f"\n🚀 Запуск клиентов: **{boot['started'] + boot['failed']}/{boot['total']}** (ошибок: {boot['failed']})"
+    # Clients, limiter and hot cache live in the shard workers when sharding is on
+    processes = sorted(ub_manager.shards.stats.items()) if ub_manager.shards else [(None, ub_manager.stats())]
+    backoffs = {key: left for _, st in processes for key, left in st.get("backoffs", {}).items()}
+    msg += (f"\n⏳ FloodWait: **{sum(st.get('flood_waits', 0) for _, st in processes)}**, "
+            f"клиентов в паузе: **{len({uid for uid, _ in backoffs})}**")
+    paused = sorted(((left, uid, kind) for (uid, kind), left in backoffs.items()), reverse=True)[:5]
+    if paused:
+        msg += " (" + ", ".join(f"`{uid}` {kind} {left:.0f}с" for left, uid, kind in paused) + ")"
+    cached = [st["hot_cache"] for _, st in processes if "hot_cache" in st]
+    hits, lookups = sum(c["hits"] for c in cached), sum(c["hits"] + c["misses"] for c in cached)
+    if lookups:
+        msg += f"\n🔥 Кэш в памяти: **{sum(c['entries'] for c in cached)}** сообщ., попаданий **{hits * 100 // lookups}%**"
+    msg += (f"\n📈 Сообщений: **{metrics.total(metrics.messages_ingested)}**, "
+            f"удалений: **{metrics.total(metrics.deletions_found)}** "
+            f"(обновления {metrics.total(metrics.deletions_found, source='update')} / проверка {metrics.total(metrics.deletions_found, source='sweep')})")
+    p95 = [(name, metrics.quantile(h, 0.95)) for name, h in (("обработчик", metrics.handler_seconds), ("БД", metrics.db_seconds), ("отправка", metrics.send_seconds))]
+    p95 = ", ".join(f"{name} {q * 1000:.0f}мс" for name, q in p95 if q is not None)
+    if p95:
+        msg += f"\n⏱ p95: {p95}"
+    if loop_watchdog.stalls:
+        site, (count, total, worst, _, _) = loop_watchdog.ranked()[0]
+        msg += f"\n🐢 Блокировки цикла: **{loop_watchdog.stalls}**, больше всего: `{site}` ({count}x, {total:.1f}с)"
+    last = backup.last_backup
+    if last:
+        if last["ok"]:
+            msg += f"\n💾 Бэкап {last['timestamp']}: **{last['gz_bytes'] / 1024 / 1024:.1f} MB** ({last['parts']} ч.), {last['total_s']}с"
+        else:
+            msg += f"\n💾 Бэкап {last['timestamp']}: ❌ ошибка"
+    if ub_manager.shards:
+        shards = ub_manager.shards
+        worst = max((st["sweep"]["last_duration"] for st in shards.stats.values()), default=0)
+        msg += (f"\n🧩 Шарды: **{shards.shards - len(shards.disabled)}/{shards.shards}**, "
+                f"клиентов: **{shards.client_count()}**, проверка: **{worst}с**")
+        for sid, st in processes:
+            cache = st.get("hot_cache", {})
+            lookups = cache.get("hits", 0) + cache.get("misses", 0)
+            msg += (f"\n  #{sid}: клиентов {st.get('clients', 0)}, проверка {st['sweep']['last_duration']}с, "
+                    f"FloodWait {st.get('flood_waits', 0)} (в паузе {len({uid for uid, _ in st.get('backoffs', {})})}), "
+                    f"кэш {cache.get('hits', 0) * 100 // lookups if lookups else 0}%")
     
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]])
     await callback.message.edit_text(msg, parse_mode="Markdown", reply_markup=kb)
     await callback.answer()
 
+@router.callback_query(F.data == "alert_latency")
+async def show_alert_latency(callback: types.CallbackQuery):
+    if callback.from_user.id != config.ADMIN_ID:
+        await callback.answer("У вас нет прав.")
+        return
+
+    fmt = lambda p: f"p50 **{p[1]:.1f}с**, p95 **{p[2]:.1f}с**, p99 **{p[3]:.1f}с** ({p[0]})"
+    overall = alert_trace.percentiles().get("all")
+    if not overall:
+        msg = "⏱ Уведомлений об удалении пока не было."
+    else:
+        msg = (f"⏱ **Удалено → уведомлено** (последние {len(alert_trace.ring)})\n\n"
+               f"Все: {fmt(overall)}\nДольше {alert_trace.slo_seconds:g}с: **{alert_trace.breaches}**")
+        by_shard = alert_trace.percentiles("shard")
+        if len(by_shard) > 1 or None not in by_shard:
+            msg += "\n\n🧩 По шардам:\n" + "\n".join(f"#{sid}: {fmt(p)}" for sid, p in sorted(by_shard.items(), key=lambda i: str(i[0])))
+        slowest = sorted(alert_trace.percentiles("user").items(), key=lambda i: i[1][2], reverse=True)[:10]
+        msg += "\n\n🐢 Медленнее всего (p95):\n" + "\n".join(f"`{uid}`: {fmt(p)}" for uid, p in slowest)
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]])
+    await callback.message.edit_text(msg, parse_mode="Markdown", reply_markup=kb)
+    await callback.answer()
+
+@router.callback_query(F.data == "retention")
+async def show_retention(callback: types.CallbackQuery):
+    if callback.from_user.id != config.ADMIN_ID:
+        await callback.answer("У вас нет прав.")
+        return
+
+    msg = (f"🧹 **Очистка кэша** (каждые {config.RETENTION_INTERVAL_HOURS}ч)\n\n"
+           f"По умолчанию: {_format_policy((config.RETENTION_MAX_AGE_DAYS, config.RETENTION_MAX_ROWS, config.RETENTION_MAX_BYTES))}\n")
+    report = retention.last_report
+    if report:
+        msg += (f"\nПоследний запуск: **{report['rows']}** сообщ., **{report['files'] + report['orphans']}** файлов "
+                f"({report['orphans']} без ссылок), **{report['bytes'] / 1024 / 1024:.1f} MB** "
+                f"у {report['users']} польз. за {report['seconds']}с")
+    else:
+        msg += "\nОчистка ещё не запускалась."
+    msg += "\n\nЛимиты пользователя: `/retention <user_id> [дни] [сообщений] [MB]` (`-` = по умолчанию)"
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]])
+    await callback.message.edit_text(msg, parse_mode="Markdown", reply_markup=kb)
+    await callback.answer()
+
+def _format_policy(policy):
+    max_age, max_rows, max_bytes = policy
+    return (f"{f'{max_age} дн.' if max_age else 'без срока'}, "
+            f"{f'{max_rows} сообщ.' if max_rows else 'без лимита сообщ.'}, "
+            f"{f'{max_bytes / 1024 / 1024:.0f} MB' if max_bytes else 'без лимита MB'}")
+
+@router.message(Command("retention"))
+async def cmd_retention(message: types.Message, command: CommandObject):
+    """/retention <user_id> shows a user's cache limits; /retention <user_id> <days> <rows> <MB> overrides them."""
+    if message.from_user.id != config.ADMIN_ID:
+        return
+
+    args = (command.args or "").split()
+    try:
+        user_id = int(args[0])
+        limits = [None if a == "-" else int(a) for a in args[1:4]]
+    except (IndexError, ValueError):
+        await message.answer("Использование: `/retention <user_id> [дни] [сообщений] [MB]`, `-` = по умолчанию", parse_mode="Markdown")
+        return
+
+    if limits:
+        max_age, max_rows, max_mb = limits + [None] * (3 - len(limits))
+        await async_db.set_retention_policy(user_id, max_age, max_rows, max_mb * 1024 * 1024 if max_mb is not None else None)
+    await message.answer(f"🧹 Лимиты `{user_id}`: {_format_policy(await retention.get_policy(user_id))}", parse_mode="Markdown")
+
 @router.callback_query(F.data == "admin_back")
 async def back_to_admin(callback: types.CallbackQuery):
     await cmd_admin(callback.message)
 
 @router.message(Form.waiting_for_broadcast)
 async def process_broadcast(message: types.Message, state: FSMContext):
-    users = database.get_all_users()
+    users = await async_db.get_all_users()
     count = 0
     blocked = 0
     
@@ -5,7 +5,7 @@ from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, PreCheckoutQuery
 from aiogram.fsm.context import FSMContext
 import config
-import database
+import async_db
 from loader import bot
 from states import PromoStates
 
@@ -22,7 +22,7 @@ PRICE_30_DAYS_RUB = 180
 async def cmd_profile(message: types.Message, user_id: int = None):
     if not user_id:
         user_id = message.from_user.id
-    expiry_str, trial_used = database.get_user_sub_info(user_id)
+    expiry_str, trial_used = await async_db.get_user_sub_info(user_id)
     
     is_active = False
     expiry_date = None
@@ -48,7 +48,7 @@ async def cmd_profile(message: types.Message, user_id: int = None):
     status_text = "✅ Активна" if is_active else "❌ Не активна"
     expiry_text = expiry_date.strftime("%d.%m.%Y %H:%M") if is_active else "—"
     
-    total_refs, active_refs = database.get_referral_stats(user_id)
+    total_refs, active_refs = await async_db.get_referral_stats(user_id)
     
     msg = (
         f"👤 **Профиль пользователя**\n\n"
@@ -81,7 +81,7 @@ async def cmd_profile(message: types.Message, user_id: int = None):
 @router.callback_query(F.data == "activate_trial")
 async def process_activate_trial(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    expiry_str, trial_used = database.get_user_sub_info(user_id)
+    expiry_str, trial_used = await async_db.get_user_sub_info(user_id)
     
     if trial_used:
         await callback.answer("❌ Вы уже использовали пробный период!", show_alert=True)
@@ -90,7 +90,7 @@ async def process_activate_trial(callback: types.CallbackQuery):
     # Add 3 days
     import time
     new_expiry_ts = time.time() + (3 * 24 * 3600)
-    database.set_subscription(user_id, new_expiry_ts, trial_used=True)
+    await async_db.set_subscription(user_id, new_expiry_ts, trial_used=True)
     
     from datetime import datetime
     expiry_date = datetime.fromtimestamp(new_expiry_ts)
@@ -224,7 +224,7 @@ async def process_successful_payment(message: types.Message):
     from datetime import datetime
     
     # Calculate new expiry
-    current_expiry_str, _ = database.get_user_sub_info(user_id)
+    current_expiry_str, _ = await async_db.get_user_sub_info(user_id)
     base_time = time.time()
     
     if current_expiry_str:
@@ -236,7 +236,7 @@ async def process_successful_payment(message: types.Message):
             pass
             
     new_expiry_ts = base_time + (days * 24 * 3600)
-    database.set_subscription(user_id, new_expiry_ts)
+    await async_db.set_subscription(user_id, new_expiry_ts)
     
     expiry_date = datetime.fromtimestamp(new_expiry_ts)
     await message.answer(
@@ -255,13 +255,13 @@ async def process_enter_promo(callback: types.CallbackQuery, state: FSMContext):
 @router.message(PromoStates.waiting_for_promo)
 async def handle_promo_input(message: types.Message, state: FSMContext):
     promo_code = message.text.strip()
-    days = database.use_promo_code(promo_code)
+    days = await async_db.use_promo_code(promo_code)
     
     if days:
         import time
         from datetime import datetime
         user_id = message.from_user.id
-        current_expiry_str, _ = database.get_user_sub_info(user_id)
+        current_expiry_str, _ = await async_db.get_user_sub_info(user_id)
         base_time = time.time()
         
         if current_expiry_str:
@@ -272,7 +272,7 @@ async def handle_promo_input(message: types.Message, state: FSMContext):
             except: pass
             
         new_expiry_ts = base_time + (days * 24 * 3600)
-        database.set_subscription(user_id, new_expiry_ts)
+        await async_db.set_subscription(user_id, new_expiry_ts)
         
         expiry_date = datetime.fromtimestamp(new_expiry_ts)
         await message.answer(f"✅ **Промокод активирован!**\n\nВы получили {days} дней подписки.\n📅 Истекает: `{expiry_date.strftime('%d.%m.%Y %H:%M')}`", parse_mode="Markdown")
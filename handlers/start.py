@@ -2,7 +2,7 @@ from aiogram import Router, types
 from aiogram.filters import Command, CommandObject
 from aiogram.types import ChatMemberUpdated
 from aiogram.fsm.context import FSMContext
-import database
+import async_db
 import logging
 from loader import bot
 from keyboards.reply import get_main_menu
@@ -18,7 +18,7 @@ async def leave_groups(event: ChatMemberUpdated):
 @router.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext, command: CommandObject = None):
     user_id = message.from_user.id
-    database.add_user(user_id)
+    await async_db.add_user(user_id)
     
     # Check referral
     if command and command.args:
@@ -27,7 +27,7 @@ async def cmd_start(message: types.Message, state: FSMContext, command: CommandO
             try:
                 referrer_id = int(args.replace("ref_", ""))
                 if referrer_id != user_id: # Cannot refer yourself
-                    database.set_referrer(user_id, referrer_id)
+                    await async_db.set_referrer(user_id, referrer_id)
                     logging.info(f"User {user_id} referred by {referrer_id}")
             except:
                 pass
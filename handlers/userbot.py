@@ -1,11 +1,14 @@
+import base64
+import struct
 import logging
 from aiogram import Router, types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
 from pyrogram import Client, errors
+from pyrogram.storage import Storage
 import config
-import database
+import async_db
 from loader import bot
 from services.userbot_manager import ub_manager
 from states import UserBotStates
@@ -20,7 +23,7 @@ router = Router()
 async def cmd_userbot(message: types.Message, state: FSMContext):
     # Check Subscription
     import datetime
-    expiry_str, _ = database.get_user_sub_info(message.from_user.id)
+    expiry_str, _ = await async_db.get_user_sub_info(message.from_user.id)
     is_active = False
     
     if expiry_str:
@@ -38,7 +41,7 @@ async def cmd_userbot(message: types.Message, state: FSMContext):
         await message.answer("🔒 **Доступ закрыт**\n\nУ вас нет активной подписки или пробного периода.\nПожалуйста, активируйте их в профиле.", reply_markup=kb)
         return
 
-    session = database.get_user_session(message.from_user.id)
+    session = await async_db.get_user_session(message.from_user.id)
     if session:
         kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔴 Отключить", callback_data="ub_stop")]])
         await message.answer("✅ У вас уже подключен UserBot для отслеживания удаленных сообщений.", reply_markup=kb)
@@ -57,7 +60,7 @@ async def cmd_userbot(message: types.Message, state: FSMContext):
 @router.callback_query(F.data == "ub_stop")
 async def process_ub_stop(callback: types.CallbackQuery):
     await ub_manager.stop_client(callback.from_user.id)
-    database.delete_user_session(callback.from_user.id)
+    await async_db.delete_user_session(callback.from_user.id)
     await callback.message.edit_text("🔴 UserBot отключен. Данные сессии удалены.")
     await callback.answer()
 
@@ -96,15 +99,60 @@ async def process_ub_phone_login(callback: types.CallbackQuery, state: FSMContex
 
 
 
-# Temp storage for users currently logging in: {user_id: Client}
+# Live temp clients of logins in progress on this process: {user_id: Client}.
+# Only a connection cache: what a login needs lives in FSM data (see _auth_meta),
+# so another worker or a restarted bot can rebuild the client and continue.
 auth_clients = {}
 
+# Official Android app credentials used for the login step
+AUTH_CLIENT_ARGS = dict(
+    api_id=6,
+    api_hash="eb06d4ab3521ad1297404c23ad8d8e05",
+    in_memory=True,
+    device_model="Android",
+    system_version="Android 11",
+    app_version="8.4.1",
+    lang_code="ru",
+)
+
 # List of backup proxies (Public MTProto/Socks4/5) - strictly for auth step
 PROXY_LIST = [
     {"scheme": "socks5", "hostname": "192.252.208.70", "port": 13915}, # Example public proxy
     {"scheme": "socks5", "hostname": "68.188.156.97", "port": 4145},
 ]
 
+async def _auth_meta(client: Client, phone: str, phone_code_hash: str, proxy):
+    """Everything needed to resume a login elsewhere: the code hash is bound to this auth key."""
+    return {
+        "phone": phone,
+        "hash": phone_code_hash,
+        "dc_id": await client.storage.dc_id(),
+        "test_mode": await client.storage.test_mode(),
+        "auth_key": base64.b64encode(await client.storage.auth_key()).decode(),
+        "proxy": proxy,
+    }
+
+async def _auth_client(user_id: int, auth: dict):
+    """This process's live temp client, or one rebuilt from the stored auth key."""
+    client = auth_clients.get(user_id)
+    if client:
+        return client
+    packed = struct.pack(
+        Storage.SESSION_STRING_FORMAT,
+        auth["dc_id"], AUTH_CLIENT_ARGS["api_id"], auth["test_mode"], base64.b64decode(auth["auth_key"]), 0, False,
+    )
+    session_string = base64.urlsafe_b64encode(packed).decode().rstrip("=")
+    client = Client(name=f"official_auth_{user_id}", session_string=session_string, proxy=auth.get("proxy"), **AUTH_CLIENT_ARGS)
+    await client.connect()
+    auth_clients[user_id] = client
+    return client
+
+async def _drop_auth_client(user_id: int):
+    client = auth_clients.pop(user_id, None)
+    if client:
+        try: await client.disconnect()
+        except: pass
+
 @router.message(UserBotStates.waiting_for_phone)
 async def process_phone(message: types.Message, state: FSMContext):
     if message.text and message.text.lower() == "отмена":
@@ -122,20 +170,12 @@ async def process_phone(message: types.Message, state: FSMContext):
     
     client = None
     connected = False
+    proxy = None
     
     # 1. Try Direct IPv4
     try:
         await status_msg.edit_text("⏳ Попытка 1: Прямое подключение...")
-        client = Client(
-            name=f"official_auth_{message.from_user.id}", 
-            api_id=6, 
-            api_hash="eb06d4ab3521ad1297404c23ad8d8e05", 
-            in_memory=True,
-            device_model="Android",
-            system_version="Android 11",
-            app_version="8.4.1",
-            lang_code="ru"
-        )
+        client = Client(name=f"official_auth_{message.from_user.id}", **AUTH_CLIENT_ARGS)
         await client.connect()
         connected = True
     except Exception as e:
@@ -144,20 +184,11 @@ async def process_phone(message: types.Message, state: FSMContext):
     # 2. Try IPv6 (if IPv4 failed or we want to try generic)
     # 3. Try Proxies
     if not connected:
-        for i, proxy in enumerate(PROXY_LIST):
+        for i, candidate in enumerate(PROXY_LIST):
+            proxy = candidate
             try:
                 await status_msg.edit_text(f"⏳ Попытка {i+2}: Использование прокси...")
-                client = Client(
-                    name=f"official_auth_{message.from_user.id}", 
-                    api_id=6, 
-                    api_hash="eb06d4ab3521ad1297404c23ad8d8e05", 
-                    in_memory=True,
-                    proxy=proxy,
-                    device_model="Android",
-                    system_version="Android 11",
-                    app_version="8.4.1",
-                    lang_code="ru"
-                )
+                client = Client(name=f"official_auth_{message.from_user.id}", proxy=proxy, **AUTH_CLIENT_ARGS)
                 await client.connect()
                 connected = True
                 break
@@ -171,11 +202,9 @@ async def process_phone(message: types.Message, state: FSMContext):
     try:
         sent_code = await client.send_code(phone)
         
-        auth_clients[message.from_user.id] = {
-            "client": client,
-            "phone": phone,
-            "hash": sent_code.phone_code_hash
-        }
+        await _drop_auth_client(message.from_user.id) # an older attempt of this user
+        auth_clients[message.from_user.id] = client
+        await state.update_data(auth=await _auth_meta(client, phone, sent_code.phone_code_hash, proxy))
         
         await status_msg.edit_text(
             "✅ **Запрос отправлен!**\n\n"
@@ -205,53 +234,48 @@ async def process_code(message: types.Message, state: FSMContext):
     if message.text and message.text.lower() == "отмена":
         await message.answer("Отменено.", reply_markup=get_main_menu())
         await state.clear()
-        if message.from_user.id in auth_clients:
-            await auth_clients[message.from_user.id]['client'].disconnect()
-            del auth_clients[message.from_user.id]
+        await _drop_auth_client(message.from_user.id)
         return
 
     code = message.text.replace("-", "").replace(" ", "").strip()
     
-    if message.from_user.id not in auth_clients:
+    auth = (await state.get_data()).get("auth")
+    if not auth:
         await message.answer("⛔️ Сессия истекла. Начните заново.")
         await state.clear()
         return
 
-    data = auth_clients[message.from_user.id]
-    client = data['client']
-    phone = data['phone']
-    ph_hash = data['hash']
-    
     status_msg = await message.answer("⏳ Проверяю код...")
     
     try:
-        await client.sign_in(phone, ph_hash, code)
+        client = await _auth_client(message.from_user.id, auth)
+        await client.sign_in(auth["phone"], auth["hash"], code)
         
-        # Success!
-        string_session = await client.export_session_string()
-        await client.disconnect() # Done with temp client
-        del auth_clients[message.from_user.id]
+        # Success! The auth key in FSM storage is now authorized: never leave it there
+        try:
+            string_session = await client.export_session_string()
+            await _drop_auth_client(message.from_user.id) # Done with temp client
         
-        # Save and Start Real Client
-        database.save_user_session(message.from_user.id, string_session)
-        await ub_manager.start_client(message.from_user.id, string_session)
+            # Save and Start Real Client
+            await async_db.save_user_session(message.from_user.id, string_session)
+            await ub_manager.start_client(message.from_user.id, string_session)
         
-        await status_msg.delete()
-        await message.answer("✅ **Успешно!** UserBot подключен и работает.\nТеперь вы будете получать уведомления об удаленных сообщениях в ЛС.", reply_markup=get_main_menu())
+            await status_msg.delete()
+            await message.answer("✅ **Успешно!** UserBot подключен и работает.\nТеперь вы будете получать уведомления об удаленных сообщениях в ЛС.", reply_markup=get_main_menu())
         
-        # Referral Reward Logic
-        referrer_id = database.claim_referral_reward(message.from_user.id)
-        if referrer_id:
-            try:
-                import time
-                cur_exp, _ = database.get_user_sub_info(referrer_id)
-                base_time = max(time.time(), float(cur_exp or 0))
-                new_exp = base_time + (4 * 24 * 3600)
-                database.set_subscription(referrer_id, new_exp)
-                await bot.send_message(referrer_id, f"🎁 **Бонус за друга!**\n\nВаш друг подключился, вам начислено **4 дня** подписки!")
-            except: pass
-
-        await state.clear()
+            # Referral Reward Logic
+            referrer_id = await async_db.claim_referral_reward(message.from_user.id)
+            if referrer_id:
+                try:
+                    import time
+                    cur_exp, _ = await async_db.get_user_sub_info(referrer_id)
+                    base_time = max(time.time(), float(cur_exp or 0))
+                    new_exp = base_time + (4 * 24 * 3600)
+                    await async_db.set_subscription(referrer_id, new_exp)
+                    await bot.send_message(referrer_id, f"🎁 **Бонус за друга!**\n\nВаш друг подключился, вам начислено **4 дня** подписки!")
+                except: pass
+        finally:
+            await state.clear()
 
     except errors.SessionPasswordNeeded:
         await status_msg.edit_text(
@@ -265,8 +289,7 @@ async def process_code(message: types.Message, state: FSMContext):
         await status_msg.edit_text("❌ **Неверный код!** Попробуйте еще раз (или напишите 'отмена').")
     except errors.PhoneCodeExpired:
         await status_msg.edit_text("❌ Код устарел. Начните заново.")
-        await client.disconnect()
-        del auth_clients[message.from_user.id]
+        await _drop_auth_client(message.from_user.id)
         await state.clear()
     except Exception as e:
         logging.error(f"Sign In Error: {e}")
@@ -277,9 +300,7 @@ async def process_password(message: types.Message, state: FSMContext):
     if message.text and message.text.lower() == "отмена":
         await message.answer("Отменено.", reply_markup=get_main_menu())
         await state.clear()
-        if message.from_user.id in auth_clients:
-            await auth_clients[message.from_user.id]['client'].disconnect()
-            del auth_clients[message.from_user.id]
+        await _drop_auth_client(message.from_user.id)
         return
 
     password = message.text
@@ -289,28 +310,30 @@ async def process_password(message: types.Message, state: FSMContext):
     except:
         pass
     
-    if message.from_user.id not in auth_clients:
+    auth = (await state.get_data()).get("auth")
+    if not auth:
         await message.answer("⛔️ Сессия истекла. Начните заново.")
         await state.clear()
         return
 
-    client = auth_clients[message.from_user.id]['client']
     status_msg = await message.answer("⏳ Проверяю пароль...")
 
     try:
+        client = await _auth_client(message.from_user.id, auth)
         await client.check_password(password=password)
         
-        # Success!
-        string_session = await client.export_session_string()
-        await client.disconnect()
-        del auth_clients[message.from_user.id]
-        
-        database.save_user_session(message.from_user.id, string_session)
-        await ub_manager.start_client(message.from_user.id, string_session)
-        
-        await status_msg.delete()
-        await message.answer("✅ **Авторизация прошла успешно!** UserBot запущен.", reply_markup=get_main_menu())
-        await state.clear()
+        # Success! The auth key in FSM storage is now authorized: never leave it there
+        try:
+            string_session = await client.export_session_string()
+            await _drop_auth_client(message.from_user.id)
+            
+            await async_db.save_user_session(message.from_user.id, string_session)
+            await ub_manager.start_client(message.from_user.id, string_session)
+            
+            await status_msg.delete()
+            await message.answer("✅ **Авторизация прошла успешно!** UserBot запущен.", reply_markup=get_main_menu())
+        finally:
+            await state.clear()
         
     except errors.PasswordHashInvalid:
         await status_msg.edit_text("❌ **Неверный пароль.** Попробуйте еще раз.")
@@ -2,6 +2,7 @@ import logging
 import config
 from aiogram import Bot, Dispatcher
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from services.fsm_storage import fsm_storage
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -13,6 +14,12 @@ except:
     BOT_ID = 0
 
 # Initialize bot, dispatcher and scheduler
-bot = Bot(token=config.BOT_TOKEN)
-dp = Dispatcher()
+if config.TELEGRAM_API_BASE:
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    bot = Bot(token=config.BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(config.TELEGRAM_API_BASE)))
+else:
+    bot = Bot(token=config.BOT_TOKEN)
+# FSM lives in SQLite so logins in progress survive restarts and are shared between workers
+dp = Dispatcher(storage=fsm_storage)
 scheduler = AsyncIOScheduler()
@@ -1,12 +1,16 @@
 import asyncio
 import logging
 import os
+import config
 import database
+import async_db
 import subprocess
 import signal
 from loader import bot, dp, scheduler
 from handlers import setup_routers
 from services.userbot_manager import ub_manager
+from services.message_buffer import message_buffer
+from services.notifier import notifier
 
 async def main():
     # Configure logging
@@ -36,23 +40,66 @@ async def main():
     setup_routers(dp)
 
     from services.backup import create_backup
+    from services.retention import run_retention
+    from services.media_store import media_store
     
     # Setup Scheduler
-    scheduler.add_job(ub_manager.check_deleted_messages, "interval", seconds=60, max_instances=2)
-    # Automatic Backup every 6 hours
-    scheduler.add_job(create_backup, "interval", hours=6)
+    # Deletions are pushed by Telegram (on_deleted_messages); this sweep only reconciles missed updates
+    scheduler.add_job(ub_manager.check_deleted_messages, "interval", seconds=config.DELETION_RECONCILE_SECONDS, max_instances=1)
+    # Automatic Backup (incremental between periodic full snapshots)
+    scheduler.add_job(create_backup, "interval", hours=config.BACKUP_INTERVAL_HOURS, max_instances=1)
+    # Retention: prune cached_messages per user policy and sweep orphaned media
+    scheduler.add_job(run_retention, "interval", hours=config.RETENTION_INTERVAL_HOURS, max_instances=1)
+    # Media store: re-hash stored files once a day
+    scheduler.add_job(media_store.check_integrity, "interval", hours=24, max_instances=1)
     scheduler.start()
     
-    # Run immediate backup on startup (to ensure it works)
-    await create_backup()
+    # Sharded mode: Pyrogram clients run in worker processes, this process only routes
+    router = None
+    if config.USERBOT_SHARDS > 1:
+        from services.sharding import ShardRouter
+        router = ShardRouter(config.USERBOT_SHARDS)
+        await router.start()
+        ub_manager.use_shards(router)
     
-    # Start saved user sessions
-    sessions = database.get_all_sessions()
-    for user_id, session_str in sessions:
-        await ub_manager.start_client(user_id, session_str)
+    # Move files saved under the old LOCAL:<path> convention into the media store
+    asyncio.create_task(media_store.import_legacy())
     
-    logging.info("Starting Aiogram Bot (UserBot Only Mode)...")
-    await dp.start_polling(bot)
+    # Start saved user sessions in the background so polling starts right away
+    boot_task = asyncio.create_task(ub_manager.start())
+    
+    # Run immediate backup on startup (to ensure it works), without holding up polling
+    backup_task = asyncio.create_task(create_backup())
+    
+    # Report whatever blocks the event loop, with the call site responsible
+    from services.loop_watchdog import loop_watchdog
+    if config.LOOP_WATCHDOG_MS:
+        loop_watchdog.start()
+    
+    # Prometheus-format /metrics for this process (and, via their stats, the shard workers)
+    metrics_runner = None
+    if config.METRICS_PORT:
+        from services import metrics
+        metrics_runner = await metrics.start_server(config.METRICS_HOST, config.METRICS_PORT)
+    
+    try:
+        if config.WEBHOOK_URL:
+            from services.webhook import run_webhook
+            logging.info("Starting Aiogram Bot in webhook mode...")
+            await run_webhook(dp, bot)
+        else:
+            logging.info("Starting Aiogram Bot (UserBot Only Mode)...")
+            await bot.delete_webhook() # A webhook left over from webhook mode blocks getUpdates
+            await dp.start_polling(bot)
+    finally:
+        boot_task.cancel()
+        backup_task.cancel()
+        if router: await router.close()
+        if metrics_runner: await metrics_runner.cleanup()
+        await loop_watchdog.stop()
+        await notifier.close()
+        await message_buffer.close()
+        await async_db.shutdown()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,111 @@
+"""
+Rebuild bot_database.db from the backups the bot sends to the Admin.
+
+Put the downloaded files in one folder and run:
+
+    python restore_backup.py <folder> [-o bot_database.db] [--chain 2024-01-01_12-00] [--upto 5]
+
+The newest full backup (backup_<chain>.db.gz.partNN) is unpacked, then its
+incrementals (backup_<chain>_incNNN.sql.gz.partNN) are replayed in order.
+A gap in the sequence stops the replay there.
+"""
+import argparse
+import gzip
+import io
+import os
+import re
+import sqlite3
+import sys
+
+FULL_RE = re.compile(r"^backup_(?P<chain>[\d_-]+)\.db\.gz\.part(?P<part>\d+)$")
+INC_RE = re.compile(r"^backup_(?P<chain>[\d_-]+)_inc(?P<seq>\d+)\.sql\.gz\.part(?P<part>\d+)$")
+
+class _Parts(io.RawIOBase):
+    """Read several part files as one stream."""
+
+    def __init__(self, paths):
+        self.files = iter(paths)
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            if self.current is None:
+                path = next(self.files, None)
+                if path is None:
+                    return 0
+                self.current = open(path, "rb")
+            n = self.current.readinto(buf)
+            if n:
+                return n
+            self.current.close()
+            self.current = None
+
+def _scan(folder):
+    fulls, incs = {}, {}
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if m := FULL_RE.match(name):
+            fulls.setdefault(m["chain"], []).append((int(m["part"]), path))
+        elif m := INC_RE.match(name):
+            incs.setdefault(m["chain"], {}).setdefault(int(m["seq"]), []).append((int(m["part"]), path))
+    return fulls, incs
+
+def _open(parts):
+    return gzip.GzipFile(fileobj=io.BufferedReader(_Parts([p for _, p in sorted(parts)])))
+
+def restore(folder, out, chain=None, upto=None):
+    fulls, incs = _scan(folder)
+    if not fulls:
+        sys.exit(f"No full backup (backup_<date>.db.gz.partNN) found in {folder}")
+    chain = chain or max(fulls)
+    if chain not in fulls:
+        sys.exit(f"No full backup for chain {chain}")
+    if os.path.exists(out):
+        sys.exit(f"{out} already exists, move it away first")
+
+    tmp = f"{out}.restoring"
+    with _open(fulls[chain]) as src, open(tmp, "wb") as dst:
+        while chunk := src.read(1024 * 1024):
+            dst.write(chunk)
+    print(f"Full backup {chain}: {os.path.getsize(tmp) / 1024 / 1024:.1f} MB")
+
+    conn = sqlite3.connect(tmp)
+    applied = 0
+    seqs = sorted(incs.get(chain, {}))
+    for seq in seqs:
+        if upto is not None and seq > upto:
+            break
+        if seq != applied + 1:
+            print(f"Incremental {applied + 1} is missing, stopping at {applied}")
+            break
+        with _open(incs[chain][seq]) as f:
+            script = f.read().decode()
+        conn.executescript(script)
+        applied = seq
+        print(f"Incremental {seq} applied")
+
+    # Replayed cached_messages rows fire the refcount triggers again; recount from scratch
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'media_store'").fetchone():
+        conn.execute("UPDATE media_store SET refcount = (SELECT COUNT(*) FROM cached_messages WHERE file_id = 'STORE:' || media_store.key)")
+        conn.commit()
+    result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    conn.close()
+    if result != "ok":
+        sys.exit(f"Restored database failed integrity_check: {result} (left at {tmp})")
+    os.replace(tmp, out)
+    print(f"Restored {out} from chain {chain} with {applied} incremental(s)")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder")
+    parser.add_argument("-o", "--out", default="bot_database.db")
+    parser.add_argument("--chain", help="timestamp of the full backup to start from (default: newest)")
+    parser.add_argument("--upto", type=int, help="last incremental to apply (point-in-time restore)")
+    args = parser.parse_args()
+    restore(args.folder, args.out, args.chain, args.upto)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import time
+import random
+import logging
+from collections import OrderedDict, deque
+import config
+from services import metrics
+
+STAGES = ("received", "cached", "detected", "restored", "queued", "notified")
+
+def mark(trace, stage: str):
+    """Stamp a stage (wall clock, so worker and front-end times compare) on a trace; None is ignored."""
+    if trace is not None:
+        trace["stages"][stage] = time.time()
+
+class AlertTracer:
+    """
+    Stage timings for deletion alerts, from Pyrogram receipt to the bot's send.
+
+    Receipt/cache times are kept for the newest `open_max` messages only. A
+    trace starts when a deletion is detected; it is a plain dict, so shard
+    workers can pass it to the front-end along with the alert text. When the
+    notifier delivers the alert the trace is finished: "deleted -> notified"
+    goes into a histogram (per shard), the whole trace into a ring buffer
+    (per-user percentiles), and a sample of traces plus every SLO breach into
+    the log.
+    """
+
+    def __init__(self, ring_size: int, open_max: int, log_sample: float, slo_seconds: float):
+        self.ring = deque(maxlen=ring_size)
+        self.open = OrderedDict()  # (user_id, chat_id, message_id) -> (received_at, cached_at)
+        self.open_max = open_max
+        self.log_sample = log_sample
+        self.slo_seconds = slo_seconds
+        self.breaches = 0
+
+    def received(self, user_id: int, chat_id: int, message_id: int, received_at: float):
+        """Called once the message has been handed to the cache."""
+        key = (user_id, chat_id, message_id)
+        self.open[key] = (received_at, time.time())
+        self.open.move_to_end(key)
+        while len(self.open) > self.open_max:
+            self.open.popitem(last=False)
+
+    def start(self, user_id: int, chat_id: int, message_id: int, source: str, detected_at: float = None):
+        trace = {"user": user_id, "chat": chat_id, "message": message_id, "source": source, "shard": None, "stages": {}}
+        receipt = self.open.pop((user_id, chat_id, message_id), None)
+        if receipt:
+            trace["stages"]["received"], trace["stages"]["cached"] = receipt
+        trace["stages"]["detected"] = detected_at or time.time()
+        return trace
+
+    def finish(self, trace, ok: bool = True):
+        mark(trace, "notified")
+        stages = trace["stages"]
+        total = stages["notified"] - stages["detected"]
+        shard = "-" if trace.get("shard") is None else trace["shard"]
+        trace["ok"] = ok
+        self.ring.append(trace)
+        metrics.alert_seconds.observe(total, shard=shard)
+        slow = total > self.slo_seconds
+        if slow:
+            self.breaches += 1
+        if slow or random.random() < self.log_sample:
+            logging.log(logging.WARNING if slow else logging.INFO, f"⏱ Deletion alert {trace['source']} user={trace['user']} shard={shard} "
+                        f"{'delivered' if ok else 'FAILED'} in {total:.2f}s ({self.format(trace)})")
+
+    @staticmethod
+    def format(trace):
+        stages = trace["stages"]
+        previous, parts = None, []
+        for stage in STAGES:
+            if stage not in stages: continue
+            if previous is not None:
+                parts.append(f"{stage} +{(stages[stage] - previous) * 1000:.0f}ms")
+            previous = stages[stage]
+        return ", ".join(parts)
+
+    def percentiles(self, by: str = None):
+        """{group: (count, p50, p95, p99)} of deleted -> notified seconds; `by` is None, "shard" or "user"."""
+        groups = {}
+        for trace in self.ring:
+            key = trace.get(by) if by else "all"
+            groups.setdefault(key, []).append(trace["stages"]["notified"] - trace["stages"]["detected"])
+        result = {}
+        for key, values in groups.items():
+            values.sort()
+            pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+            result[key] = (len(values), pick(0.5), pick(0.95), pick(0.99))
+        return result
+
+alert_trace = AlertTracer(config.ALERT_TRACE_RING, config.ALERT_TRACE_OPEN, config.ALERT_TRACE_LOG_SAMPLE, config.ALERT_SLO_SECONDS)
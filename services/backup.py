@@ -1,49 +1,275 @@
 import os
+import gzip
+import json
+import time
 import shutil
+import sqlite3
+import hashlib
 import datetime
 import logging
 import asyncio
+import tempfile
 from aiogram.types import FSInputFile
+import config
+import database
 from config import ADMIN_ID
-from loader import bot
+from services.notifier import notifier
 
-DB_PATH = "bot_database.db"
+BACKUP_PAGES_PER_STEP = 1024 # pages copied per backup step; writers get the DB between steps
+COPY_CHUNK = 1024 * 1024
+BACKUP_DIR = "backups"
+BASE_PATH = os.path.join(BACKUP_DIR, "base.db")     # copy of what was last shipped, incrementals diff against it
+STATE_PATH = os.path.join(BACKUP_DIR, "state.json") # {"chain": <full timestamp>, "seq": n, "full_at": epoch}
 
-async def create_backup():
+last_backup = None # metrics of the latest run, shown by the admin panel
+_lock = asyncio.Lock()
+
+class _PartWriter:
+    """File-like sink that splits a byte stream into numbered files of at most part_size bytes."""
+
+    def __init__(self, base_path: str, part_size: int):
+        self.base_path = base_path
+        self.part_size = part_size
+        self.parts = []   # [(path, size, sha256)]
+        self.total = hashlib.sha256()
+        self._file = None
+        self._hash = None
+        self._written = 0
+
+    def _rotate(self):
+        self._close_part()
+        path = f"{self.base_path}.part{len(self.parts) + 1:02d}"
+        self._file = open(path, "wb")
+        self._hash = hashlib.sha256()
+        self._written = 0
+        self.parts.append([path, 0, None])
+
+    def _close_part(self):
+        if self._file:
+            self._file.close()
+            self.parts[-1][1] = self._written
+            self.parts[-1][2] = self._hash.hexdigest()
+            self._file = None
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._file is None or self._written >= self.part_size:
+                self._rotate()
+            n = min(len(view), self.part_size - self._written)
+            self._file.write(view[:n])
+            self._hash.update(view[:n])
+            self.total.update(view[:n])
+            self._written += n
+            view = view[n:]
+        return len(data)
+
+    def flush(self):
+        if self._file: self._file.flush()
+
+    def close(self):
+        self._close_part()
+
+def _snapshot(dest: str):
+    """Consistent copy of the live WAL database (includes committed -wal pages)."""
+    src = sqlite3.connect(database.DB_PATH, timeout=30)
+    dst = sqlite3.connect(dest)
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP)
+    finally:
+        dst.close()
+        src.close()
+
+def _verify(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute("PRAGMA integrity_check").fetchone()[0]
+    finally:
+        conn.close()
+    if result != "ok":
+        raise RuntimeError(f"integrity_check failed: {result}")
+
+def _compress(path: str, base_path: str, part_size: int):
+    """gzip the snapshot into size-limited parts; returns (parts, sha256 of the whole .gz)."""
+    writer = _PartWriter(base_path, part_size)
+    try:
+        with open(path, "rb") as src, gzip.GzipFile(filename=os.path.basename(path), mode="wb", fileobj=writer, compresslevel=6) as gz:
+            shutil.copyfileobj(src, gz, COPY_CHUNK)
+    finally:
+        writer.close()
+    return [tuple(p) for p in writer.parts], writer.total.hexdigest()
+
+def _schema(conn, schema: str):
+    """{table: [columns]} plus user_version, to tell whether a diff is possible."""
+    tables = {}
+    for (name,) in conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"):
+        tables[name] = [r[1] for r in conn.execute(f'PRAGMA {schema}.table_info("{name}")')]
+    return tables, conn.execute(f"PRAGMA {schema}.user_version").fetchone()[0]
+
+def _diff(path: str, base: str, out_base: str, part_size: int, header: str):
     """
-    Creates a copy of the database and sends it to the Admin.
+    Write the rows that changed between base and the snapshot at path as a
+    gzipped SQL script (deletes by rowid, then INSERT OR REPLACE with rowid),
+    split like a full backup. Returns (parts, sha256, changes), or None when
+    the schemas differ and only a full backup will do.
     """
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("ATTACH DATABASE ? AS base", (base,))
+        tables, version = _schema(conn, "main")
+        if (tables, version) != _schema(conn, "base"):
+            return None
+        writer = _PartWriter(out_base, part_size)
+        changes = 0
+        try:
+            with gzip.GzipFile(filename=os.path.basename(out_base), mode="wb", fileobj=writer, compresslevel=6) as gz:
+                gz.write(f"{header}\nBEGIN;\n".encode())
+                for table, cols in tables.items():
+                    for (rowid,) in conn.execute(f'SELECT rowid FROM base."{table}" EXCEPT SELECT rowid FROM main."{table}"'):
+                        gz.write(f'DELETE FROM "{table}" WHERE rowid = {rowid};\n'.encode())
+                        changes += 1
+                    names = ", ".join(f'"{c}"' for c in cols)
+                    values = " || ', ' || ".join(["quote(_rowid)"] + [f'quote("{c}")' for c in cols])
+                    # SQLite renders the literals itself; only new or changed rows survive the EXCEPT
+                    rows = conn.execute(
+                        f"""SELECT 'INSERT OR REPLACE INTO "{table}" (rowid, {names.replace("'", "''")}) VALUES (' || {values} || ');'
+                            FROM (SELECT rowid AS _rowid, * FROM main."{table}" EXCEPT SELECT rowid, * FROM base."{table}")"""
+                    )
+                    for (statement,) in rows:
+                        gz.write(statement.encode() + b"\n")
+                        changes += 1
+                gz.write(b"COMMIT;\n")
+        finally:
+            writer.close()
+        return [tuple(p) for p in writer.parts], writer.total.hexdigest(), changes
+    finally:
+        conn.close()
+
+def _load_state():
     try:
-        if not os.path.exists(DB_PATH):
+        with open(STATE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _promote(snapshot: str, state: dict):
+    """The snapshot we just shipped becomes the base for the next incremental."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    shutil.move(snapshot, f"{BASE_PATH}.tmp")
+    os.replace(f"{BASE_PATH}.tmp", BASE_PATH)
+    with open(f"{STATE_PATH}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{STATE_PATH}.tmp", STATE_PATH)
+
+def _check_parts(parts, digest: str):
+    """Re-read the written parts: every part hash and the whole-stream hash must match."""
+    total = hashlib.sha256()
+    for path, size, part_digest in parts:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+                h.update(chunk)
+                total.update(chunk)
+        if h.hexdigest() != part_digest or os.path.getsize(path) != size:
+            raise RuntimeError(f"backup part {os.path.basename(path)} does not match its checksum")
+    if total.hexdigest() != digest:
+        raise RuntimeError("backup archive checksum mismatch")
+
+async def create_backup(full: bool = False):
+    """
+    Snapshot the database with the SQLite online backup API and send it to
+    the Admin in parts below Telegram's document limit. In incremental mode
+    only rows changed since the last shipped backup are sent, with a full
+    snapshot every BACKUP_FULL_INTERVAL_HOURS. restore_backup.py replays them.
+    All file work runs in a worker thread.
+    """
+    global last_backup
+    if _lock.locked():
+        logging.warning("Backup already running, skipping this run.")
+        return
+    async with _lock:
+        if not os.path.exists(database.DB_PATH):
             logging.error("Backup failed: Database file not found!")
             return
 
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M")
-        backup_filename = f"backup_{timestamp}.db"
-        
-        # Create a local copy first
-        shutil.copy2(DB_PATH, backup_filename)
-        
-        # Send to Admin
-        file_to_send = FSInputFile(backup_filename)
-        caption = (
-            f"💾 **Автоматический бэкап базы данных**\n"
-            f"📅 Дата: `{timestamp}`\n"
-            f"📂 Файл: `{backup_filename}`\n\n"
-            f"⚠️ Сохраните этот файл! В нем все подписки и сессии."
+        state = await asyncio.to_thread(_load_state)
+        incremental = (
+            not full and config.BACKUP_MODE == "incremental" and state is not None
+            and os.path.exists(BASE_PATH)
+            and time.time() - state["full_at"] < config.BACKUP_FULL_INTERVAL_HOURS * 3600
         )
-        
+        metrics = {"timestamp": timestamp, "ok": False, "kind": "full"}
+        started = time.monotonic()
         try:
-            await bot.send_document(ADMIN_ID, file_to_send, caption=caption, parse_mode="Markdown")
-            logging.info(f"✅ Backup sent to Admin ID {ADMIN_ID}")
+            with tempfile.TemporaryDirectory(prefix="backup_") as tmp:
+                snapshot = os.path.join(tmp, f"backup_{timestamp}.db")
+
+                t = time.monotonic()
+                await asyncio.to_thread(_snapshot, snapshot)
+                metrics["snapshot_s"] = round(time.monotonic() - t, 2)
+                metrics["db_bytes"] = os.path.getsize(snapshot)
+
+                t = time.monotonic()
+                await asyncio.to_thread(_verify, snapshot)
+                metrics["verify_s"] = round(time.monotonic() - t, 2)
+
+                t = time.monotonic()
+                result = None
+                if incremental:
+                    seq = state["seq"] + 1
+                    backup_filename = f"backup_{state['chain']}_inc{seq:03d}.sql.gz"
+                    header = f"-- riz incremental backup chain={state['chain']} seq={seq} taken={timestamp}"
+                    result = await asyncio.to_thread(_diff, snapshot, BASE_PATH, os.path.join(tmp, backup_filename), config.BACKUP_PART_BYTES, header)
+                    if result is None:
+                        logging.info("Schema changed since the last backup, taking a full one.")
+                if result is not None:
+                    parts, digest, changes = result
+                    metrics.update(kind="incremental", changes=changes, seq=seq)
+                    new_state = dict(state, seq=seq)
+                else:
+                    backup_filename = f"backup_{timestamp}.db.gz"
+                    parts, digest = await asyncio.to_thread(_compress, snapshot, os.path.join(tmp, backup_filename), config.BACKUP_PART_BYTES)
+                    new_state = {"chain": timestamp, "seq": 0, "full_at": time.time()}
+                await asyncio.to_thread(_check_parts, parts, digest)
+                metrics["compress_s"] = round(time.monotonic() - t, 2)
+                metrics["gz_bytes"] = sum(p[1] for p in parts)
+                metrics["parts"] = len(parts)
+                metrics["sha256"] = digest
+
+                t = time.monotonic()
+                if metrics["kind"] == "incremental" and not metrics["changes"]:
+                    logging.info("💾 No changes since the last backup, nothing sent.")
+                else:
+                    if metrics["kind"] == "full":
+                        title = "💾 **Автоматический бэкап базы данных**"
+                        restore = "Восстановление: `python restore_backup.py <папка с файлами>`"
+                    else:
+                        title = f"💾 **Инкрементальный бэкап №{seq}** (изменений: {metrics['changes']})"
+                        restore = f"Применяется поверх полного бэкапа `{state['chain']}`"
+                    for i, (path, size, part_digest) in enumerate(parts, start=1):
+                        caption = (
+                            f"{title}\n"
+                            f"📅 Дата: `{timestamp}`\n"
+                            f"📂 Файл: `{backup_filename}` (часть {i}/{len(parts)})\n"
+                            f"🔐 SHA-256 архива: `{digest}`\n\n"
+                            f"⚠️ Сохраните этот файл! В нем все подписки и сессии.\n"
+                            f"{restore}"
+                        )
+                        await notifier.send("send_document", ADMIN_ID, FSInputFile(path), caption=caption, parse_mode="Markdown")
+                    if config.BACKUP_MODE == "incremental":
+                        await asyncio.to_thread(_promote, snapshot, new_state)
+                metrics["send_s"] = round(time.monotonic() - t, 2)
+                metrics["ok"] = True
+            logging.info(
+                f"✅ {metrics['kind'].capitalize()} backup sent to Admin ID {ADMIN_ID}: {metrics['db_bytes'] / 1024 / 1024:.1f} MB DB -> "
+                f"{metrics['gz_bytes'] / 1024 / 1024:.2f} MB in {metrics['parts']} part(s), "
+                f"snapshot {metrics['snapshot_s']}s, verify {metrics['verify_s']}s, "
+                f"compress {metrics['compress_s']}s, send {metrics['send_s']}s"
+            )
         except Exception as e:
-            logging.error(f"❌ Failed to send backup to Telegram: {e}")
-        
-        # Clean up local backup file to save space
-        try:
-            os.remove(backup_filename)
-        except:
-            pass
-            
-    except Exception as e:
-        logging.error(f"Critical Backup Error: {e}")
+            metrics["error"] = str(e)
+            logging.error(f"Critical Backup Error: {e}", exc_info=True)
+        metrics["total_s"] = round(time.monotonic() - started, 2)
+        last_backup = metrics
+        return metrics
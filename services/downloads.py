@@ -0,0 +1,119 @@
+import os
+import time
+import asyncio
+import logging
+import config
+from services.rate_limit import limiter
+
+DOWNLOADS_DIR = "downloads"
+USAGE_TTL_SECONDS = 30
+
+class DownloadRejected(Exception):
+    """Download refused by a size limit or the downloads/ disk quota."""
+
+class DownloadService:
+    """
+    Bounded media download pool shared by all UserBot clients.
+
+    Every download runs as its own task under a per-user and a global
+    semaphore, so a large video of one user neither blocks that client's
+    handlers nor starves other users. Files are checked against per-type size
+    limits and the downloads/ disk quota before any bytes are fetched, and all
+    of a user's downloads are cancelled when their client stops.
+    """
+
+    def __init__(self, global_limit: int, per_user_limit: int, quota_bytes: int, size_limits: dict):
+        self.global_sem = asyncio.Semaphore(global_limit)
+        self.per_user_limit = per_user_limit
+        self.quota_bytes = quota_bytes
+        self.size_limits = size_limits
+        self.user_sems = {}
+        self.tasks = {}   # user_id -> set of running download tasks
+        self._usage = (0, 0.0) # (bytes, measured_at)
+        self._walking = None   # running os.walk of downloads/, if any
+        self.stats = {"done": 0, "rejected": 0, "failed": 0, "cancelled": 0}
+
+    @staticmethod
+    def _walk_usage():
+        used = 0
+        for root, _, files in os.walk(DOWNLOADS_DIR):
+            for name in files:
+                try: used += os.path.getsize(os.path.join(root, name))
+                except OSError: pass
+        return used
+
+    async def _disk_usage(self):
+        used, measured = self._usage
+        if time.monotonic() - measured < USAGE_TTL_SECONDS:
+            return used
+        # Walk downloads/ off the loop; concurrent callers share one walk
+        if self._walking is None:
+            self._walking = asyncio.ensure_future(asyncio.to_thread(self._walk_usage))
+            self._walking.add_done_callback(lambda _: setattr(self, "_walking", None))
+        used = await asyncio.shield(self._walking)
+        self._usage = (used, time.monotonic())
+        return used
+
+    async def _check(self, media_type, size, to_disk):
+        limit = self.size_limits.get(media_type or "", self.size_limits["default"])
+        if size and size > limit:
+            raise DownloadRejected(f"{media_type} of {size} bytes exceeds the {limit} byte limit")
+        if to_disk and await self._disk_usage() + (size or 0) > self.quota_bytes:
+            raise DownloadRejected("downloads/ disk quota exceeded")
+
+    def submit(self, user_id: int, client, target, media_type: str = None, size: int = 0, **kwargs):
+        """
+        Queue client.download_media(target, **kwargs) and return its task.
+        Pass in_memory=True for a BytesIO result, otherwise the file lands on disk.
+        """
+        task = asyncio.create_task(self._run(user_id, client, target, media_type, size, kwargs))
+        running = self.tasks.setdefault(user_id, set())
+        running.add(task)
+        task.add_done_callback(running.discard)
+        return task
+
+    async def fetch(self, user_id: int, client, target, media_type: str = None, size: int = 0, **kwargs):
+        """submit() and wait for the result."""
+        return await self.submit(user_id, client, target, media_type, size, **kwargs)
+
+    async def _run(self, user_id, client, target, media_type, size, kwargs):
+        to_disk = not kwargs.get("in_memory")
+        try:
+            await self._check(media_type, size, to_disk)
+        except DownloadRejected as e:
+            self.stats["rejected"] += 1
+            logging.warning(f"Download for {user_id} rejected: {e}")
+            raise
+
+        user_sem = self.user_sems.setdefault(user_id, asyncio.Semaphore(self.per_user_limit))
+        try:
+            if to_disk:
+                os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+            # User slot first, so a busy user never holds a global slot while queueing
+            result = await limiter.call(user_id, "download", client.download_media, target, slots=(user_sem, self.global_sem), **kwargs)
+        except asyncio.CancelledError:
+            self.stats["cancelled"] += 1
+            raise
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+
+        self.stats["done"] += 1
+        if to_disk and result:
+            used, measured = self._usage
+            try: self._usage = (used + os.path.getsize(result), measured)
+            except OSError: pass
+        return result
+
+    def cancel_user(self, user_id: int):
+        """Cancel everything queued or running for a stopped client."""
+        for task in list(self.tasks.pop(user_id, ())):
+            task.cancel()
+        self.user_sems.pop(user_id, None)
+
+downloads = DownloadService(
+    config.DOWNLOAD_GLOBAL_LIMIT,
+    config.DOWNLOAD_PER_USER_LIMIT,
+    config.DOWNLOAD_QUOTA_BYTES,
+    config.DOWNLOAD_SIZE_LIMITS,
+)
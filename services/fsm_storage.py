@@ -0,0 +1,108 @@
+import json
+import time
+import asyncio
+import logging
+from typing import Any, Dict, Mapping, Optional
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+import config
+import async_db
+
+_UNSET = object()
+
+class SQLiteStorage(BaseStorage):
+    """
+    aiogram FSM storage in the bot's SQLite database.
+
+    State and data survive restarts and are shared by every process that uses
+    the same database file. Writes are batched like MessageBuffer (one
+    transaction per flush) and reads see this process's unflushed writes
+    first. Entries expire `ttl` seconds after their last write. Data must be
+    JSON-serializable.
+    """
+
+    def __init__(self, ttl: int, flush_ms: int = 50):
+        self.ttl = ttl
+        self.max_delay = flush_ms / 1000
+        self.pending = {}   # key -> [state, data], _UNSET where not written
+        self.inflight = {}
+        self._timer = None
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, "business_connection_id", None), key.destiny,
+        ))
+
+    def _write(self, key: StorageKey, index: int, value):
+        entry = self.pending.setdefault(self._key(key), [_UNSET, _UNSET])
+        entry[index] = value
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._schedule_flush)
+
+    def _buffered(self, key: str, index: int):
+        for entries in (self.pending, self.inflight):
+            entry = entries.get(key)
+            if entry and entry[index] is not _UNSET:
+                return entry[index]
+        return _UNSET
+
+    def _schedule_flush(self):
+        self._timer = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        async with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending:
+                return
+            self.inflight, self.pending = self.pending, {}
+            states = [(k, e[0]) for k, e in self.inflight.items() if e[0] is not _UNSET]
+            datas = [(k, e[1]) for k, e in self.inflight.items() if e[1] is not _UNSET]
+            now = time.time()
+            try:
+                await async_db.fsm_write_bulk(states, datas, now, now + self.ttl)
+            except Exception as e:
+                logging.error(f"FSM flush failed ({len(self.inflight)} keys): {e}")
+                for key, entry in self.inflight.items():
+                    newer = self.pending.setdefault(key, [_UNSET, _UNSET])
+                    for i in (0, 1):
+                        if newer[i] is _UNSET: newer[i] = entry[i]
+            finally:
+                self.inflight = {}
+        if self.pending and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._schedule_flush)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        self._write(key, 0, state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state = self._buffered(self._key(key), 0)
+        if state is not _UNSET:
+            return state
+        row = await async_db.fsm_get(self._key(key), time.time())
+        return row[0] if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        self._write(key, 1, json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = self._buffered(self._key(key), 1)
+        if data is _UNSET:
+            row = await async_db.fsm_get(self._key(key), time.time())
+            data = row[1] if row else None
+        return json.loads(data) if data else {}
+
+    async def close(self) -> None:
+        """Flush-on-shutdown hook (aiogram calls it when the dispatcher shuts down)."""
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+fsm_storage = SQLiteStorage(config.FSM_TTL_SECONDS, config.FSM_FLUSH_MS)
@@ -0,0 +1,131 @@
+from collections import OrderedDict
+import config
+
+class CachedRecord:
+    """One cached private message, in database.cache_message field order."""
+    __slots__ = ("message_id", "chat_id", "user_id", "sender_id", "content", "sender_name",
+                 "media_type", "file_id", "sender_username", "chat_title", "file_unique_id")
+
+    def __init__(self, message_id, chat_id, user_id, sender_id, content, sender_name,
+                 media_type=None, file_id=None, sender_username=None, chat_title=None, file_unique_id=None):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.sender_id = sender_id
+        self.content = content
+        self.sender_name = sender_name
+        self.media_type = media_type
+        self.file_id = file_id
+        self.sender_username = sender_username
+        self.chat_title = chat_title
+        self.file_unique_id = file_unique_id
+
+    def check_row(self):
+        """Same layout as database.get_messages_for_check rows."""
+        return (self.message_id, self.chat_id, self.sender_id, self.content, self.sender_name,
+                self.media_type, self.file_id, self.sender_username, self.chat_title, self.file_unique_id)
+
+    def content_row(self):
+        """Same layout as database.get_cached_message_content."""
+        return (self.content, self.media_type, self.sender_name, self.sender_username, self.chat_title)
+
+class HotCache:
+    """
+    Per-user bounded ring of the most recently cached messages.
+
+    Every cached_messages write and delete passes through MessageBuffer, which
+    mirrors it here, so the ring always holds a user's newest rows. Once a
+    user's ring has been warmed from the DB it is authoritative for the newest
+    `per_user` messages, and the deletion sweep and edit diffing no longer need
+    SQLite for them.
+    """
+
+    def __init__(self, per_user: int):
+        self.per_user = per_user
+        self.rings = {}  # user_id -> OrderedDict((message_id, chat_id) -> CachedRecord), oldest first
+        self.index = {}  # (message_id, chat_id) -> CachedRecord
+        self.warm = set()     # users whose ring mirrors the newest rows in the DB
+        self.complete = set() # warm users whose ring holds every row they have
+        self.discards = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, *row):
+        record = CachedRecord(*row)
+        key = (record.message_id, record.chat_id)
+        old = self.index.get(key)
+        if old is not None and old.user_id != record.user_id:
+            self.discard(*key)
+        ring = self.rings.setdefault(record.user_id, OrderedDict())
+        ring.pop(key, None)
+        ring[key] = record # newest at the end, like a refreshed timestamp in the DB
+        self.index[key] = record
+        self._trim(record.user_id, ring)
+
+    def get(self, message_id, chat_id):
+        record = self.index.get((message_id, chat_id))
+        if record is None: self.misses += 1
+        else: self.hits += 1
+        return record
+
+    def find(self, user_id, message_ids):
+        """Records of a user with one of the given ids, in any chat (delete updates may lack the chat)."""
+        wanted = set(message_ids)
+        found = [r for r in self.rings.get(user_id, {}).values() if r.message_id in wanted]
+        self.hits += len(found)
+        self.misses += len(wanted) - len(found)
+        return found
+
+    def discard(self, message_id, chat_id):
+        self.discards += 1
+        record = self.index.pop((message_id, chat_id), None)
+        if record is not None:
+            ring = self.rings.get(record.user_id)
+            if ring is not None:
+                ring.pop((message_id, chat_id), None)
+
+    def recent(self, user_id, limit):
+        """Newest `limit` rows for a warm user, or None when the DB must be asked."""
+        ring = self.rings.get(user_id, {})
+        if user_id not in self.warm or (len(ring) < limit and user_id not in self.complete):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [r.check_row() for r in list(reversed(ring.values()))[:limit]]
+
+    def load(self, user_id, check_rows, exhausted: bool):
+        """
+        Warm a user's ring from get_messages_for_check rows (newest first).
+        `exhausted` means the DB has no older rows for this user.
+        """
+        ring = self.rings.setdefault(user_id, OrderedDict())
+        for row in check_rows:
+            key = (row[0], row[1])
+            if key in ring: continue # a newer write is already here
+            record = CachedRecord(row[0], row[1], user_id, *row[2:])
+            ring[key] = record
+            ring.move_to_end(key, last=False) # loaded rows are older than anything written since
+            self.index[key] = record
+        self.warm.add(user_id)
+        if exhausted: self.complete.add(user_id)
+        self._trim(user_id, ring)
+
+    def _trim(self, user_id, ring):
+        while len(ring) > self.per_user:
+            _, evicted = ring.popitem(last=False)
+            self.index.pop((evicted.message_id, evicted.chat_id), None)
+            self.complete.discard(user_id) # the DB now holds rows the ring doesn't
+
+    def replace_file_ref(self, old_ref, new_ref):
+        """Mirror of database.replace_file_ref."""
+        for record in self.index.values():
+            if record.file_id == old_ref:
+                record.file_id = new_ref
+
+    def drop_user(self, user_id):
+        for key in self.rings.pop(user_id, {}):
+            self.index.pop(key, None)
+        self.warm.discard(user_id)
+        self.complete.discard(user_id)
+
+hot_cache = HotCache(config.HOT_CACHE_PER_USER)
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+import config
+from services import metrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class LoopWatchdog:
+    """
+    Finds the code that blocks the event loop.
+
+    A heartbeat task wakes every `threshold / 2`; a daemon thread watches the
+    heartbeat and, once it is overdue by more than `threshold`, grabs the loop
+    thread's stack with sys._current_frames(). When the heartbeat finally
+    runs, the measured lag is charged to that stack's call site: the
+    innermost frame in our own code, the library frame it was stuck in, and
+    the outermost frame in our code (the handler or job it ran under).
+    Totals per call site are logged every `summary_seconds`.
+    """
+
+    def __init__(self, threshold_ms: int, summary_seconds: int, top: int = 10):
+        self.threshold = threshold_ms / 1000
+        self.interval = self.threshold / 2
+        self.summary_seconds = summary_seconds
+        self.top = top
+        self.sites = {}   # site -> [stalls, total seconds, worst seconds, handler, blocked in]
+        self.window = {}  # same, since the last summary
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._sample = None  # (beat it belongs to, site, handler, blocked in)
+        self._loop_thread = None
+        self._tasks = []
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        if self._tasks: return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._tasks = [asyncio.create_task(self._heartbeat()), asyncio.create_task(self._summaries())]
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logging.info(f"🐶 Loop watchdog: reporting stalls over {self.threshold * 1000:.0f}ms")
+
+    async def stop(self):
+        self._stop.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _heartbeat(self):
+        while True:
+            self._beat = beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - beat - self.interval
+            metrics.loop_lag_seconds.observe(max(0.0, lag))
+            if lag > self.threshold:
+                self._record(beat, lag)
+
+    def _watch(self):
+        """Watchdog thread: sample the loop thread's stack once per stall."""
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            if time.monotonic() - beat < self.interval + self.threshold:
+                continue
+            if self._sample is not None and self._sample[0] == beat:
+                continue # this stall has been sampled already
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._sample = (beat, *self._attribute(traceback.extract_stack(frame)))
+
+    @staticmethod
+    def _attribute(stack):
+        """(call site, handler, blocked in) for a stack listed outermost first."""
+        # Frames below the loop's Handle._run belong to asyncio.run()/main(), not to the running callback
+        start = max((i + 1 for i, f in enumerate(stack) if f.name == "_run" and f.filename.endswith(os.path.join("asyncio", "events.py"))), default=0)
+        stack = stack[start:]
+        ours = [i for i, f in enumerate(stack) if f.filename.startswith(ROOT) and "site-packages" not in f.filename and f.filename != __file__]
+        where = lambda f: f"{os.path.basename(f.filename)}:{f.lineno} {f.name}"
+        if not ours:
+            return "outside our code", None, where(stack[-1]) if stack else None
+        site, handler = stack[ours[-1]], stack[ours[0]]
+        blocked = where(stack[-1]) if ours[-1] < len(stack) - 1 else None
+        return f"{os.path.relpath(site.filename, ROOT)}:{site.lineno} {site.name}", f"{os.path.relpath(handler.filename, ROOT)} {handler.name}", blocked
+
+    def _record(self, beat, lag):
+        sample = self._sample
+        if sample is not None and sample[0] == beat:
+            site, handler, blocked = sample[1:]
+        else:
+            site, handler, blocked = "not sampled (stall ended between checks)", None, None
+        self.stalls += 1
+        metrics.loop_stalls.inc()
+        for table in (self.sites, self.window):
+            entry = table.setdefault(site, [0, 0.0, 0.0, handler, blocked])
+            entry[0] += 1
+            entry[1] += lag
+            entry[2] = max(entry[2], lag)
+        if lag >= 1:
+            logging.warning(f"🐢 Event loop blocked for {lag:.2f}s at {site} (in {blocked}, under {handler})")
+
+    def ranked(self, table=None):
+        """Call sites by total blocked time, worst first."""
+        return sorted((table if table is not None else self.sites).items(), key=lambda item: item[1][1], reverse=True)
+
+    async def _summaries(self):
+        while True:
+            await asyncio.sleep(self.summary_seconds)
+            if not self.window: continue
+            window, self.window = self.window, {}
+            lines = [f"{total * 1000:8.0f}ms {count:5}x max {worst * 1000:6.0f}ms  {site}  [{blocked or '-'}; {handler or '-'}]"
+                     for site, (count, total, worst, handler, blocked) in self.ranked(window)[:self.top]]
+            logging.warning(f"🐢 Loop stalls in the last {self.summary_seconds}s (total blocked time, count, worst, call site):\n" + "\n".join(lines))
+
+loop_watchdog = LoopWatchdog(config.LOOP_WATCHDOG_MS, config.LOOP_WATCHDOG_SUMMARY_SECONDS)
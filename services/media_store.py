@@ -0,0 +1,155 @@
+import os
+import time
+import asyncio
+import hashlib
+import tempfile
+import logging
+import config
+import async_db
+from services.hot_cache import hot_cache
+
+STORE_DIR = os.path.join("downloads", "store")
+STORE_PREFIX = "STORE:"
+
+def _hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _write_entry(key, ext, data, src_path):
+    """Write data (or move src_path) into the store atomically; returns (path, size, sha256)."""
+    path = os.path.abspath(os.path.join(STORE_DIR, key[:2], f"{key}{ext}"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique temp name: concurrent puts of the same key must not write into each other's file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{key}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            if not src_path:
+                f.write(data)
+        if src_path:
+            os.replace(src_path, tmp)
+        digest = _hash_file(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        _unlink(tmp)
+        raise
+    return path, os.path.getsize(path), digest
+
+def _size(path):
+    try: return os.path.getsize(path)
+    except OSError: return None
+
+def _unlink(path):
+    try: os.remove(path)
+    except OSError: pass
+
+class MediaStore:
+    """
+    Content-addressed store for media we keep on our own disk.
+
+    Files are keyed by Telegram's file_unique_id (identical for the same file in
+    every chat) or, failing that, by sha256 of the content, so media shared
+    with many users is stored once. cached_messages references an entry as
+    file_id = "STORE:<key>"; database triggers keep refcount in sync with
+    those rows. When the store grows past MEDIA_STORE_MAX_BYTES, unreferenced
+    entries go first, then the least recently used. A new entry's reference
+    sits in the MessageBuffer until the next flush, so unreferenced entries
+    younger than `grace` seconds are left alone.
+    """
+
+    def __init__(self, max_bytes: int, grace: int = 600):
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def ref(key: str):
+        return f"{STORE_PREFIX}{key}"
+
+    @staticmethod
+    def key_of(file_ref):
+        if file_ref and str(file_ref).startswith(STORE_PREFIX):
+            return str(file_ref)[len(STORE_PREFIX):]
+        return None
+
+    async def put(self, data: bytes = None, src_path: str = None, key: str = None, ext: str = ".bin"):
+        """Store bytes or take ownership of a file on disk; returns the key. Duplicates are not rewritten."""
+        if not key:
+            key = await asyncio.to_thread(lambda: hashlib.sha256(data).hexdigest() if data is not None else _hash_file(src_path))
+        existing = await async_db.media_store_get(key)
+        if existing and await asyncio.to_thread(os.path.exists, existing[0]):
+            await async_db.media_store_touch(key, time.time())
+            if src_path: await asyncio.to_thread(_unlink, src_path)
+            return key
+
+        path, size, digest = await asyncio.to_thread(_write_entry, key, ext, data, src_path)
+        await async_db.media_store_add(key, path, size, digest, time.time())
+        await self.evict()
+        return key
+
+    async def get(self, key: str):
+        """O(1) lookup of an entry's path; entries whose file is missing or truncated are dropped."""
+        row = await async_db.media_store_get(key)
+        if not row:
+            return None
+        path, size = row[0], row[1]
+        if await asyncio.to_thread(_size, path) != size:
+            logging.warning(f"Media store entry {key} is missing or corrupt, dropping it.")
+            await async_db.media_store_delete(key)
+            return None
+        await async_db.media_store_touch(key, time.time())
+        return path
+
+    async def evict(self):
+        async with self._lock:
+            count, total = await async_db.media_store_total()
+            if total <= self.max_bytes:
+                return
+            freed = 0
+            while total > self.max_bytes:
+                victims = await async_db.media_store_lru(50, time.time() - self.grace)
+                if not victims: break
+                for key, path, size in victims:
+                    await asyncio.to_thread(_unlink, path)
+                    await async_db.media_store_delete(key)
+                    total -= size or 0
+                    freed += size or 0
+                    if total <= self.max_bytes: break
+            logging.info(f"🧹 Media store evicted {freed / 1024 / 1024:.1f} MB")
+
+    async def check_integrity(self):
+        """Re-hash every entry and drop the ones whose content no longer matches."""
+        bad = 0
+        for key, path, size, digest in await async_db.media_store_all():
+            try:
+                ok = await asyncio.to_thread(_hash_file, path) == digest
+            except OSError:
+                ok = False
+            if not ok:
+                bad += 1
+                await asyncio.to_thread(_unlink, path)
+                await async_db.media_store_delete(key)
+        logging.info(f"🔍 Media store integrity check: {bad} bad entries removed")
+        return bad
+
+    async def import_legacy(self):
+        """Move files referenced by the old LOCAL:<path> convention into the store."""
+        moved = 0
+        for ref in await async_db.get_local_media_refs():
+            path = str(ref)[len("LOCAL:"):]
+            if not await asyncio.to_thread(os.path.exists, path):
+                continue
+            try:
+                key = await self.put(src_path=path, ext=os.path.splitext(path)[1] or ".bin")
+                await async_db.replace_file_ref(ref, self.ref(key))
+                hot_cache.replace_file_ref(ref, self.ref(key))
+                moved += 1
+            except Exception as e:
+                logging.error(f"Could not import {path} into media store: {e}")
+        if moved:
+            logging.info(f"📦 Imported {moved} legacy media files into the store")
+        return moved
+
+media_store = MediaStore(config.MEDIA_STORE_MAX_BYTES, config.MEDIA_STORE_GRACE_SECONDS)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import config
+import async_db
+from services.hot_cache import hot_cache
+from services import metrics
+
+CHECK_LIMIT = 100 # rows per user looked at by the deletion sweep
+
+class MessageBuffer:
+    """
+    Write-behind queue for cached_messages.
+
+    Rows from all UserBot clients are collected in memory and written with a
+    single executemany/commit every `max_rows` rows or `max_delay_ms`
+    milliseconds, whichever comes first. Every write and delete is mirrored
+    into the per-user hot tier, and reads try it and the buffer before SQLite,
+    so an edit arriving right after its original still finds it.
+    """
+
+    def __init__(self, max_rows: int = 200, max_delay_ms: int = 250):
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self.pending = {}   # (message_id, chat_id) -> row, not yet handed to the DB
+        self.inflight = {}  # rows currently being written
+        self._timer = None
+        self._flush_task = None
+        self._lock = asyncio.Lock()
+
+    def cache_message(self, message_id, chat_id, user_id, sender_id, content, sender_name, media_type=None, file_id=None, sender_username=None, chat_title=None, file_unique_id=None):
+        """Queue a row; same signature as database.cache_message (last write wins)."""
+        key = (message_id, chat_id)
+        self.pending.pop(key, None)
+        self.pending[key] = (message_id, chat_id, user_id, sender_id, content, sender_name, media_type, file_id, sender_username, chat_title, file_unique_id)
+        hot_cache.put(*self.pending[key])
+
+        if len(self.pending) >= self.max_rows:
+            self._schedule_flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.max_delay, self._schedule_flush)
+
+    def _schedule_flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        """Write everything queued so far in one transaction."""
+        async with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self.pending:
+                return
+            self.inflight, self.pending = self.pending, {}
+            try:
+                await async_db.cache_messages_bulk(list(self.inflight.values()))
+            except Exception as e:
+                logging.error(f"Cache flush failed ({len(self.inflight)} rows): {e}")
+                # Put rows back unless a newer version was queued meanwhile
+                for key, row in self.inflight.items():
+                    self.pending.setdefault(key, row)
+            finally:
+                self.inflight = {}
+
+        # Rows that arrived during the write get their own batch
+        if len(self.pending) >= self.max_rows:
+            self._schedule_flush()
+        elif self.pending and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._schedule_flush)
+
+    def get_buffered(self, message_id, chat_id):
+        key = (message_id, chat_id)
+        return self.pending.get(key) or self.inflight.get(key)
+
+    async def get_cached_message_content(self, message_id, chat_id):
+        """Read-your-writes version of database.get_cached_message_content."""
+        record = hot_cache.get(message_id, chat_id)
+        if record:
+            return record.content_row()
+        row = self.get_buffered(message_id, chat_id)
+        if row:
+            return (row[4], row[6], row[5], row[8], row[9]) # (content, media_type, name, username, title)
+        return await async_db.get_cached_message_content(message_id, chat_id)
+
+    async def get_messages_for_check(self, user_id):
+        """Newest CHECK_LIMIT rows of a user; served from the hot tier once it is warm."""
+        rows = hot_cache.recent(user_id, CHECK_LIMIT)
+        if rows is not None:
+            return rows
+        await self.flush()
+        discards = hot_cache.discards
+        rows = await async_db.get_messages_for_check(user_id, CHECK_LIMIT)
+        if hot_cache.discards == discards: # Nothing deleted while we read, safe to warm
+            hot_cache.load(user_id, rows, exhausted=len(rows) < CHECK_LIMIT)
+        return rows
+
+    async def get_cached_messages_by_ids(self, user_id, message_ids):
+        """Resolve a delete update; only ids the hot tier can't answer go to the DB."""
+        rows = [r.check_row() for r in hot_cache.find(user_id, message_ids)]
+        missing = set(message_ids) - {r[0] for r in rows}
+        if missing and user_id not in hot_cache.complete:
+            await self.flush()
+            rows += await async_db.get_cached_messages_by_ids(user_id, list(missing))
+        return rows
+
+    async def delete_cached_message(self, message_id, chat_id):
+        hot_cache.discard(message_id, chat_id)
+        self.pending.pop((message_id, chat_id), None)
+        if (message_id, chat_id) in self.inflight:
+            await self.flush()
+        await async_db.delete_cached_message(message_id, chat_id)
+
+    async def close(self):
+        """Flush-on-shutdown hook."""
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+message_buffer = MessageBuffer(config.CACHE_FLUSH_ROWS, config.CACHE_FLUSH_MS)
+metrics.Gauge("message_buffer_pending", "Cached messages waiting for the next DB flush", fn=lambda: len(message_buffer.pending))
+metrics.Gauge("hot_cache_messages", "Messages held in the in-memory hot tier", fn=lambda: len(hot_cache.index))
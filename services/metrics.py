@@ -0,0 +1,202 @@
+"""
+In-process metrics: counters, gauges and latency histograms.
+
+Everything is recorded on the event loop thread, so no locking is needed.
+`snapshot()` gives a picklable copy (shard workers ship it to the front-end
+with their stats) and `render()` produces the Prometheus text format served
+on METRICS_HOST:METRICS_PORT/metrics.
+"""
+import bisect
+import time
+import logging
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []       # registration order = output order
+extra_sources = []  # callables returning [(labels, snapshot)] from other processes (shard workers)
+
+def _key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _fmt_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _fmt_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.samples = {} # label key -> value
+        _metrics.append(self)
+
+    def collect(self):
+        return dict(self.samples)
+
+    def render_samples(self, samples, extra=()):
+        for key, value in samples.items():
+            yield f"{self.name}{_fmt_labels(key + extra)} {_fmt_value(value)}"
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _key(labels)
+        self.samples[key] = self.samples.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn=None):
+        super().__init__(name, help)
+        self.fn = fn
+
+    def set(self, value: float, **labels):
+        self.samples[_key(labels)] = value
+
+    def collect(self):
+        if self.fn is None:
+            return dict(self.samples)
+        try:
+            return {(): self.fn()}
+        except Exception as e:
+            logging.debug(f"Gauge {self.name} failed: {e}")
+            return {}
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        state = self.samples.get(_key(labels))
+        if state is None:
+            state = self.samples[_key(labels)] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def collect(self):
+        return {k: [list(v[0]), v[1], v[2]] for k, v in self.samples.items()}
+
+    def render_samples(self, samples, extra=()):
+        for key, (counts, total, count) in samples.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                yield f"{self.name}_bucket{_fmt_labels(key + extra + (('le', _fmt_value(float(bound))),))} {cumulative}"
+            yield f"{self.name}_sum{_fmt_labels(key + extra)} {total!r}"
+            yield f"{self.name}_count{_fmt_labels(key + extra)} {count}"
+
+def _everywhere(metric):
+    """Samples of a metric from this process and every extra source."""
+    samples = [metric.collect()]
+    for source in extra_sources:
+        try:
+            samples.extend(snap.get(metric.name, {}) for _, snap in source())
+        except Exception as e:
+            logging.error(f"Metrics source failed: {e}")
+    return samples
+
+def total(counter: Counter, **match):
+    """Sum of a counter over all processes and label sets containing `match`."""
+    want = set(_key(match))
+    return sum(v for samples in _everywhere(counter) for k, v in samples.items() if want <= set(k))
+
+def quantile(histogram: Histogram, q: float, **match):
+    """Estimated quantile (linear within a bucket) over all processes and matching label sets."""
+    want = set(_key(match))
+    counts = [0] * (len(histogram.buckets) + 1)
+    for samples in _everywhere(histogram):
+        for k, state in samples.items():
+            if want <= set(k):
+                counts = [a + b for a, b in zip(counts, state[0])]
+    rank, seen = q * sum(counts), 0
+    if not rank:
+        return None
+    for i, n in enumerate(counts):
+        if n and seen + n >= rank:
+            lower = histogram.buckets[i - 1] if i else 0.0
+            upper = histogram.buckets[min(i, len(histogram.buckets) - 1)]
+            return lower + (upper - lower) * (rank - seen) / n
+        seen += n
+    return histogram.buckets[-1]
+
+def snapshot():
+    """{metric name: samples}, picklable."""
+    return {m.name: m.collect() for m in _metrics}
+
+def render():
+    """Prometheus text exposition of this process plus every extra source."""
+    extra = []
+    for source in extra_sources:
+        try:
+            extra.extend(source())
+        except Exception as e:
+            logging.error(f"Metrics source failed: {e}")
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render_samples(metric.collect()))
+        for labels, snap in extra:
+            samples = snap.get(metric.name)
+            if samples:
+                lines.extend(metric.render_samples(samples, _key(labels)))
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+async def start_server(host: str, port: int):
+    """Serve GET /metrics; returns the aiohttp runner (call .cleanup() on shutdown)."""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"📈 Metrics on http://{host}:{port}/metrics")
+    return runner
+
+# --- UserBot pipeline ---
+messages_ingested = Counter("userbot_messages_total", "Private messages cached")
+edits_seen = Counter("userbot_edits_total", "Edited messages reported")
+secret_media = Counter("userbot_secret_media_total", "Self-destructing / protected media detected")
+deletions_found = Counter("userbot_deletions_total", "Deleted messages found, by source (update or sweep)")
+handler_seconds = Histogram("userbot_handler_seconds", "Pyrogram handler run time")
+sweep_seconds = Histogram("deletion_sweep_seconds", "Reconciliation sweep duration", buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+
+# --- Storage and delivery ---
+db_seconds = Histogram("db_call_seconds", "async_db call latency as seen by the loop (queue wait + execution)")
+send_seconds = Histogram("bot_send_seconds", "Bot API call latency")
+sends = Counter("bot_sends_total", "Bot API calls, by method and result")
+loop_lag_seconds = Histogram("event_loop_lag_seconds", "How late the loop watchdog's heartbeat woke up",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+loop_stalls = Counter("event_loop_stalls_total", "Heartbeats late by more than LOOP_WATCHDOG_MS")
+alert_seconds = Histogram("deletion_alert_seconds", "Deletion detected -> alert delivered to the user, by shard",
+                          buckets=(0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120, 300))
@@ -0,0 +1,162 @@
+import time
+import asyncio
+import itertools
+import logging
+from aiogram.exceptions import TelegramRetryAfter
+import config
+from loader import bot
+from services.rate_limit import TokenBucket
+from services import metrics
+from services.alert_trace import alert_trace, mark
+
+# Lower value = sent first
+PRIORITY_SECRET = 0
+PRIORITY_DELETION = 1
+PRIORITY_EDIT = 2
+PRIORITY_DEFAULT = 3
+
+MAX_MESSAGE_LEN = 4000
+MAX_RETRIES = 5
+
+class Notifier:
+    """
+    Central outbound queue for Bot API sends.
+
+    Respects the global (~30 msg/s) and per-chat (~1 msg/s) limits, retries on
+    429 using retry_after, and coalesces deletion alerts for the same chat that
+    arrive within a short window into one digest message.
+    """
+
+    def __init__(self, global_rate: float = 30, chat_interval: float = 1.0, digest_window: float = 2.0, workers: int = 8):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_interval = chat_interval
+        self.digest_window = digest_window
+        self.workers = workers
+        self.queue = None
+        self.parked = {}      # seq -> (timer, item): sends waiting in call_later for pacing or retry_after
+        self.next_slot = {}   # chat_id -> monotonic time of its next allowed send
+        self.digests = {}     # chat_id -> pending deletion alert texts
+        self._seq = itertools.count()
+        self._tasks = []
+        self.stats = {"sent": 0, "retries": 0, "failed": 0, "coalesced": 0}
+
+    def _ensure_started(self):
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, method: str, chat_id: int, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        """Queue a bot.<method>(chat_id, *args, **kwargs) call and return its future."""
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self._seq), [method, chat_id, args, kwargs, fut, 0]))
+        return fut
+
+    async def send(self, method: str, chat_id: int, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        """Queue a send and wait for it; raises whatever the final attempt raised."""
+        return await self.submit(method, chat_id, *args, priority=priority, **kwargs)
+
+    def deletion(self, chat_id: int, text: str, trace=None):
+        """Fire-and-forget deletion alert; bursts in one chat are merged into a digest."""
+        self._ensure_started()
+        mark(trace, "queued")
+        pending = self.digests.setdefault(chat_id, [])
+        pending.append((text, trace))
+        if len(pending) == 1:
+            asyncio.get_running_loop().call_later(self.digest_window, self._flush_digest, chat_id)
+        else:
+            self.stats["coalesced"] += 1
+
+    def _flush_digest(self, chat_id):
+        pending = self.digests.pop(chat_id, [])
+        if not pending: return
+        texts = [text for text, _ in pending]
+        traces = [trace for _, trace in pending if trace is not None]
+        if len(texts) == 1:
+            parts = texts
+        else:
+            parts, current = [], f"🗑 Удалено сообщений: {len(texts)}"
+            for text in texts:
+                if len(current) + len(text) + 2 > MAX_MESSAGE_LEN:
+                    parts.append(current); current = ""
+                current = f"{current}\n\n{text}" if current else text
+            parts.append(current)
+        for part in parts:
+            fut = self.submit("send_message", chat_id, part[:MAX_MESSAGE_LEN], priority=PRIORITY_DELETION)
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception()) # Failures are already logged by the worker
+        # The digest reaches the user with its last part
+        fut.add_done_callback(lambda f: [alert_trace.finish(t, ok=not f.cancelled() and f.exception() is None) for t in traces])
+
+    def _requeue(self, item, delay):
+        def put():
+            self.parked.pop(item[1], None)
+            self.queue.put_nowait(item)
+        self.parked[item[1]] = (asyncio.get_running_loop().call_later(max(0.0, delay), put), item)
+
+    async def _worker(self):
+        while True:
+            item = await self.queue.get()
+            priority, seq, job = item
+            method, chat_id, args, kwargs, fut, attempts = job
+            try:
+                if fut.done(): continue
+                now = time.monotonic()
+                wait = self.next_slot.get(chat_id, 0) - now
+                if wait > 0:
+                    self._requeue(item, wait) # Other chats keep flowing meanwhile
+                    continue
+                self.next_slot[chat_id] = now + self.chat_interval
+                await self.global_bucket.acquire()
+                started = time.perf_counter()
+                try:
+                    result = await getattr(bot, method)(chat_id, *args, **kwargs)
+                    self.stats["sent"] += 1
+                    metrics.send_seconds.observe(time.perf_counter() - started, method=method)
+                    metrics.sends.inc(method=method, result="ok")
+                    if not fut.done(): fut.set_result(result)
+                except TelegramRetryAfter as e:
+                    metrics.sends.inc(method=method, result="retry_after")
+                    job[5] += 1
+                    self.stats["retries"] += 1
+                    self.next_slot[chat_id] = time.monotonic() + e.retry_after
+                    if job[5] > MAX_RETRIES:
+                        self.stats["failed"] += 1
+                        if not fut.done(): fut.set_exception(e)
+                    else:
+                        logging.warning(f"429 for chat {chat_id}, retrying {method} in {e.retry_after}s")
+                        self._requeue(item, e.retry_after)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    metrics.sends.inc(method=method, result="error")
+                    logging.error(f"Notifier {method} to {chat_id} failed: {e}")
+                    if not fut.done(): fut.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def close(self, timeout: float = 10):
+        """Flush pending digests and give queued and parked sends a chance to go out."""
+        if self.queue is None: return
+        for chat_id in list(self.digests):
+            self._flush_digest(chat_id)
+        async def drain():
+            # join() alone returns while sends sit in call_later waiting for their chat's slot
+            while True:
+                await self.queue.join()
+                if not self.parked: return
+                await asyncio.sleep(0.05)
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Notifier closed with {self.queue.qsize() + len(self.parked)} sends still queued")
+        for task in self._tasks:
+            task.cancel()
+        # Whatever did not go out must not leave its caller waiting forever
+        for timer, item in self.parked.values():
+            timer.cancel()
+            item[2][4].cancel()
+        self.parked.clear()
+        while not self.queue.empty():
+            self.queue.get_nowait()[2][4].cancel()
+
+notifier = Notifier(config.NOTIFY_GLOBAL_RATE, config.NOTIFY_CHAT_INTERVAL, config.NOTIFY_DIGEST_WINDOW)
+metrics.Gauge("notifier_queue_size", "Bot API sends waiting in the notifier queue", fn=lambda: notifier.queue.qsize() if notifier.queue else 0)
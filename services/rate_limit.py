@@ -0,0 +1,108 @@
+import time
+import asyncio
+import contextlib
+import logging
+from pyrogram.errors import FloodWait
+import config
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ClientRateLimiter:
+    """
+    Paces Telegram API calls per UserBot client and per method class.
+
+    Method classes: "history" (get_messages), "raw" (client.invoke),
+    "download" (download_media). A FloodWait pauses only that client/class for
+    FloodWait.value seconds, after which the call is retried, so work is
+    deferred instead of dropped.
+    """
+
+    MAX_FLOOD_RETRIES = 3
+
+    def __init__(self, limits: dict):
+        self.limits = limits       # kind -> (rate per second, burst)
+        self.buckets = {}          # (user_id, kind) -> TokenBucket
+        self.blocked_until = {}    # (user_id, kind) -> monotonic deadline
+        self.flood_waits = 0
+
+    def _bucket(self, key):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            rate, burst = self.limits[key[1]]
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def call(self, user_id: int, kind: str, fn, *args, slots=(), **kwargs):
+        """
+        fn(*args, **kwargs), paced and retried on FloodWait. `slots` (the caller's
+        semaphores) are held only around the API call itself, never while this
+        client sits out a FloodWait, so a paused client doesn't block others.
+        """
+        key = (user_id, kind)
+        attempt = 0
+        while True:
+            wait = self.backoff(user_id, kind)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with contextlib.AsyncExitStack() as held:
+                for slot in slots:
+                    await held.enter_async_context(slot)
+                if self.backoff(user_id, kind) > 0:
+                    continue # another call of this client hit a FloodWait while we queued for a slot
+                await self._bucket(key).acquire()
+                try:
+                    return await fn(*args, **kwargs)
+                except FloodWait as e:
+                    self.flood_waits += 1
+                    seconds = int(getattr(e, "value", 0) or 1)
+                    self.blocked_until[key] = time.monotonic() + seconds
+                    if attempt == self.MAX_FLOOD_RETRIES:
+                        raise
+                    attempt += 1
+                    logging.warning(f"⏳ FloodWait {seconds}s for user {user_id} ({kind}), deferring call.")
+
+    def backoff(self, user_id: int, kind: str):
+        """Seconds left in a client/class FloodWait pause, 0 if none."""
+        return max(0.0, self.blocked_until.get((user_id, kind), 0) - time.monotonic())
+
+    def state(self, user_id: int = None):
+        """Current backoff per (user_id, kind): seconds left and tokens available."""
+        now = time.monotonic()
+        result = {}
+        for key, bucket in self.buckets.items():
+            if user_id is not None and key[0] != user_id: continue
+            bucket._refill()
+            result[key] = {
+                "backoff": round(max(0.0, self.blocked_until.get(key, 0) - now), 1),
+                "tokens": round(bucket.tokens, 2),
+            }
+        return result
+
+    def forget(self, user_id: int):
+        for key in [k for k in self.buckets if k[0] == user_id]:
+            self.buckets.pop(key, None)
+            self.blocked_until.pop(key, None)
+
+limiter = ClientRateLimiter({
+    "history": (config.RATE_HISTORY_PER_SEC, config.RATE_HISTORY_BURST),
+    "raw": (config.RATE_RAW_PER_SEC, config.RATE_RAW_BURST),
+    "download": (config.RATE_DOWNLOAD_PER_SEC, config.RATE_DOWNLOAD_BURST),
+})
@@ -0,0 +1,146 @@
+import os
+import time
+import asyncio
+import logging
+import config
+import async_db
+from services.message_buffer import message_buffer
+from services.userbot_manager import ub_manager
+
+DOWNLOADS_DIR = "downloads"
+CHUNK_SIZE = 500           # rows per DELETE transaction, keeps write locks short
+ORPHAN_GRACE_SECONDS = 3600 # files younger than this may still be on their way into the DB
+
+last_report = None
+
+def _local_path(file_id):
+    if file_id and str(file_id).startswith("LOCAL:"):
+        return str(file_id)[len("LOCAL:"):]
+    return None
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def _remove_file(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
+
+async def get_policy(user_id):
+    """(max_age_days, max_rows, max_bytes) for a user, config defaults filling unset limits."""
+    row = await async_db.get_retention_policy(user_id)
+    max_age, max_rows, max_bytes = row if row else (None, None, None)
+    return (
+        max_age if max_age is not None else config.RETENTION_MAX_AGE_DAYS,
+        max_rows if max_rows is not None else config.RETENTION_MAX_ROWS,
+        max_bytes if max_bytes is not None else config.RETENTION_MAX_BYTES,
+    )
+
+async def _delete_chunk(user_id, rows, report):
+    """rows: [(rowid, content_bytes, file_id, message_id, chat_id)] -> deletes rows and their local files."""
+    await async_db.delete_cached_rows([r[0] for r in rows])
+    report["rows"] += len(rows)
+    ub_manager.discard_cached(user_id, [(r[3], r[4]) for r in rows]) # with sharding, the owning worker's hot cache
+    for _, content_bytes, file_id, message_id, chat_id in rows:
+        report["bytes"] += content_bytes or 0
+        path = _local_path(file_id)
+        if path:
+            freed = await asyncio.to_thread(_remove_file, path)
+            if freed:
+                report["files"] += 1
+                report["bytes"] += freed
+
+async def prune_user(user_id: int, report: dict):
+    max_age, max_rows, max_bytes = await get_policy(user_id)
+
+    # 1. Max age
+    if max_age:
+        while True:
+            rows = await async_db.get_oldest_cached(user_id, CHUNK_SIZE, older_than_days=max_age)
+            if not rows: break
+            await _delete_chunk(user_id, rows, report)
+
+    # 2. Max rows
+    count, content_bytes = await async_db.get_cache_usage(user_id)
+    if max_rows and count > max_rows:
+        excess = count - max_rows
+        while excess > 0:
+            rows = await async_db.get_oldest_cached(user_id, min(CHUNK_SIZE, excess))
+            if not rows: break
+            await _delete_chunk(user_id, rows, report)
+            excess -= len(rows)
+
+    # 3. Max bytes (message text + locally saved media)
+    if max_bytes:
+        count, content_bytes = await async_db.get_cache_usage(user_id)
+        paths = [p for p in map(_local_path, await async_db.get_local_media_refs(user_id)) if p]
+        total = content_bytes + sum(await asyncio.to_thread(lambda: [_file_size(p) for p in paths]))
+        while total > max_bytes:
+            rows = await async_db.get_oldest_cached(user_id, CHUNK_SIZE)
+            if not rows: break
+            paths = [_local_path(row[2]) for row in rows]
+            sizes = await asyncio.to_thread(lambda: [_file_size(p) if p else 0 for p in paths])
+            chunk = []
+            for row, size in zip(rows, sizes):
+                chunk.append(row)
+                total -= (row[1] or 0) + size
+                if total <= max_bytes: break
+            await _delete_chunk(user_id, chunk, report)
+
+async def sweep_orphaned_files(report: dict):
+    """Remove files in downloads/ that no cached message references anymore."""
+    if not os.path.isdir(DOWNLOADS_DIR):
+        return
+    referenced = {os.path.abspath(p) for p in map(_local_path, await async_db.get_local_media_refs()) if p}
+    referenced |= {os.path.abspath(p) for p in (_local_path(r[7]) for r in list(message_buffer.pending.values()) + list(message_buffer.inflight.values())) if p}
+
+    def sweep():
+        removed, freed = 0, 0
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        for entry in os.scandir(DOWNLOADS_DIR):
+            if not entry.is_file(): continue
+            path = os.path.abspath(entry.path)
+            if path in referenced: continue
+            try:
+                if entry.stat().st_mtime > cutoff: continue
+            except OSError:
+                continue
+            size = _remove_file(path)
+            if size or not os.path.exists(path):
+                removed += 1
+                freed += size
+        return removed, freed
+
+    removed, freed = await asyncio.to_thread(sweep)
+    report["orphans"] += removed
+    report["bytes"] += freed
+
+async def run_retention():
+    """Scheduled job: apply per-user policies, prune legacy cache, sweep orphaned media."""
+    global last_report
+    started = time.monotonic()
+    report = {"rows": 0, "files": 0, "orphans": 0, "bytes": 0, "users": 0}
+    try:
+        await message_buffer.flush()
+        for user_id in await async_db.get_cached_user_ids():
+            await prune_user(user_id, report)
+            report["users"] += 1
+        await async_db.cleanup_old_messages(config.RETENTION_MAX_AGE_DAYS)
+        await sweep_orphaned_files(report)
+    except Exception as e:
+        logging.error(f"Retention run failed: {e}", exc_info=True)
+
+    report["seconds"] = round(time.monotonic() - started, 2)
+    last_report = report
+    logging.info(
+        f"🧹 Retention: {report['rows']} rows, {report['files'] + report['orphans']} files "
+        f"({report['orphans']} orphaned), {report['bytes'] / 1024 / 1024:.1f} MB reclaimed "
+        f"across {report['users']} users in {report['seconds']}s"
+    )
+    return report
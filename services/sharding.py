@@ -0,0 +1,308 @@
+"""
+Multi-process sharding of UserBot clients.
+
+With USERBOT_SHARDS > 1 the aiogram front-end no longer runs Pyrogram clients
+itself. Each worker process owns a partition of user_ids (user_id % shards),
+runs its own UserBotManager, event loop and reconciliation sweep, and receives
+start/stop commands over a multiprocessing queue. Bot API calls made by the
+worker (alerts, restored media) are relayed back to the front-end, whose
+notifier owns the only aiogram Bot session and the global send limits.
+
+If a worker dies it is restarted and its users are replayed to it; a shard
+that keeps crashing is disabled and its users are spread over the survivors.
+"""
+import asyncio
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import random
+import time
+import config
+from services import metrics
+
+RESTART_WINDOW_SECONDS = 300
+MAX_RESTARTS_PER_WINDOW = 3
+MONITOR_INTERVAL_SECONDS = 5
+RELAY_FILE_GRACE_SECONDS = 60
+
+# --- Worker side ---
+
+class NotifierRelay:
+    """Stand-in for services.notifier inside a worker: sends are queued by the front-end's notifier."""
+
+    def __init__(self, shard_id, events):
+        self.shard_id = shard_id
+        self.events = events
+        self.pending = {}
+        self._ids = itertools.count()
+
+    async def send(self, method, chat_id, *args, priority=None, **kwargs):
+        args = [_portable(a) for a in args]
+        kwargs = {k: _portable(v) for k, v in kwargs.items()}
+        call_id = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[call_id] = fut
+        self.events.put(("send", self.shard_id, call_id, method, chat_id, args, priority, kwargs))
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # Callers delete their file once send() returns; the front-end may still be reading it
+            if any(_is_file(v) for v in (*args, *kwargs.values())):
+                try: await asyncio.wait_for(asyncio.shield(fut), RELAY_FILE_GRACE_SECONDS)
+                except BaseException: pass
+            self.pending.pop(call_id, None)
+            raise
+
+    def submit(self, method, chat_id, *args, priority=None, **kwargs):
+        """Fire-and-forget counterpart of send(), like notifier.submit."""
+        return asyncio.ensure_future(self.send(method, chat_id, *args, priority=priority, **kwargs))
+
+    def deletion(self, chat_id, text, trace=None):
+        if trace is not None:
+            trace["shard"] = self.shard_id
+        self.events.put(("deletion", self.shard_id, chat_id, text, trace))
+
+    def resolve(self, call_id, ok, payload):
+        fut = self.pending.pop(call_id, None)
+        if fut and not fut.done():
+            if ok: fut.set_result(payload)
+            else: fut.set_exception(RuntimeError(payload))
+
+def _is_file(value):
+    from aiogram.types import FSInputFile
+    return isinstance(value, FSInputFile)
+
+def _portable(value):
+    """
+    Files go to the front-end by path, not by content: both processes share
+    the disk, and a restored video can be hundreds of MB. The caller removes
+    the file only after send() returns, i.e. once the front-end has sent it.
+    """
+    from aiogram.types import FSInputFile
+    if _is_file(value):
+        path = os.path.abspath(value.path) # the front-end may not share our cwd
+        return FSInputFile(path, filename=value.filename or os.path.basename(path), chunk_size=value.chunk_size)
+    return value
+
+async def _boot(manager, sem, user_id, session_string):
+    async with sem:
+        await asyncio.sleep(random.uniform(0, config.BOOT_JITTER_SECONDS))
+        await manager.start_client(user_id, session_string)
+
+def _worker_main(shard_id, commands, events):
+    logging.basicConfig(level=logging.INFO, format=f"[shard {shard_id}] %(levelname)s:%(name)s:%(message)s")
+    try:
+        asyncio.run(_worker_loop(shard_id, commands, events))
+    except KeyboardInterrupt:
+        pass
+
+async def _worker_loop(shard_id, commands, events):
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+    import async_db
+    import services.userbot_manager as userbot_manager
+    from services.message_buffer import message_buffer
+    from services.hot_cache import hot_cache
+    from services.loop_watchdog import loop_watchdog
+
+    relay = NotifierRelay(shard_id, events)
+    userbot_manager.notifier = relay # alerts go out through the front-end's rate-limited notifier
+    manager = userbot_manager.ub_manager
+
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(manager.check_deleted_messages, "interval", seconds=config.DELETION_RECONCILE_SECONDS, max_instances=1)
+    scheduler.start()
+    if config.LOOP_WATCHDOG_MS:
+        loop_watchdog.start()
+
+    boot_sem = asyncio.Semaphore(config.BOOT_PARALLELISM)
+    loop = asyncio.get_running_loop()
+    events.put(("ready", shard_id))
+    logging.info(f"Shard {shard_id} ready (pid {os.getpid()})")
+
+    while True:
+        try:
+            cmd = await loop.run_in_executor(None, commands.get, True, 1.0)
+        except queue.Empty:
+            continue
+        kind = cmd[0]
+        if kind == "start":
+            _, user_id, session_string = cmd
+            asyncio.create_task(_boot(manager, boot_sem, user_id, session_string))
+        elif kind == "stop":
+            asyncio.create_task(manager.stop_client(cmd[1]))
+        elif kind == "result":
+            relay.resolve(*cmd[1:])
+        elif kind == "discard":
+            for message_id, chat_id in cmd[1]:
+                hot_cache.discard(message_id, chat_id)
+        elif kind == "stats":
+            events.put(("stats", shard_id, {**manager.stats(), "metrics": metrics.snapshot()}))
+        elif kind == "shutdown":
+            break
+
+    scheduler.shutdown(wait=False)
+    await loop_watchdog.stop()
+    for user_id in list(manager.clients):
+        await manager.stop_client(user_id)
+    await message_buffer.close()
+    await async_db.shutdown()
+
+# --- Front-end side ---
+
+class ShardRouter:
+    """Owns the worker processes and routes users to them."""
+
+    def __init__(self, shards: int):
+        self.shards = shards
+        self.ctx = mp.get_context("spawn")
+        self.events = self.ctx.Queue()
+        self.procs = [None] * shards
+        self.commands = [None] * shards
+        self.disabled = set()
+        self.restarts = {i: [] for i in range(shards)}
+        self.sessions = {}  # user_id -> session_string (everything that should be running)
+        self.owner = {}     # user_id -> shard_id
+        self.stats = {}     # shard_id -> last stats reported by the worker
+        self._tasks = []
+        metrics.extra_sources.append(lambda: [({"shard": sid}, st.get("metrics", {})) for sid, st in sorted(self.stats.items())])
+
+    def _spawn(self, shard_id):
+        self.commands[shard_id] = self.ctx.Queue()
+        proc = self.ctx.Process(target=_worker_main, args=(shard_id, self.commands[shard_id], self.events),
+                                name=f"userbot-shard-{shard_id}", daemon=True)
+        proc.start()
+        self.procs[shard_id] = proc
+        logging.info(f"🧩 Started UserBot shard {shard_id} (pid {proc.pid})")
+
+    async def start(self):
+        for shard_id in range(self.shards):
+            self._spawn(shard_id)
+        self._tasks = [asyncio.create_task(self._pump_events()), asyncio.create_task(self._monitor())]
+
+    def _alive_shards(self):
+        return [i for i in range(self.shards) if i not in self.disabled]
+
+    def _pick_shard(self, user_id):
+        alive = self._alive_shards()
+        home = user_id % self.shards
+        if home in alive:
+            return home
+        # Home shard disabled: least-loaded survivor
+        loads = {i: 0 for i in alive}
+        for owner in self.owner.values():
+            if owner in loads: loads[owner] += 1
+        return min(loads, key=loads.get)
+
+    async def start_client(self, user_id: int, session_string: str):
+        if not self._alive_shards():
+            logging.error(f"No UserBot shards alive, cannot start {user_id}")
+            return False
+        shard_id = self._pick_shard(user_id)
+        self.sessions[user_id] = session_string
+        self.owner[user_id] = shard_id
+        self.commands[shard_id].put(("start", user_id, session_string))
+        return True
+
+    async def stop_client(self, user_id: int):
+        self.sessions.pop(user_id, None)
+        shard_id = self.owner.pop(user_id, None)
+        if shard_id is not None and self.commands[shard_id] is not None:
+            self.commands[shard_id].put(("stop", user_id))
+
+    def discard_cached(self, user_id: int, keys):
+        """Drop (message_id, chat_id) pairs from the hot cache of the worker that owns user_id."""
+        shard_id = self.owner.get(user_id)
+        if shard_id is not None and self.commands[shard_id] is not None:
+            self.commands[shard_id].put(("discard", keys))
+
+    async def _pump_events(self):
+        from services.notifier import notifier, PRIORITY_DEFAULT
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                event = await loop.run_in_executor(None, self.events.get, True, 1.0)
+            except queue.Empty:
+                continue
+            kind = event[0]
+            if kind == "send":
+                _, shard_id, call_id, method, chat_id, args, priority, kwargs = event
+                fut = notifier.submit(method, chat_id, *args, priority=PRIORITY_DEFAULT if priority is None else priority, **kwargs)
+                fut.add_done_callback(lambda f, s=shard_id, c=call_id: self._reply(s, c, f))
+            elif kind == "deletion":
+                notifier.deletion(event[2], event[3], trace=event[4])
+            elif kind == "stats":
+                self.stats[event[1]] = event[2]
+            elif kind == "ready":
+                logging.info(f"🧩 Shard {event[1]} ready")
+
+    def _reply(self, shard_id, call_id, fut):
+        if fut.cancelled(): # notifier closed before the send went out
+            ok, payload = False, "CancelledError: notifier closed"
+        elif fut.exception():
+            e = fut.exception()
+            ok, payload = False, f"{type(e).__name__}: {e}"
+        else:
+            ok, payload = True, None
+            try:
+                pickle.dumps(fut.result())
+                payload = fut.result()
+            except Exception:
+                pass
+        commands = self.commands[shard_id]
+        if commands is not None:
+            commands.put(("result", call_id, ok, payload))
+
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(MONITOR_INTERVAL_SECONDS)
+            for shard_id in self._alive_shards():
+                proc = self.procs[shard_id]
+                if proc.is_alive():
+                    self.commands[shard_id].put(("stats",))
+                    continue
+                logging.error(f"💥 UserBot shard {shard_id} died (exit code {proc.exitcode})")
+                self._handle_dead(shard_id)
+
+    def _handle_dead(self, shard_id):
+        now = time.monotonic()
+        recent = [t for t in self.restarts[shard_id] if now - t < RESTART_WINDOW_SECONDS]
+        self.restarts[shard_id] = recent + [now]
+        users = [uid for uid, owner in self.owner.items() if owner == shard_id]
+
+        if len(recent) < MAX_RESTARTS_PER_WINDOW:
+            self._spawn(shard_id)
+            for uid in users:
+                self.commands[shard_id].put(("start", uid, self.sessions[uid]))
+            logging.info(f"🧩 Shard {shard_id} restarted, replayed {len(users)} sessions")
+            return
+
+        # Crash loop: give up on this shard and rebalance its users
+        self.disabled.add(shard_id)
+        self.commands[shard_id] = None
+        self.stats.pop(shard_id, None)
+        for uid in users:
+            self.owner.pop(uid, None)
+        for uid in users:
+            new_shard = self._pick_shard(uid) if self._alive_shards() else None
+            if new_shard is None: break
+            self.owner[uid] = new_shard
+            self.commands[new_shard].put(("start", uid, self.sessions[uid]))
+        logging.error(f"🧩 Shard {shard_id} disabled after repeated crashes, moved {len(users)} sessions")
+
+    def client_count(self):
+        return sum(s.get("clients", 0) for s in self.stats.values())
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for shard_id in self._alive_shards():
+            if self.commands[shard_id] is not None:
+                self.commands[shard_id].put(("shutdown",))
+        for proc in self.procs:
+            if proc is None: continue
+            await asyncio.to_thread(proc.join, 10)
+            if proc.is_alive():
+                proc.terminate()
@@ -1,41 +1,141 @@
 import logging
 import asyncio
 import os
+import time
+import random
 import datetime
+from collections import OrderedDict
 from pyrogram import Client, enums, raw
 from pyrogram.types import Message as PyMessage
-from aiogram.types import FSInputFile
+from aiogram.types import FSInputFile, BufferedInputFile
 import config
-import database
-from loader import bot
+import async_db
+from services.message_buffer import message_buffer
+from services.hot_cache import hot_cache
+from services.rate_limit import limiter
+from services.downloads import downloads
+from services.media_store import media_store
+from services.notifier import notifier, PRIORITY_SECRET, PRIORITY_DELETION, PRIORITY_EDIT
+from services import metrics
+from services.alert_trace import alert_trace, mark
+
+TTL_MEDIA = ("photo", "video", "voice", "video_note", "audio", "document")
+
+try:
+    BOT_ID = int(config.BOT_TOKEN.split(":")[0]) # Messages from our own bot are never cached
+except (AttributeError, ValueError):
+    BOT_ID = 0
+
+SECRET_EXT = {"voice": ".ogg", "video_note": ".mp4", "photo": ".jpg", "video": ".mp4"}
+
+def _bot_file_id(sent_msg):
+    """file_id of the media inside a message the bot just sent (largest size for photos)"""
+    if sent_msg is None: return None
+    for attr in ("photo", "video", "voice", "video_note", "document", "audio", "animation", "sticker"):
+        media = getattr(sent_msg, attr, None)
+        if media:
+            if isinstance(media, list): media = media[-1]
+            return getattr(media, "file_id", None)
+    return None
+
+def _secret_flags(message):
+    """
+    (is_protected, has_ttl) from the parsed fields only: protected content,
+    a self-destruct timer or view-once on the message or its media object.
+    """
+    is_protected = bool(getattr(message, "has_protected_content", False))
+    if getattr(message, "ttl_seconds", None) or getattr(message, "view_once", False):
+        return is_protected, True
+    media = getattr(message, "media", None)
+    attrs = (media.value,) if isinstance(media, enums.MessageMediaType) else TTL_MEDIA
+    for attr in attrs:
+        obj = getattr(message, attr, None)
+        if obj is not None and (getattr(obj, "ttl_seconds", None) or getattr(obj, "view_once", False)):
+            return is_protected, True
+    return is_protected, False
+
+def _is_active(expiry):
+    """sub_expiry is stored either as a unix timestamp or an ISO string"""
+    if not expiry: return False
+    try:
+        try:
+            ts = float(expiry)
+        except (ValueError, TypeError):
+            ts = datetime.datetime.fromisoformat(str(expiry)).timestamp()
+        return ts > time.time()
+    except Exception:
+        return False
 
 class UserBotManager:
     def __init__(self):
         self.clients = {} # user_id -> Client
         self.is_running = False
+        self.boot_progress = {"total": 0, "started": 0, "failed": 0}
+        self.bg_tasks = {} # user_id -> set of background tasks (media relay, deletion restore)
+        self.shards = None # ShardRouter when clients run in worker processes (services/sharding.py)
+        self._reported = OrderedDict() # (user_id, chat_id, message_id) already alerted, bounded
+        self._sweep_lock = asyncio.Lock()
+        self.sweep_stats = {"runs": 0, "last_duration": 0.0, "max_duration": 0.0, "timeouts": 0, "skipped_overlaps": 0, "last_run": None}
+
+    def use_shards(self, router):
+        """Front-end mode: clients live in shard workers, this manager only routes commands"""
+        self.shards = router
+
+    def discard_cached(self, user_id: int, keys):
+        """Drop rows deleted behind the write buffer's back (retention) from the hot cache that holds them"""
+        for message_id, chat_id in keys:
+            hot_cache.discard(message_id, chat_id)
+        if self.shards:
+            self.shards.discard_cached(user_id, keys)
+
+    def stats(self):
+        """This process's client, sweep, FloodWait and hot cache figures (shard workers send them to the front-end)"""
+        return {
+            "clients": len(self.clients),
+            "sweep": self.sweep_stats,
+            "flood_waits": limiter.flood_waits,
+            "backoffs": {key: st["backoff"] for key, st in limiter.state().items() if st["backoff"]}, # (user_id, kind) -> seconds left
+            "hot_cache": {"entries": len(hot_cache.index), "hits": hot_cache.hits, "misses": hot_cache.misses},
+        }
 
     async def start(self):
-        """Load all sessions from DB and start them"""
+        """Load all sessions from DB and start them concurrently (active subscribers first)"""
         if self.is_running: return
+        self.is_running = True
         
-        sessions = database.get_all_sessions()
-        logging.info(f"UserBotManager: Found {len(sessions)} sessions.")
+        sessions = await async_db.get_all_sessions_with_expiry()
+        sessions = [row for row in sessions if row[1]]
+        # Paying users get their deletion coverage back first
+        sessions.sort(key=lambda row: not _is_active(row[2]))
+        total = len(sessions)
         
-        for row in sessions:
-            if len(row) == 2:
-                user_id, session_string = row
-            else:
-                 user_id = row[0]
-                 session_string = row[1] if len(row) > 1 else None
-
-            if session_string:
-                await self.start_client(user_id, session_string)
+        if self.shards: # Workers pace their own logins
+            for row in sessions: await self.start_client(row[0], row[1])
+            logging.info(f"UserBotManager: Routed {total} sessions to {self.shards.shards} shards.")
+            return
+        logging.info(f"UserBotManager: Found {total} sessions, starting {config.BOOT_PARALLELISM} at a time.")
         
-        self.is_running = True
+        sem = asyncio.Semaphore(config.BOOT_PARALLELISM)
+        self.boot_progress = {"total": total, "started": 0, "failed": 0}
+        started_at = time.monotonic()
+        
+        async def boot(user_id, session_string):
+            async with sem:
+                # Jitter spreads reconnects so we don't hit Telegram with N logins in the same instant
+                await asyncio.sleep(random.uniform(0, config.BOOT_JITTER_SECONDS))
+                ok = await self.start_client(user_id, session_string)
+            self.boot_progress["started" if ok else "failed"] += 1
+            done = self.boot_progress["started"] + self.boot_progress["failed"]
+            if done == total or done % max(1, total // 10) == 0:
+                logging.info(f"🚀 Boot progress: {done}/{total} ({self.boot_progress['failed']} failed) in {time.monotonic() - started_at:.1f}s")
+        
+        await asyncio.gather(*(boot(row[0], row[1]) for row in sessions))
 
     async def start_client(self, user_id: int, session_string: str):
+        if self.shards:
+            return await self.shards.start_client(user_id, session_string)
         if user_id in self.clients:
-            return
+            return True
         
         try:
             # USE OFFICIAL ANDROID KEYS FOR MAXIMUM TRUST (REQUIRED FOR VIEW-ONCE)
@@ -57,6 +157,7 @@ class UserBotManager:
             await client.start()
             self.clients[user_id] = client
             logging.info(f"UserBot for user {user_id} started.")
+            return True
             
             # Send alive message to self (silent check)
             try:
@@ -66,9 +167,16 @@ class UserBotManager:
             
         except Exception as e:
             logging.error(f"Failed to start UserBot for {user_id}: {e}")
+            return False
 
     async def stop_client(self, user_id: int):
+        if self.shards:
+            return await self.shards.stop_client(user_id)
         client = self.clients.pop(user_id, None)
+        for task in list(self.bg_tasks.pop(user_id, ())): task.cancel()
+        downloads.cancel_user(user_id)
+        limiter.forget(user_id)
+        hot_cache.drop_user(user_id)
         if client:
             try:
                 await client.stop()
@@ -78,16 +186,15 @@ class UserBotManager:
         
         @client.on_message()
         async def py_on_message(c, message: PyMessage):
+            started = time.perf_counter()
+            received_at = time.time()
             try:
                 # 1. Self & Bot Ignore
                 if message.from_user and message.from_user.is_self: return
                 if client.me and message.from_user and message.from_user.id == client.me.id: return
                 
-                try:
-                    bot_id = int(config.BOT_TOKEN.split(':')[0])
-                    if message.chat.id == bot_id or (message.from_user and message.from_user.id == bot_id):
-                        return
-                except: pass
+                if message.chat.id == BOT_ID or (message.from_user and message.from_user.id == BOT_ID):
+                    return
 
                 # 2. Filter: Only Private Chats
                 if message.chat.type != enums.ChatType.PRIVATE:
@@ -96,24 +203,8 @@ class UserBotManager:
                 # 3. Data Extraction Helpers
                 def get_fid(obj): return getattr(obj, "file_id", None)
                 
-                # Pre-calculate flags
-                is_protected = getattr(message, "has_protected_content", False)
-                has_ttl = False
-                
-                # Check for TTL/View-Once at top level
-                if hasattr(message, 'ttl_seconds') and message.ttl_seconds: 
-                    has_ttl = True
-                
-                # Deep attribute check for TTL in sub-objects
-                for attr in ['photo', 'video', 'voice', 'video_note', 'audio', 'document']:
-                    obj = getattr(message, attr, None)
-                    if obj:
-                        # Check for timer (photo/video/voice/video_note)
-                        if getattr(obj, "ttl_seconds", None):
-                            has_ttl = True; break
-                        # Check for explicit view_once (some API versions)
-                        if getattr(obj, "view_once", False):
-                            has_ttl = True; break
+                # Protected / self-destructing (timer or view-once) media
+                is_protected, has_ttl = _secret_flags(message)
 
                 # Extract basic info
                 s_id = message.from_user.id if message.from_user else 0
@@ -151,19 +242,19 @@ class UserBotManager:
                 if (not message.text and not media_type) or is_unsupported:
                     await asyncio.sleep(1.5) # Wait for media to settle
                     try:
-                        message = await client.get_messages(message.chat.id, message.id)
+                        message = await limiter.call(user_id, "history", client.get_messages, message.chat.id, message.id)
                         
                         # RAW INVOKE for View-Once detection if high-level fails
                         try:
-                            raw_res = await client.invoke(
+                            raw_res = await limiter.call(user_id, "raw", client.invoke,
                                 raw.functions.messages.GetMessages(id=[raw.types.InputMessageID(id=message.id)])
                             )
                             if hasattr(raw_res, "messages") and raw_res.messages:
-                                has_ttl = has_ttl or getattr(raw_res.messages[0].media, "ttl_seconds", 0) > 0
+                                has_ttl = has_ttl or bool(getattr(raw_res.messages[0].media, "ttl_seconds", None))
                         except: pass
 
-                        is_protected = getattr(message, "has_protected_content", False)
-                        has_ttl = has_ttl or getattr(message, "ttl_seconds", 0) > 0
+                        is_protected, refetched_ttl = _secret_flags(message)
+                        has_ttl = has_ttl or refetched_ttl
                         
                         if not media_type:
                             if message.photo: media_type = "photo"; file_id = get_fid(message.photo); content = content or "[Фотография]"
@@ -172,142 +263,44 @@ class UserBotManager:
                     except Exception as refetch_e:
                         logging.error(f"Refetch failed: {refetch_e}")
 
-                logging.info(f"📩 Private Message from {s_id}: Type={media_type} Secret={has_ttl or is_protected}")
+                logging.debug(f"📩 Private Message from {s_id}: Type={media_type} protected={is_protected} ttl={has_ttl}")
 
-                logging.info(f"📩 Private Message from {s_id}: Type={media_type}")
-                logging.info(f"🕵️ Detection Result: is_protected={is_protected}, has_ttl={has_ttl}")
-                
-                # Enhanced debug for all non-text messages
-                if not message.text:
-                    if getattr(message, "media", None):
-                        logging.info(f"DEBUG: Media object: {message.media}")
-                    try:
-                        logging.info(f"FULL MESSAGE DATA: {message}")
+                # Full object dumps serialize the whole message; only a sample, and only when asked for
+                if config.MESSAGE_DUMP_SAMPLE and not message.text and random.random() < config.MESSAGE_DUMP_SAMPLE:
+                    try: logging.info(f"FULL MESSAGE DATA (sampled): {message}")
                     except: pass
 
-                # --- 1. IMMEDIATE SAVE FOR SECRET MEDIA (Priority) ---
-                if is_protected or has_ttl:
-                    try:
-                        logging.info(f"🔒 Secret media {message.id} detected. Downloading IMMEDIATELY...")
-                        os.makedirs("downloads", exist_ok=True)
-                        path = await client.download_media(message)
-                        if path:
-                            file_id = f"LOCAL:{path}" # Update file_id for database
-                            logging.info(f"✅ Secret media saved to disk: {path}")
-                    except Exception as dl_e:
-                        logging.error(f"Immediate download failed: {dl_e}")
+                # Same for a file in every chat; keys the bot's file_id cache and the media store
+                file_unique_id = getattr(getattr(message, media_type, None), "file_unique_id", None) if media_type else None
 
-                # --- 2. CACHE TO DATABASE ---
+                # --- 1. CACHE TO DATABASE ---
                 try:
-                    database.cache_message(
+                    message_buffer.cache_message(
                         message.id, message.chat.id, user_id, s_id, 
                         content, s_name, media_type, file_id, s_username, 
-                        message.chat.title or "Личный чат"
+                        message.chat.title or "Личный чат", file_unique_id
                     )
+                    metrics.messages_ingested.inc()
+                    alert_trace.received(user_id, message.chat.id, message.id, received_at)
                 except Exception as db_e:
                     logging.error(f"DB Cache Error: {db_e}")
-
-                # --- 3. KEYWORD DUMP CHECK (Fallback) ---
-                if not has_ttl:
-                    try:
-                        dump = str(message).lower()
-                        if any(k in dump for k in ["ttl", "view", "once", "expire"]):
-                            has_ttl = True
-                    except: pass
             
-                # --- 4. DOWNLOAD AND FORWARD SECRET MEDIA ---
+                # --- 2. RELAY SECRET MEDIA (one download, no temp files) ---
                 if is_protected or has_ttl:
-                    logging.info(f"🔒 Secret Media Detected! Attempting download...")
-                    
-                    content_secret = f"[🔐 Секретное медиа ({media_type or 'Файл'})] {content} (Сгорающее)"
-                    
-                    # Attempt Download with Safe Wrapper
-                    file_path = None
-                    # If file_id was already set to LOCAL:path by immediate save, use that
-                    if file_id and str(file_id).startswith("LOCAL:"):
-                        file_path = str(file_id).replace("LOCAL:", "")
-                        if not os.path.exists(file_path):
-                            logging.warning(f"Immediate saved file {file_path} not found. Attempting re-download.")
-                            file_path = None # Reset to attempt re-download
-                    
-                    if not file_path: # Only attempt download if not already saved
-                        try:
-                            logging.info(f"Step 1: Attempting RAM download for {media_type}...")
-                            try:
-                               file_bytes = await client.download_media(message, in_memory=True)
-                               if file_bytes:
-                                   logging.info(f"Step 2: RAM download successful. Type of data: {type(file_bytes)}")
-                                   ts = int(datetime.datetime.now().timestamp())
-                                   ext = ".bin"
-                                   if media_type == "voice": ext = ".ogg"
-                                   elif media_type == "video_note": ext = ".mp4"
-                                   elif media_type == "photo": ext = ".jpg"
-                                   elif media_type == "video": ext = ".mp4"
-                                   
-                                   os.makedirs("downloads", exist_ok=True)
-                                   fname = f"downloads/secret_{ts}{ext}"
-                                   manual_path = os.path.abspath(fname)
-                                   
-                                   logging.info(f"Step 3: Writing to file: {manual_path}")
-                                   with open(manual_path, "wb") as f:
-                                       if hasattr(file_bytes, "getbuffer"): f.write(file_bytes.getbuffer())
-                                       elif hasattr(file_bytes, "read"): f.write(file_bytes.read())
-                                       else: f.write(file_bytes)
-                                   
-                                   if os.path.exists(manual_path):
-                                       file_path = manual_path
-                                       logging.info(f"Step 4: File successfully created at {file_path}")
-                                   else:
-                                       logging.error(f"Step 4 ERROR: File was not created at {manual_path}!")
-                               else:
-                                   logging.warning("Step 2: RAM download returned None.")
-                            except Exception as ram_e:
-                               logging.warning(f"RAM download error: {ram_e}")
-                               
-                            # Priority 2: Standard Download if RAM failed
-                            if not file_path:
-                                logging.info(f"Step 5: Falling back to standard download...")
-                                file_path = await message.download()
-                                if file_path:
-                                    logging.info(f"Step 6: Standard download successful saved to {file_path}")
-                                else:
-                                    logging.error("Step 6: Standard download returned None.")
-
-                        except Exception as dl_e:
-                            logging.error(f"CRITICAL Download error: {dl_e}", exc_info=True)
-
-                    if file_path:
-                        user_tag = f"@{s_username}" if s_username else s_name
-                        caption = f"🔐 Секретное медиа от {user_tag}\n📁 Чат: {message.chat.title or 'Личный'}"
-                        try:
-                            inp = FSInputFile(file_path)
-                            sent_msg = None
-                            caption = f"🔐 Секретное медиа от {s_name} (@{s_username if s_username else 'None'})\n📁 Чат: {message.chat.title or 'Личный'}"
-                            
-                            is_voice = (media_type == "voice") or str(file_path).endswith(".ogg")
-                            is_video_note = (media_type == "video_note") or (str(file_path).endswith(".mp4") and "video_note" in str(file_path))
-                            
-                            if is_voice: sent_msg = await bot.send_voice(user_id, inp, caption=caption)
-                            elif is_video_note: sent_msg = await bot.send_video_note(user_id, inp); await bot.send_message(user_id, caption)
-                            elif media_type == "photo": sent_msg = await bot.send_photo(user_id, inp, caption=caption)
-                            elif media_type == "video": sent_msg = await bot.send_video(user_id, inp, caption=caption)
-                            else: sent_msg = await bot.send_document(user_id, inp, caption=caption)
-                        except Exception as send_e:
-                             logging.error(f"Error during bot send: {send_e}")
-                             try: await client.send_document("me", file_path, caption=f"Fallback save: {caption}")
-                             except: pass
-
-                        if os.path.exists(file_path): os.remove(file_path)
-                    else:
-                        try: await bot.send_message(user_id, f"👀 Замечено секретное медиа ({media_type}), но Telegram не дал его скачать.")
-                        except: pass
+                    metrics.secret_media.inc()
+                    logging.info(f"🔒 Secret media {message.id} detected. Relaying in background...")
+                    row = (message.id, message.chat.id, user_id, s_id, content, s_name, media_type, None, s_username, message.chat.title or "Личный чат", file_unique_id)
+                    self._spawn(user_id, self._relay_and_cache(client, user_id, message, row))
 
             except Exception as global_e:
                 logging.error(f"CRITICAL ERROR in py_on_message: {global_e}", exc_info=True)
+            finally:
+                metrics.handler_seconds.observe(time.perf_counter() - started, handler="message")
 
 
         @client.on_edited_message()
         async def py_on_edit(c, message: PyMessage):
+            started = time.perf_counter()
             try:
                 if message.from_user and message.from_user.is_self: return
                 if message.chat.type != enums.ChatType.PRIVATE: return
@@ -315,7 +308,7 @@ class UserBotManager:
                 new_text = message.text or message.caption or ""
                 if not new_text: new_text = "[Медиа]"
                 
-                old_data = database.get_cached_message_content(message.id, message.chat.id)
+                old_data = await message_buffer.get_cached_message_content(message.id, message.chat.id)
                 if old_data:
                     old_text = old_data[0] if old_data else ""
                     
@@ -323,101 +316,280 @@ class UserBotManager:
                          s_name = message.from_user.first_name if message.from_user else "Unknown"
                          alert = (f"✏️ Сообщение изменено!\n👤 {s_name}\n"
                                   f"📜 Было: {old_text}\n🆕 Стало: {new_text}")
-                         try: await bot.send_message(user_id, alert)
-                         except: pass
+                         metrics.edits_seen.inc()
+                         # Queued, not awaited: per-chat pacing must not hold up this handler
+                         notifier.submit("send_message", user_id, alert, priority=PRIORITY_EDIT).add_done_callback(lambda f: f.cancelled() or f.exception())
                 
                 # Update cache
                 # We need sender info again
                 s_name = message.from_user.first_name if message.from_user else "Unknown"
                 s_id = message.from_user.id if message.from_user else 0
-                database.cache_message(
+                message_buffer.cache_message(
                     message.id, message.chat.id, user_id, s_id, 
                     new_text, s_name, None, None, message.from_user.username, 
                     "Личный чат"
                 )
             except Exception as e:
                 logging.error(f"Edit Handler Error: {e}")
+            finally:
+                metrics.handler_seconds.observe(time.perf_counter() - started, handler="edit")
+
+        @client.on_deleted_messages()
+        async def py_on_deleted(c, messages):
+            """Real-time path: resolve Telegram's delete update against our cached message ids"""
+            started = time.perf_counter()
+            detected_at = time.time()
+            try:
+                # Private-chat deletions carry only ids; channel ones also carry the chat
+                chat_of = {m.id: (m.chat.id if m.chat else None) for m in messages}
+                rows = await message_buffer.get_cached_messages_by_ids(user_id, list(chat_of.keys()))
+                if not rows: return
 
-    async def check_deleted_messages(self):
-        """Periodically check if cached messages still exist"""
-        try:
-            for user_id, client in self.clients.items():
-                if not client.is_connected: continue
-                
-                cached_msgs = database.get_messages_for_check(user_id)
-                if not cached_msgs: continue
-                
-                # Get exclusions
                 try:
-                     excluded = [r[0] for r in database.get_excluded_chats(user_id)]
+                     excluded = [r[0] for r in await async_db.get_excluded_chats(user_id)]
                 except: excluded = []
-                
-                chats = {}
-                for row in cached_msgs:
-                    mid = row[0]; cid = row[1]; sid = row[2]; content = row[3]
-                    sname = row[4]; mtype = row[5]; fid = row[6]; s_username = row[7]
-                    
+
+                for row in rows:
+                    mid, cid = row[0], row[1]
+                    if chat_of.get(mid) not in (None, cid): continue # Same id, different chat
                     if cid in excluded: continue
+                    metrics.deletions_found.inc(source="update")
+                    self._spawn(user_id, self.report_deleted(client, user_id, cid, mid, (row[3], row[4], row[5], row[6], row[7], row[9]), "update", detected_at))
+            except Exception as e:
+                logging.error(f"Delete Handler Error: {e}")
+            finally:
+                metrics.handler_seconds.observe(time.perf_counter() - started, handler="deleted")
+
+    def _spawn(self, user_id: int, coro):
+        """Run handler follow-up work in the background; cancelled when the client stops"""
+        task = asyncio.create_task(coro)
+        running = self.bg_tasks.setdefault(user_id, set())
+        running.add(task)
+        task.add_done_callback(running.discard)
+        return task
+
+    async def _relay_and_cache(self, client: Client, user_id: int, message: PyMessage, row):
+        try:
+            saved_ref = await self.relay_secret_media(client, user_id, message, row[6], row[5], row[8])
+            if saved_ref:
+                # Deletion restore resends the bot's copy (or ours if the bot never got it)
+                message_buffer.cache_message(*row[:7], saved_ref, *row[8:])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Secret media relay failed: {e}", exc_info=True)
+
+    async def relay_secret_media(self, client: Client, user_id: int, message: PyMessage, media_type, s_name, s_username):
+        """
+        Download TTL/protected media once and hand it to the bot.
+        Small files stay in RAM; only files above SECRET_MEDIA_RAM_LIMIT are downloaded to disk.
+        Returns the file reference to cache for deletion restore: BOT:<bot file_id>,
+        or STORE:<key> (services/media_store.py) when the bot could not take the file.
+        """
+        fname = f"secret_{message.chat.id}_{message.id}{SECRET_EXT.get(media_type, '.bin')}"
+        unique_id = getattr(getattr(message, media_type or "", None), "file_unique_id", None)
+        caption = f"🔐 Секретное медиа от {s_name} (@{s_username if s_username else 'None'})\n📁 Чат: {message.chat.title or 'Личный'}"
+        size = getattr(getattr(message, media_type or "", None), "file_size", 0) or 0
+        buf = None; path = None
+        try:
+            if size > config.SECRET_MEDIA_RAM_LIMIT:
+                path = await downloads.fetch(user_id, client, message, media_type, size, file_name=os.path.abspath(os.path.join("downloads", fname)))
+            else:
+                buf = await downloads.fetch(user_id, client, message, media_type, size, in_memory=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as dl_e:
+            logging.error(f"Secret media download failed: {dl_e}")
+
+        if not buf and not path:
+            try: await notifier.send("send_message", user_id, f"👀 Замечено секретное медиа ({media_type}), но Telegram не дал его скачать.", priority=PRIORITY_SECRET)
+            except: pass
+            return None
+
+        data = buf.getvalue() if buf else None # materialized once: the bot upload and the media store share these bytes
+        inp = BufferedInputFile(data, filename=fname) if buf else FSInputFile(path)
+        bot_fid = None
+        try:
+            if media_type == "voice": sent_msg = await notifier.send("send_voice", user_id, inp, caption=caption, priority=PRIORITY_SECRET)
+            elif media_type == "video_note": sent_msg = await notifier.send("send_video_note", user_id, inp, priority=PRIORITY_SECRET); await notifier.send("send_message", user_id, caption, priority=PRIORITY_SECRET)
+            elif media_type == "photo": sent_msg = await notifier.send("send_photo", user_id, inp, caption=caption, priority=PRIORITY_SECRET)
+            elif media_type == "video": sent_msg = await notifier.send("send_video", user_id, inp, caption=caption, priority=PRIORITY_SECRET)
+            else: sent_msg = await notifier.send("send_document", user_id, inp, caption=caption, priority=PRIORITY_SECRET)
+            bot_fid = _bot_file_id(sent_msg)
+            if bot_fid and unique_id: await async_db.save_bot_file_id(unique_id, bot_fid, media_type)
+        except Exception as send_e:
+            logging.error(f"Error during bot send: {send_e}")
+            try: await client.send_document("me", path or buf, file_name=fname, caption=f"Fallback save: {caption}")
+            except: pass
+
+        if bot_fid:
+            if path and os.path.exists(path): os.remove(path)
+            return f"BOT:{bot_fid}"
+
+        # The bot has no copy we can resend, so keep the file for deletion restore
+        ext = SECRET_EXT.get(media_type, ".bin")
+        if path:
+            key = await media_store.put(src_path=path, key=unique_id, ext=ext)
+        else:
+            key = await media_store.put(data=data, key=unique_id, ext=ext)
+        return media_store.ref(key)
+
+    async def report_deleted(self, client: Client, user_id: int, chat_id: int, message_id: int, cached, source: str = "sweep", detected_at: float = None):
+        """Alert the owner about a deleted message, restoring media if possible, and drop it from cache"""
+        key = (user_id, chat_id, message_id)
+        if key in self._reported: return # Already handled by the other detection path
+        self._reported[key] = True
+        if len(self._reported) > 10000: self._reported.popitem(last=False)
+        try:
+            trace = alert_trace.start(user_id, chat_id, message_id, source, detected_at)
+
+            content, sname, mtype, fid, s_username, unique_id = cached
+            tag = f"@{s_username}" if s_username else ""
+            alert = f"🗑 Удалено сообщение!\n👤 {sname} {tag}\n💬 {content}"
+        
+            # Restore media
+            if mtype and fid:
+                cap = f"🗑 Восстановленное медиа от {sname}"
+                restored = False
+                try:
+                    # 1. The bot has uploaded this exact file before: resend by id, zero download/upload
+                    cached_fid = str(fid)[len("BOT:"):] if str(fid).startswith("BOT:") else None
+                    if not cached_fid and unique_id:
+                        cached_fid = await async_db.get_bot_file_id(unique_id)
+                    if cached_fid:
+                        try:
+                            await self._send_restored(user_id, mtype, cached_fid, cap)
+                            restored = True
+                        except Exception as e:
+                            logging.warning(f"Cached bot file_id for {unique_id} failed, uploading again: {e}")
+                            if unique_id: await async_db.delete_bot_file_id(unique_id)
+
+                    # 2. Upload from our store / disk, or download from Telegram
+                    if not restored:
+                        path = None; downloaded = False
+                        if media_store.key_of(fid):
+                            path = await media_store.get(media_store.key_of(fid))
+                        elif str(fid).startswith("LOCAL:"):
+                            path = str(fid).replace("LOCAL:", "")
+                            if not os.path.exists(path):
+                                logging.warning(f"Local file {path} not found for deleted message.")
+                                path = None # File not found, try downloading
+                        if not path and not str(fid).startswith(("BOT:", "STORE:", "LOCAL:")):
+                            path = await downloads.fetch(user_id, client, fid, mtype)
+                            downloaded = True
+
+                        if path:
+                            try:
+                                sent = await self._send_restored(user_id, mtype, FSInputFile(path), cap)
+                                restored = True
+                                bot_fid = _bot_file_id(sent)
+                                if unique_id and bot_fid: await async_db.save_bot_file_id(unique_id, bot_fid, mtype)
+                            except Exception: alert += "\n❌ Ошибка отправки медиа."
+                            if downloaded and os.path.exists(path): # Never remove stored/local cached files
+                                os.remove(path)
+                except Exception: pass # alert += "\n❌ Не удалось скачать."
+                if restored: alert += "\n💾 Медиа восстановлено."
+                mark(trace, "restored")
+        except BaseException:
+            # Cancelled (sweep deadline, client stop) before the alert was queued: let the next sweep or update retry it
+            self._reported.pop(key, None)
+            raise
+        
+        notifier.deletion(user_id, alert, trace=trace)
+        await message_buffer.delete_cached_message(message_id, chat_id)
+
+    async def _send_restored(self, user_id: int, mtype, inp, cap):
+        if mtype=='photo': return await notifier.send("send_photo", user_id, inp, caption=cap, priority=PRIORITY_DELETION)
+        elif mtype=='video': return await notifier.send("send_video", user_id, inp, caption=cap, priority=PRIORITY_DELETION)
+        elif mtype=='voice': return await notifier.send("send_voice", user_id, inp, caption=cap, priority=PRIORITY_DELETION)
+        elif mtype=='video_note': return await notifier.send("send_video_note", user_id, inp, priority=PRIORITY_DELETION)
+        else: return await notifier.send("send_document", user_id, inp, caption=cap, priority=PRIORITY_DELETION)
+
+    async def check_deleted_messages(self):
+        """Reconciliation fallback: poll recent cached messages for deletions the update stream missed"""
+        if self.shards: return # Each shard worker runs its own sweep
+        if self._sweep_lock.locked():
+            self.sweep_stats["skipped_overlaps"] += 1
+            logging.warning("Deletion sweep still running, skipping this run.")
+            return
+
+        async with self._sweep_lock:
+            started = time.monotonic()
+            run = {"clients": 0, "chats": 0, "deleted": 0, "errors": 0, "deferred": 0}
+            try:
+                global_sem = asyncio.Semaphore(config.SWEEP_CONCURRENCY)
+                clients = [(uid, c) for uid, c in list(self.clients.items()) if c.is_connected]
+                run["clients"] = len(clients)
+                tasks = [asyncio.create_task(self._sweep_client(uid, c, global_sem, run)) for uid, c in clients]
+                if tasks:
+                    done, pending = await asyncio.wait(tasks, timeout=config.SWEEP_DEADLINE_SECONDS)
+                    for t in pending: t.cancel()
+                    if pending:
+                        await asyncio.gather(*pending, return_exceptions=True)
+                        self.sweep_stats["timeouts"] += 1
+                        logging.warning(f"Deletion sweep hit {config.SWEEP_DEADLINE_SECONDS}s deadline, {len(pending)} clients unfinished.")
+            except Exception as e:
+                logging.error(f"Check deleted loop error: {e}")
+
+            duration = time.monotonic() - started
+            metrics.sweep_seconds.observe(duration)
+            self.sweep_stats.update(last_duration=round(duration, 2), max_duration=round(max(duration, self.sweep_stats["max_duration"]), 2), runs=self.sweep_stats["runs"] + 1, last_run=run)
+            logging.info(f"🔎 Deletion sweep: {run['clients']} clients, {run['chats']} chats, {run['deleted']} deleted, {run['errors']} failed, {run['deferred']} clients deferred in {duration:.1f}s")
+
+    async def _sweep_client(self, user_id: int, client: Client, global_sem: asyncio.Semaphore, run: dict):
+        if limiter.backoff(user_id, "history"):
+            run["deferred"] += 1 # FloodWait pause: this client is checked again next sweep
+            return
+        cached_msgs = await message_buffer.get_messages_for_check(user_id)
+        if not cached_msgs: return
+        
+        # Get exclusions
+        try:
+             excluded = [r[0] for r in await async_db.get_excluded_chats(user_id)]
+        except: excluded = []
+        
+        chats = {}
+        for row in cached_msgs:
+            mid = row[0]; cid = row[1]; sid = row[2]; content = row[3]
+            sname = row[4]; mtype = row[5]; fid = row[6]; s_username = row[7]
+            
+            if cid in excluded: continue
+            
+            if cid not in chats: chats[cid] = {}
+            chats[cid][mid] = (content, sname, mtype, fid, s_username, row[9])
+
+        client_sem = asyncio.Semaphore(config.SWEEP_PER_CLIENT)
+        await asyncio.gather(*(self._sweep_chat(user_id, client, chat_id, msgs, global_sem, client_sem, run) for chat_id, msgs in chats.items()))
+
+    async def _sweep_chat(self, user_id, client, chat_id, msgs, global_sem, client_sem, run):
+        msg_ids = list(msgs.keys())
+        if not msg_ids: return
+        
+        try:
+            current = await limiter.call(user_id, "history", client.get_messages, chat_id, msg_ids, slots=(client_sem, global_sem))
+            detected_at = time.time()
+            run["chats"] += 1
+            if not isinstance(current, list): current = [current]
+            
+            # Process 
+            for i, msg_obj in enumerate(current):
+                orig_id = msg_ids[i]
+                # Check deletion
+                is_deleted = False
+                if msg_obj is None or (hasattr(msg_obj, 'empty') and msg_obj.empty):
+                    is_deleted = True
                     
-                    if cid not in chats: chats[cid] = {}
-                    chats[cid][mid] = (content, sname, mtype, fid, s_username)
-                
-                for chat_id, msgs in chats.items():
-                    msg_ids = list(msgs.keys())
-                    if not msg_ids: continue
+                if is_deleted:
+                    run["deleted"] += 1
+                    metrics.deletions_found.inc(source="sweep")
+                    await self.report_deleted(client, user_id, chat_id, orig_id, msgs[orig_id], "sweep", detected_at)
                     
-                    try:
-                        current = await client.get_messages(chat_id, msg_ids)
-                        if not isinstance(current, list): current = [current]
-                        
-                        # Process 
-                        for i, msg_obj in enumerate(current):
-                            orig_id = msg_ids[i]
-                            # Check deletion
-                            is_deleted = False
-                            if msg_obj is None or (hasattr(msg_obj, 'empty') and msg_obj.empty):
-                                is_deleted = True
-                                
-                            if is_deleted:
-                                content, sname, mtype, fid, s_username = msgs[orig_id]
-                                tag = f"@{s_username}" if s_username else ""
-                                alert = f"🗑 Удалено сообщение!\n👤 {sname} {tag}\n💬 {content}"
-                                
-                                # Restore media
-                                if mtype and fid:
-                                    try:
-                                        path = None
-                                        if str(fid).startswith("LOCAL:"):
-                                            path = str(fid).replace("LOCAL:", "")
-                                            if not os.path.exists(path):
-                                                logging.warning(f"Local file {path} not found for deleted message.")
-                                                path = None # File not found, try downloading
-                                        
-                                        if not path: # If not local or local file not found, download
-                                            path = await client.download_media(fid)
-
-                                        if path:
-                                            inp = FSInputFile(path)
-                                            cap = f"🗑 Восстановленное медиа от {sname}"
-                                            try:
-                                                if mtype=='photo': await bot.send_photo(user_id, inp, caption=cap)
-                                                elif mtype=='video': await bot.send_video(user_id, inp, caption=cap)
-                                                elif mtype=='voice': await bot.send_voice(user_id, inp, caption=cap)
-                                                else: await bot.send_document(user_id, inp, caption=cap)
-                                                alert += "\n💾 Медиа восстановлено."
-                                            except: alert += "\n❌ Ошибка отправки медиа."
-                                            if os.path.exists(path) and not str(fid).startswith("LOCAL:"): # Only remove if not a local cached file
-                                                os.remove(path)
-                                    except: pass # alert += "\n❌ Не удалось скачать."
-                                
-                                await bot.send_message(user_id, alert)
-                                database.delete_cached_message(orig_id, chat_id)
-                                
-                    except Exception as e:
-                        # logging.error(f"Check chat {chat_id} failed: {e}")
-                        pass
-
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logging.error(f"Check deleted loop error: {e}")
+            run["errors"] += 1
+            # One warning per sweep, the rest at debug: a broken client fails every chat it has
+            logging.log(logging.WARNING if run["errors"] == 1 else logging.DEBUG, f"Check chat {chat_id} of {user_id} failed: {e}")
 
 ub_manager = UserBotManager()
+metrics.Gauge("userbot_clients", "UserBot clients running in this process", fn=lambda: len(ub_manager.clients))
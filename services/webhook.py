@@ -0,0 +1,38 @@
+import asyncio
+import logging
+import secrets
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import config
+
+def build_app(dp: Dispatcher, bot: Bot, secret_token: str):
+    """
+    aiohttp app that feeds Telegram's webhook POSTs into the dispatcher.
+    Requests without the right X-Telegram-Bot-Api-Secret-Token are rejected,
+    and every update is handled in its own task, so a slow handler never
+    delays the next update.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret_token, handle_in_background=True).register(app, path=config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Serve the webhook and register it with Telegram; runs until cancelled."""
+    secret_token = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    runner = web.AppRunner(build_app(dp, bot, secret_token))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, config.WEBHOOK_HOST, config.WEBHOOK_PORT).start()
+        url = config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH
+        await bot.set_webhook(
+            url,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )
+        logging.info(f"🌐 Webhook listening on {config.WEBHOOK_HOST}:{config.WEBHOOK_PORT}{config.WEBHOOK_PATH}, registered as {url}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()